@@ -1,16 +1,452 @@
 import os
-from flask import Flask, request, abort, jsonify
+from datetime import datetime, timedelta
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
 
-def create_app(test_config=None):
-  # create and configure the app
+import geo
+import instrumentation
+import routing
+from availability import available_venues
+from booking import (EXCLUSION_VIOLATION, BookingConflict, book, book_series, cancel_occurrence, ensure_free,
+                     materialize, pgcode, run_in_transaction)
+from cache import cache
+from counters import counters_cli
+from config import PROFILES
+from database import MigrateGroup, pool_stats
+from importer import import_command
+from jobs import jobs, worker_command
+from export import EXPORTS, FORMATS, export, export_command
+from etags import artist_etag, conditional, require_match, show_etag, venue_etag
+from genres import genres_cli
+from model import db, Venue, Artist, Show, ShowSeries
+from loaders import apply_profile
+from partitions import partitions_cli
+from pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_page, page_size
+from queries import (artist_shows_query, calendar, filter_by_genre, region_tag, split_shows, venue_shows,
+                     venues_by_region, venues_near)
+from search import search
+from serializers import ARTISTS, SHOWS, VENUES, json_response
+
+VENUE_FIELDS = ('name', 'city', 'state', 'address', 'phone', 'image_link', 'facebook_link',
+                'website_link', 'look_talent', 'seek_des', 'genres', 'latitude', 'longitude')
+ARTIST_FIELDS = ('name', 'city', 'state', 'phone', 'image_link', 'facebook_link',
+                 'website_link', 'seeking_venue', 'seek_des', 'genres')
+# listings carry the show counters; detail pages count their shows live instead,
+# since the counters lag until the next `flask counters roll`
+COUNTERS = ('upcoming_show_count', 'past_show_count')
+
+
+def detail_fields(obj):
+  return {name: value for name, value in obj.format().items() if name not in COUNTERS}
+
+
+def create_app(test_config=None, profile=None):
+  # create and configure the app; nothing here connects to the database or
+  # imports Alembic, so building it (and forking after) stays cheap
+  profile = profile or os.environ.get('FYYUR_ENV', 'development')
+  if profile not in PROFILES:
+    raise ValueError('unknown config profile %r, expected one of %s' % (profile, ', '.join(sorted(PROFILES))))
   app = Flask(__name__)
+  app.config.from_object(PROFILES[profile])
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  if not app.config.get('SECRET_KEY'):
+    raise RuntimeError('SECRET_KEY must be set in the environment for the %s profile' % profile)
+  routing.init_app(app, db)
+  db.init_app(app)
+  cache.init_app(app)
+  geo.init_app(app)
+  jobs.init_app(app)
+  instrumentation.init_app(app)
   CORS(app)
+  app.cli.add_command(import_command)
+  app.cli.add_command(export_command)
+  app.cli.add_command(counters_cli)
+  app.cli.add_command(geo.geocode_cli)
+  app.cli.add_command(worker_command)
+  app.cli.add_command(partitions_cli)
+  app.cli.add_command(genres_cli)
+  app.cli.add_command(MigrateGroup(app, db))
 
-  return app
+  def get_or_404(query, model, id):
+    item = query.filter(model.id == id).one_or_none()
+    if item is None:
+      abort(404)
+    return item
+
+  def update(model, id, etag_for, apply):
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict) or not changes:
+      abort(400)
+    item = get_or_404(model.query, model, id)
+    # the loaded version guards the UPDATE, so a write that lands after this
+    # check still fails with StaleDataError instead of being overwritten
+    require_match(etag_for(id))
+    try:
+      apply(item, changes)
+    except (KeyError, TypeError, ValueError):
+      db.session.rollback()
+      abort(400)
+    except BookingConflict:
+      db.session.rollback()
+      abort(409)
+    try:
+      db.session.commit()
+    except StaleDataError:
+      db.session.rollback()
+      abort(412)
+    except DBAPIError as e:
+      db.session.rollback()
+      if pgcode(e) == EXCLUSION_VIOLATION:
+        abort(409)
+      raise
+    response = jsonify({'success': True, model.__tablename__.rstrip('s'): item.format()})
+    response.set_etag(etag_for(id))
+    return response
+
+  def apply_fields(fields):
+    def apply(item, changes):
+      unknown = set(changes) - set(fields)
+      if unknown:
+        raise KeyError(unknown.pop())
+      for key, value in changes.items():
+        setattr(item, key, value)
+    return apply
+
+  def apply_show_changes(show, changes):
+    # nothing is flushed before ensure_free holds the venue lock
+    with db.session.no_autoflush:
+      for key, value in changes.items():
+        if key == 'time':
+          show.time = datetime.fromisoformat(value)
+        elif key == 'venue_id':
+          if Venue.query.get(value) is None:
+            raise ValueError(value)
+          show.venue_id = value
+        elif key == 'artist_ids':
+          artists = Artist.query.filter(Artist.id.in_(value)).all()
+          if len(artists) != len(set(value)):
+            raise ValueError(value)
+          show.artist = artists
+        elif key == 'duration':
+          show.duration = value
+        else:
+          raise KeyError(key)
+    if {'time', 'venue_id', 'duration'} & set(changes):
+      ensure_free(show)
+
+  def paginate(serializer, query, columns):
+    # listings are read-only, so rows are rendered from the selected columns
+    # without building ORM objects
+    try:
+      limit = page_size(request.args.get('limit'), app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+      rows, next_cursor = keyset_page(query, columns, request.args.get('cursor'), limit)
+    except InvalidCursor:
+      abort(400)
+    return json_response({
+      'success': True,
+      'data': serializer.render(rows),
+      'next_cursor': next_cursor,
+    })
+
+  def listing(serializer):
+    query = serializer.query()
+    genre = request.args.get('genre')
+    if genre:
+      query = filter_by_genre(query, serializer.model, genre)
+    return paginate(serializer, query, [serializer.model.id])
+
+  @app.route('/venues')
+  @cache.cached('venues', vary_on_args=True)
+  def get_venues():
+    return listing(VENUES)
+
+  @app.route('/venues/by-region')
+  @cache.cached('regions', vary_on_args=True)
+  def get_venues_by_region():
+    city, state = request.args.get('city'), request.args.get('state')
+    regions = venues_by_region(city, state)
+    cache.depends_on(region_tag(city, state))
+    return json_response({
+      'success': True,
+      'data': [{'city': city, 'state': state, 'venues': venues} for city, state, venues in regions],
+    })
+
+  @app.route('/venues/near')
+  def get_venues_near():
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius_km', 25.0, type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+      abort(400)
+    if not 0 < radius <= app.config['NEAR_MAX_RADIUS_KM']:
+      abort(400)
+    try:
+      limit = page_size(request.args.get('limit'), app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+    except InvalidCursor:
+      abort(400)
+    return json_response({
+      'success': True,
+      'data': [
+        dict(venue, distance_km=round(distance, 3))
+        for venue, distance in venues_near(lat, lng, radius, limit)
+      ],
+    })
+
+  @app.route('/venues/available')
+  def get_available_venues():
+    # ?start&end&city&state&genre=Jazz,Blues&min_minutes: venues looking for
+    # talent with a free window of min_minutes somewhere in [start, end)
+    try:
+      start = datetime.fromisoformat(request.args['start'])
+      end = datetime.fromisoformat(request.args['end'])
+      min_minutes = int(request.args.get('min_minutes', 120))
+      limit = page_size(request.args.get('limit'), app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+      cursor = request.args.get('cursor')
+      after_id = decode_cursor(cursor, (int,))[0] if cursor else None
+    except (KeyError, ValueError):
+      abort(400)
+    if not start < end <= start + timedelta(days=app.config['CALENDAR_MAX_DAYS']) or min_minutes < 1:
+      abort(400)
+    genres = [name.strip() for value in request.args.getlist('genre') for name in value.split(',') if name.strip()]
+    found, has_more = available_venues(start, end, request.args.get('city'), request.args.get('state'), genres,
+                                       min_minutes, after_id, limit)
+    venues = VENUES.fetch([venue_id for venue_id, _ in found])
+    return json_response({
+      'success': True,
+      'data': [
+        dict(venues[venue_id], free=[{'start': starts, 'end': ends} for starts, ends in windows])
+        for venue_id, windows in found
+      ],
+      'next_cursor': encode_cursor([found[-1][0]]) if has_more else None,
+    })
+
+  @app.route('/venues/<int:venue_id>')
+  @conditional(venue_etag)
+  @cache.cached('venue:{venue_id}')
+  def get_venue(venue_id):
+    venue = get_or_404(Venue.query, Venue, venue_id)
+    shows = split_shows(venue_shows(venue_id), 'venue_detail')
+    cache.depends_on(*['show:%d' % show.id for show in shows.upcoming + shows.past])
+    return jsonify({
+      'success': True,
+      'venue': dict(
+        detail_fields(venue),
+        upcoming_shows=[show.format() for show in shows.upcoming],
+        past_shows=[show.format() for show in shows.past],
+        upcoming_shows_count=shows.upcoming_count,
+        past_shows_count=shows.past_count,
+      ),
+    })
+
+  @app.route('/venues/<int:venue_id>', methods=['PATCH'])
+  def update_venue(venue_id):
+    return update(Venue, venue_id, venue_etag, apply_fields(VENUE_FIELDS))
+
+  @app.route('/artists')
+  @cache.cached('artists', vary_on_args=True)
+  def get_artists():
+    return listing(ARTISTS)
+
+  @app.route('/artists/<int:artist_id>')
+  @conditional(artist_etag)
+  @cache.cached('artist:{artist_id}')
+  def get_artist(artist_id):
+    artist = get_or_404(Artist.query, Artist, artist_id)
+    shows = split_shows(artist_shows_query(artist_id), 'artist_detail')
+    for show in shows.upcoming + shows.past:
+      cache.depends_on('show:%d' % show.id, 'venue:%d' % show.venue_id)
+    return jsonify({
+      'success': True,
+      'artist': dict(
+        detail_fields(artist),
+        upcoming_shows=[dict(show.format(), venue_name=show.venue.name) for show in shows.upcoming],
+        past_shows=[dict(show.format(), venue_name=show.venue.name) for show in shows.past],
+        upcoming_shows_count=shows.upcoming_count,
+        past_shows_count=shows.past_count,
+      ),
+    })
+
+  @app.route('/artists/<int:artist_id>', methods=['PATCH'])
+  def update_artist(artist_id):
+    return update(Artist, artist_id, artist_etag, apply_fields(ARTIST_FIELDS))
+
+  @app.route('/shows')
+  @cache.cached('shows', vary_on_args=True)
+  def get_shows():
+    return paginate(SHOWS, SHOWS.query(), [Show.time, Show.id])
 
-APP = create_app()
+  @app.route('/shows', methods=['POST'])
+  def create_show():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    try:
+      show = book(body['venue_id'], body.get('artist_ids', []), datetime.fromisoformat(body['time']),
+                  body.get('duration', 120))
+    except (KeyError, TypeError, ValueError):
+      abort(400)
+    except BookingConflict:
+      abort(409)
+    return jsonify({'success': True, 'show': show.format()}), 201
+
+  @app.route('/shows/<int:show_id>')
+  @conditional(show_etag)
+  @cache.cached('show:{show_id}')
+  def get_show(show_id):
+    show = get_or_404(apply_profile(Show.query, 'show_detail'), Show, show_id)
+    cache.depends_on('venue:%d' % show.venue_id)
+    return jsonify({'success': True, 'show': dict(show.format(), venue_name=show.venue.name)})
+
+  @app.route('/shows/<int:show_id>', methods=['PATCH'])
+  def update_show(show_id):
+    return update(Show, show_id, show_etag, apply_show_changes)
+
+  @app.route('/venues/<int:venue_id>/series', methods=['POST'])
+  def create_series(venue_id):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    get_or_404(Venue.query, Venue, venue_id)
+    try:
+      item = book_series(venue_id, body.get('artist_ids', []), body['rrule'], datetime.fromisoformat(body['starts_at']),
+                         body.get('duration', 120))
+    except (KeyError, TypeError, ValueError):
+      abort(400)
+    except BookingConflict:
+      abort(409)
+    return jsonify({'success': True, 'series': item.format()}), 201
+
+  @app.route('/series/<int:series_id>')
+  def get_series(series_id):
+    return jsonify({'success': True, 'series': get_or_404(ShowSeries.query, ShowSeries, series_id).format()})
+
+  def occurrence_time(value):
+    try:
+      return datetime.fromisoformat(value)
+    except ValueError:
+      abort(404)
+
+  @app.route('/series/<int:series_id>/occurrences/<occurrence>', methods=['PATCH'])
+  def update_occurrence(series_id, occurrence):
+    # editing an occurrence stores it as a Show that replaces the generated one
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict) or not changes:
+      abort(400)
+    occurrence = occurrence_time(occurrence)
+
+    def work():
+      show = materialize(series_id, occurrence)
+      apply_show_changes(show, changes)
+      return show
+
+    try:
+      show = run_in_transaction(work)
+    except LookupError:
+      abort(404)
+    except (KeyError, TypeError, ValueError):
+      abort(400)
+    except BookingConflict:
+      abort(409)
+    return jsonify({'success': True, 'show': show.format()})
+
+  @app.route('/series/<int:series_id>/occurrences/<occurrence>', methods=['DELETE'])
+  def delete_occurrence(series_id, occurrence):
+    try:
+      cancel_occurrence(series_id, occurrence_time(occurrence))
+    except LookupError:
+      abort(404)
+    return jsonify({'success': True})
+
+  @app.route('/calendar')
+  def get_calendar():
+    try:
+      start = datetime.fromisoformat(request.args['start'])
+      end = datetime.fromisoformat(request.args['end'])
+    except (KeyError, ValueError):
+      abort(400)
+    venue_id = request.args.get('venue_id', type=int)
+    if not start < end <= start + timedelta(days=app.config['CALENDAR_MAX_DAYS']):
+      abort(400)
+    return json_response({
+      'success': True,
+      'data': [
+        entry._asdict()
+        for entry in calendar(start, end, venue_id)
+      ],
+    })
+
+  @app.route('/search')
+  def search_endpoint():
+    model = {'venues': Venue, 'artists': Artist}.get(request.args.get('type', 'venues'))
+    page = request.args.get('page', 1, type=int)
+    if model is None or page < 1:
+      abort(400)
+    try:
+      per_page = page_size(request.args.get('limit'), app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+    except InvalidCursor:
+      abort(400)
+    rows, has_more = search(model, request.args.get('q', ''), page, per_page)
+    return json_response({
+      'success': True,
+      'data': [
+        {'id': id, 'name': name, 'city': city, 'state': state, 'rank': rank}
+        for id, name, city, state, rank in rows
+      ],
+      'next_page': page + 1 if has_more else None,
+    })
+
+  @app.route('/export/<kind>')
+  def get_export(kind):
+    fmt = request.args.get('format', 'ndjson')
+    if kind not in EXPORTS:
+      abort(404)
+    if fmt not in FORMATS:
+      abort(400)
+    compress = 'gzip' in request.accept_encodings
+    # get_bind sends a read-only request's dump to a replica
+    chunks = export(kind, fmt, compress, engine=db.session.get_bind(Show.__mapper__))
+    response = Response(stream_with_context(chunks), mimetype=FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (kind, fmt)
+    response.vary.add('Accept-Encoding')
+    if compress:
+      response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+  @app.route('/health/pool')
+  def get_pool_stats():
+    replicas = app.extensions['replicas']
+    return jsonify({
+      'success': True,
+      'pool': pool_stats(db.engine),
+      'replicas': {key: pool_stats(replicas.engine(key)) for key in replicas.keys},
+    })
+
+  @app.route('/metrics')
+  def get_metrics():
+    text = app.extensions['metrics'].render(instrumentation.pools(app, db))
+    return app.response_class(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+  @app.errorhandler(400)
+  def bad_request(error):
+    return jsonify({'success': False, 'error': 400, 'message': 'bad request'}), 400
+
+  @app.errorhandler(404)
+  def not_found(error):
+    return jsonify({'success': False, 'error': 404, 'message': 'resource not found'}), 404
+
+  @app.errorhandler(409)
+  def conflict(error):
+    return jsonify({'success': False, 'error': 409, 'message': 'conflict'}), 409
+
+  @app.errorhandler(412)
+  def precondition_failed(error):
+    return jsonify({'success': False, 'error': 412, 'message': 'precondition failed'}), 412
+
+  return app
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+  create_app().run(host='0.0.0.0', port=8080)
@@ -0,0 +1,12 @@
+"""ASGI entry point for any ASGI server, e.g. ``uvicorn asgi:application --workers 2``.
+
+Like wsgi.py this builds the production profile unless FYYUR_ENV says
+otherwise; see serving.ThreadPoolASGI for how requests are run.
+"""
+import os
+
+from app import create_app
+from serving import ThreadPoolASGI
+
+
+application = ThreadPoolASGI(create_app(profile=os.environ.get('FYYUR_ENV', 'production')))
@@ -0,0 +1,130 @@
+"""Free windows at venues looking for talent over an arbitrary date range.
+
+A venue is busy during its stored shows and its series occurrences; what is
+left of [start, end) are its free windows. Candidates are handled a chunk at a
+time until a page is full. On Postgres one statement per chunk does the
+work: the chunk's shows are read through ix_shows_venue_id_time, merged with
+``range_agg`` and subtracted from the requested range as a ``tsmultirange``
+(Postgres 14+). Elsewhere the same shows come back ordered by ``(venue_id,
+time)`` and are swept in Python.
+"""
+from datetime import timedelta
+from itertools import groupby
+
+from sqlalchemy import DateTime, Integer, bindparam, exists, func, literal, literal_column, select, true, union_all
+from sqlalchemy.dialects.postgresql import ARRAY
+
+import series
+from booking import MAX_DURATION
+from model import db, Venue, Genre, Show, venue_genres
+
+
+SWEEP_CHUNK = 4  # candidates per chunk, as a multiple of the page size
+
+
+def candidates(city=None, state=None, genres=()):
+    """Ids of venues looking for talent, optionally in a city/state and
+    matching any of ``genres``, in id order."""
+    query = select(Venue.id).where(Venue.look_talent == 'y')
+    for column, value in ((Venue.city, city), (Venue.state, state)):
+        if value is not None:
+            query = query.where(column == value)
+    if genres:
+        # resolved once here rather than joined in every chunk's statement,
+        # so the planner sees the genre ids and their row estimates
+        genre_ids = db.session.execute(select(Genre.id).where(Genre.name.in_(list(genres)))).scalars().all()
+        query = query.where(exists().where(venue_genres.c.venue_id == Venue.id,
+                                           venue_genres.c.genre_id.in_(genre_ids)))
+    return query.order_by(Venue.id)
+
+
+def free_windows(start, end, busy, min_length):
+    """Gaps of at least ``min_length`` left in [start, end) by ``busy``
+    ``(starts, ends)`` intervals sorted by start."""
+    windows, cursor = [], start
+    for starts, ends in busy:
+        if starts - cursor >= min_length:
+            windows.append((cursor, min(starts, end)))
+        cursor = max(cursor, ends)
+        if cursor >= end:
+            break
+    if end - cursor >= min_length:
+        windows.append((cursor, end))
+    return windows
+
+
+def _occurrences(start, end, venue_ids):
+    # series occurrences as (venue_id, starts, ends), sorted like the shows
+    return sorted((item.venue_id, time, time + timedelta(minutes=item.duration))
+                  for item, time in series.slots(start, end, venue_ids=venue_ids))
+
+
+def available_venues(start, end, city=None, state=None, genres=(), min_minutes=120, after_id=None, limit=20):
+    """``([(venue_id, [(starts, ends), ...]), ...], has_more)`` for the first
+    ``limit`` candidate venues after ``after_id`` with a free window of at
+    least ``min_minutes`` in [start, end).
+
+    Candidates are taken in id order, a chunk at a time, until the page is
+    full, so the cost follows the page size rather than how many venues the
+    city has.
+    """
+    query = candidates(city, state, genres)
+    min_length = timedelta(minutes=min_minutes)
+    windows_of = _windows_postgresql if db.engine.dialect.name == 'postgresql' else _windows_fallback
+    found = []
+    while len(found) <= limit:
+        chunk = query if after_id is None else query.where(Venue.id > after_id)
+        ids = db.session.execute(chunk.limit((limit + 1) * SWEEP_CHUNK)).scalars().all()
+        if not ids:
+            break
+        found.extend(windows_of(ids, start, end, min_length))
+        after_id = ids[-1]
+    return found[:limit], len(found) > limit
+
+
+def _windows_postgresql(ids, start, end, min_length):
+    candidate = func.unnest(bindparam('candidate_ids', ids, type_=ARRAY(Integer))) \
+        .table_valued('id').render_derived('candidate')
+    minute = literal_column("interval '1 minute'")
+    busy = select(Show.venue_id, func.tsrange(Show.time, Show.time + minute * Show.duration).label('slot')) \
+        .where(Show.venue_id.in_(ids), Show.time < end, Show.time > start - timedelta(minutes=MAX_DURATION))
+    occurrences = _occurrences(start, end, ids)
+    if occurrences:
+        venue_ids, starts, ends = zip(*occurrences)
+        generated = func.unnest(bindparam('occurrence_venue_ids', list(venue_ids), type_=ARRAY(Integer)),
+                                bindparam('occurrence_starts', list(starts), type_=ARRAY(DateTime)),
+                                bindparam('occurrence_ends', list(ends), type_=ARRAY(DateTime))) \
+            .table_valued('venue_id', 'starts', 'ends').render_derived('occurrence')
+        busy = union_all(busy, select(generated.c.venue_id, func.tsrange(generated.c.starts, generated.c.ends)))
+    busy = busy.cte('busy')
+    taken = func.coalesce(func.range_agg(busy.c.slot), literal_column("'{}'::tsmultirange"))
+    free = select(candidate.c.id.label('venue_id'),
+                  func.tsmultirange(func.tsrange(literal(start), literal(end))).op('-')(taken).label('windows')) \
+        .select_from(candidate.outerjoin(busy, busy.c.venue_id == candidate.c.id)) \
+        .group_by(candidate.c.id).cte('free')
+    unnested = func.unnest(free.c.windows).table_valued('window').render_derived('free_window').lateral()
+    window = unnested.c.window
+    rows = db.session.execute(
+        select(free.c.venue_id, func.lower(window), func.upper(window))
+        .select_from(free.join(unnested, true()))
+        .where(func.upper(window) - func.lower(window) >= min_length)
+        .order_by(free.c.venue_id, func.lower(window)))
+    return [(venue_id, [(starts, ends) for _, starts, ends in group])
+            for venue_id, group in groupby(rows, key=lambda row: row[0])]
+
+
+def _windows_fallback(ids, start, end, min_length):
+    rows = db.session.execute(
+        select(Show.venue_id, Show.time, Show.duration)
+        .where(Show.venue_id.in_(ids), Show.time < end, Show.time > start - timedelta(minutes=MAX_DURATION))
+        .order_by(Show.venue_id, Show.time))
+    busy = {venue_id: [(time, time + timedelta(minutes=duration)) for _, time, duration in group]
+            for venue_id, group in groupby(rows, key=lambda row: row[0])}
+    for venue_id, starts, ends in _occurrences(start, end, ids):
+        busy.setdefault(venue_id, []).append((starts, ends))
+    found = []
+    for venue_id in ids:
+        windows = free_windows(start, end, sorted(busy.get(venue_id, ())), min_length)
+        if windows:
+            found.append((venue_id, windows))
+    return found
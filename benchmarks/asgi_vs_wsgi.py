@@ -0,0 +1,185 @@
+"""Compare thread-per-request WSGI serving with asgi.ThreadPoolASGI as concurrency grows.
+
+    python benchmarks/asgi_vs_wsgi.py --database-url postgresql://localhost/fyyur --generate --clients 16,64,256
+
+Both modes run in-process without sockets, so the numbers isolate the
+serving model. ``wsgi`` gives every client its own thread, which is what
+werkzeug's threaded server and most thread-per-connection servers do.
+``asgi`` runs every client as a task on one event loop, with requests on
+the adapter's bounded pools. Each mode runs in its own subprocess and
+reports read req/s, p50/p95/p99, 503s, peak threads and peak RSS growth.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from serving import ThreadPoolASGI, build_environ  # noqa: E402
+from datagen import create_schema, generate, load  # noqa: E402
+from load import detail, listing, search  # noqa: E402
+from report import summarize  # noqa: E402
+
+
+READS = (listing, detail, search)
+
+
+def rss_kib():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class Monitor(object):
+    """Sample thread count and resident memory until stopped."""
+
+    def __init__(self):
+        self.start_rss = rss_kib()
+        self.peak_rss = self.start_rss
+        self.peak_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(0.05):
+            self.peak_rss = max(self.peak_rss, rss_kib())
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return {'peak_threads': self.peak_threads, 'rss_growth_mib': (self.peak_rss - self.start_rss) / 1024.0}
+
+
+def scope_for(rng, sizes):
+    _, target, _ = rng.choice(READS)(rng, sizes)
+    path, _, query = target.partition('?')
+    return {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode('latin-1'),
+            'headers': [], 'http_version': '1.1', 'scheme': 'http'}
+
+
+def run_wsgi(app, clients, duration, sizes):
+    deadline = time.perf_counter() + duration
+    latencies, statuses = [], []
+
+    def client(index):
+        rng = random.Random(index)
+        while time.perf_counter() < deadline:
+            status = []
+            started = time.perf_counter()
+            result = app(build_environ(scope_for(rng, sizes), b''), lambda s, h, e=None: status.append(s))
+            try:
+                for _ in result:
+                    pass
+            finally:
+                result.close()
+            latencies.append(time.perf_counter() - started)
+            statuses.append(int(status[0][:3]))
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+
+def run_asgi(app, clients, duration, sizes):
+    adapter = ThreadPoolASGI(app)
+    latencies, statuses = [], []
+
+    async def client(index, deadline):
+        rng = random.Random(index)
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        while time.perf_counter() < deadline:
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            started = time.perf_counter()
+            await adapter(scope_for(rng, sizes), receive, send)
+            latencies.append(time.perf_counter() - started)
+            statuses.append(messages[0]['status'])
+            if messages[0]['status'] == 503:
+                await asyncio.sleep(0.1)  # a polite client backs off on 503
+
+    async def main():
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[client(index, deadline) for index in range(clients)])
+
+    asyncio.run(main())
+    adapter.reads.shutdown()
+    adapter.writes.shutdown()
+    return latencies, statuses
+
+
+def measure(args):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'CACHE_BACKEND': 'null', 'SLOW_QUERY_MS': 0,
+                      'DEBUG': False})
+    sizes = {'venues': args.venues, 'artists': args.artists, 'shows': args.shows}
+    results = {}
+    for clients in args.clients:
+        monitor = Monitor()
+        began = time.perf_counter()
+        latencies, statuses = (run_wsgi if args.mode == 'wsgi' else run_asgi)(app, clients, args.duration, sizes)
+        elapsed = time.perf_counter() - began
+        served = [latency for latency, status in zip(latencies, statuses) if status != 503]
+        summary = summarize(served, sum(status >= 500 and status != 503 for status in statuses), elapsed)
+        summary['busy'] = statuses.count(503)
+        summary.update(monitor.stop())
+        results[clients] = summary
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--generate', action='store_true', help='load the synthetic catalogue first')
+    parser.add_argument('--venues', type=int, default=200)
+    parser.add_argument('--artists', type=int, default=1000)
+    parser.add_argument('--shows', type=int, default=20000)
+    parser.add_argument('--clients', type=lambda text: [int(n) for n in text.split(',')], default=[16, 64, 256],
+                        help='comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per concurrency level')
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+
+    if args.mode:
+        json.dump(measure(args), sys.stdout)
+        return 0
+    if args.generate:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'CACHE_BACKEND': 'null', 'DEBUG': False})
+        with app.app_context():
+            create_schema(app)
+            load(generate(args.venues, args.artists, args.shows))
+    print('%-5s %7s %9s %9s %9s %9s %6s %8s %9s' % (
+        'mode', 'clients', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', '503s', 'threads', 'rss MiB'))
+    child = [arg for arg in sys.argv[1:] if arg != '--generate']
+    for mode in ('wsgi', 'asgi'):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode] + child,
+                                check=True, stdout=subprocess.PIPE).stdout
+        for clients, summary in sorted(json.loads(output).items(), key=lambda item: int(item[0])):
+            print('%-5s %7s %9.1f %9.1f %9.1f %9.1f %6d %8d %9.1f' % (
+                mode, clients, summary['rps'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms'],
+                summary['busy'], summary['peak_threads'], summary['rss_growth_mib']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
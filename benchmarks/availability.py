@@ -0,0 +1,100 @@
+"""Time GET /venues/available on a large synthetic catalogue.
+
+    python benchmarks/availability.py --database-url postgresql://localhost/fyyur --generate --venues 100000 --shows 500000
+
+Each request asks for venues looking for talent in a random datagen city
+with a free window of 2-6 hours somewhere in a 1 to 14 day range during the
+first weeks of the generated calendar, where the shows are densest. Half
+the requests also filter on a random genre. p50/p95/p99 per scenario are
+printed; ``--max-p95-ms`` fails the run when a scenario is slower.
+
+Measured on a laptop-class machine against a local Postgres 16 with 100k
+venues and 500k shows: p95 about 41 ms for a city and 40 ms for a city and
+genre, including Flask and serialization. The genre filter cost 91 ms at p95
+while its names were joined in the candidates statement, which the planner
+misestimated into a probe of every venue with the genre.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from datagen import CITIES, GENRES, START, create_schema, generate, load  # noqa: E402
+from report import format_table, summarize  # noqa: E402
+
+
+def request(rng, with_genre, limit):
+    city, state = rng.choice(CITIES)
+    start = START + timedelta(hours=rng.randrange(0, 30 * 24))
+    query = {
+        'start': start.isoformat(),
+        'end': (start + timedelta(days=rng.randint(1, 14))).isoformat(),
+        'city': city,
+        'state': state,
+        'min_minutes': rng.choice((120, 240, 360)),
+        'limit': limit,
+    }
+    if with_genre:
+        query['genre'] = rng.choice(GENRES)
+    return '/venues/available?' + urlencode(query)
+
+
+def measure(client, with_genre, requests, limit, rng):
+    latencies, errors = [], 0
+    began = time.perf_counter()
+    for _ in range(requests):
+        url = request(rng, with_genre, limit)
+        started = time.perf_counter()
+        res = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        errors += res.status_code != 200
+    return summarize(latencies, errors, time.perf_counter() - began)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--generate', action='store_true', help='load the synthetic catalogue first')
+    parser.add_argument('--venues', type=int, default=100000)
+    parser.add_argument('--artists', type=int, default=10000)
+    parser.add_argument('--shows', type=int, default=500000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=200, help='per scenario')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--max-p95-ms', type=float)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'CACHE_BACKEND': 'null', 'SLOW_QUERY_MS': 0,
+                      'DEBUG': False})
+    with app.app_context():
+        if args.generate:
+            began = time.perf_counter()
+            create_schema(app)
+            load(generate(args.venues, args.artists, args.shows), args.batch_size)
+            print('loaded the catalogue in %.1fs' % (time.perf_counter() - began))
+        client = app.test_client()
+        rng = random.Random(0)
+        measure(client, False, 20, args.limit, rng)  # warm up
+        results = {
+            'city': measure(client, False, args.requests, args.limit, rng),
+            'city+genre': measure(client, True, args.requests, args.limit, rng),
+        }
+    print(format_table(results))
+    slow = [name for name, summary in results.items()
+            if args.max_p95_ms is not None and summary['p95_ms'] > args.max_p95_ms]
+    if slow:
+        print('REGRESSION p95 above %.1fms: %s' % (args.max_p95_ms, ', '.join(slow)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
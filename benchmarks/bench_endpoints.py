@@ -0,0 +1,84 @@
+"""Per-endpoint micro-benchmarks for pytest-benchmark, outside the regular test run.
+
+    pip install pytest-benchmark
+    pytest benchmarks/bench_endpoints.py --benchmark-autosave
+    pytest benchmarks/bench_endpoints.py --benchmark-compare --benchmark-compare-fail=median:15%
+
+Requests go through Flask's test client, so the numbers cover routing,
+queries and serialization but not the network. The catalogue is generated
+once per session into a temporary SQLite file, or into BENCH_DATABASE_URL
+(which must point at an empty database) when it is set.
+"""
+import os
+import random
+import sys
+from datetime import timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip('pytest_benchmark')
+
+from app import create_app  # noqa: E402
+from datagen import create_schema, generate, load  # noqa: E402
+from load import BOOKING_START  # noqa: E402
+from model import db  # noqa: E402
+
+
+SIZES = {'venues': 100, 'artists': 500, 'shows': 5000}
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    url = os.environ.get('BENCH_DATABASE_URL') or 'sqlite:///%s' % tmp_path_factory.mktemp('bench').joinpath('bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'CACHE_BACKEND': 'null', 'SLOW_QUERY_MS': 0, 'DEBUG': False})
+    with app.app_context():
+        create_schema(app)
+        load(generate(SIZES['venues'], SIZES['artists'], SIZES['shows'], seed=0))
+        db.session.remove()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def ok(client, url, status=200):
+    res = client.get(url)
+    assert res.status_code == status
+    return res
+
+
+@pytest.mark.parametrize('url', ['/venues', '/artists?genre=Jazz', '/shows', '/venues/by-region'])
+def test_listing(benchmark, client, url):
+    benchmark(ok, client, url)
+
+
+@pytest.mark.parametrize('url', ['/venues/1', '/artists/1', '/shows/1'])
+def test_detail(benchmark, client, url):
+    # the lowest ids are the busiest venues and artists
+    benchmark(ok, client, url)
+
+
+@pytest.mark.parametrize('url', ['/search?type=venues&q=blue', '/search?type=artists&q=jazz'])
+def test_search(benchmark, client, url):
+    benchmark(ok, client, url)
+
+
+def test_booking(benchmark, client):
+    slots = iter(range(10 ** 6))
+    rng = random.Random(0)
+
+    def book():
+        body = {
+            'venue_id': rng.randint(1, SIZES['venues']),
+            'artist_ids': [rng.randint(1, SIZES['artists'])],
+            'time': (BOOKING_START + timedelta(hours=3 * next(slots))).isoformat(),
+            'duration': 120,
+        }
+        assert client.post('/shows', json=body).status_code == 201
+
+    benchmark(book)
@@ -0,0 +1,113 @@
+"""Book overlapping slots from many threads and check no venue is double-booked.
+
+Run it against Postgres (SQLite serializes writers and shows nothing useful)::
+
+    DATABASE_URL=postgresql://localhost/fyyur python benchmarks/booking_stress.py --threads 16
+
+Each run creates its own venues, so an existing database is left intact apart
+from the shows booked at them. ``--skip-lock`` leaves only the exclusion
+constraint to catch double bookings.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import booking  # noqa: E402
+from app import create_app  # noqa: E402
+from booking import BookingConflict, book  # noqa: E402
+from model import db, Venue, Show  # noqa: E402
+from report import percentile  # noqa: E402
+
+
+def overlaps(venue_ids):
+    shows = Show.query.filter(Show.venue_id.in_(venue_ids)).order_by(Show.venue_id, Show.time).all()
+    clashes = 0
+    for previous, show in zip(shows, shows[1:]):
+        if previous.venue_id == show.venue_id and \
+                previous.time + timedelta(minutes=previous.duration) > show.time:
+            clashes += 1
+    return clashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--attempts', type=int, default=2000, help='booking attempts in total')
+    parser.add_argument('--venues', type=int, default=4)
+    parser.add_argument('--slots', type=int, default=200, help='half-hour start slots per venue')
+    parser.add_argument('--skip-lock', action='store_true', help='do not take the advisory lock')
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database_url,
+        'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': args.threads, 'max_overflow': 0},
+        'CACHE_BACKEND': 'null',
+    })
+    if args.skip_lock:
+        booking.lock_venue = lambda venue_id: None
+    with app.app_context():
+        db.create_all()
+        venues = [Venue('Stress %d' % i, 'Nowhere', 'NA', None, None, None, None, None, None, None, None)
+                  for i in range(args.venues)]
+        db.session.add_all(venues)
+        db.session.commit()
+        venue_ids = [venue.id for venue in venues]
+    start = datetime(2100, 1, 1)
+    remaining = iter(range(args.attempts))
+    lock = threading.Lock()
+    outcomes = {'booked': 0, 'conflict': 0, 'error': 0}
+    latencies = []
+
+    def worker():
+        with app.app_context():
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                slot = start + timedelta(minutes=30 * random.randrange(args.slots))
+                began = time.perf_counter()
+                try:
+                    book(random.choice(venue_ids), [], slot, random.choice((30, 60, 90)))
+                    outcome = 'booked'
+                except BookingConflict:
+                    outcome = 'conflict'
+                except Exception as e:
+                    print('error: %r' % e, file=sys.stderr)
+                    outcome = 'error'
+                elapsed = time.perf_counter() - began
+                with lock:
+                    outcomes[outcome] += 1
+                    latencies.append(elapsed)
+                db.session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    with app.app_context():
+        clashes = overlaps(venue_ids)
+    print('threads=%d attempts=%d booked=%d conflicts=%d errors=%d'
+          % (args.threads, args.attempts, outcomes['booked'], outcomes['conflict'], outcomes['error']))
+    print('elapsed=%.2fs bookings/s=%.0f attempts/s=%.0f p50=%.1fms p95=%.1fms p99=%.1fms'
+          % (elapsed, outcomes['booked'] / elapsed, args.attempts / elapsed,
+             percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+             percentile(latencies, 0.99) * 1000))
+    print('overlapping shows: %d' % clashes)
+    return 1 if clashes or outcomes['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
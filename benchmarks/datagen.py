@@ -0,0 +1,165 @@
+"""Fill a database with a reproducible synthetic catalogue of venues, artists and shows.
+
+    python benchmarks/datagen.py --database-url sqlite:////tmp/bench.db --venues 200 --artists 1000 --shows 20000
+
+Point it at an empty database. The same ``--seed`` and sizes always produce
+the same rows and ids. Artist popularity follows a Zipf-like curve, so a few
+artists play many shows, and most shows have one or two artists. Shows at a
+venue never overlap. Rows go in through ``importer.run_import``, which also
+refreshes the show counters.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_migrate import Migrate, upgrade  # noqa: E402
+
+from app import create_app  # noqa: E402
+from importer import run_import  # noqa: E402
+from model import db  # noqa: E402
+
+
+CITIES = (
+    ('San Francisco', 'CA'), ('Los Angeles', 'CA'), ('New York', 'NY'), ('Brooklyn', 'NY'),
+    ('Chicago', 'IL'), ('Austin', 'TX'), ('Houston', 'TX'), ('Seattle', 'WA'),
+    ('Portland', 'OR'), ('Nashville', 'TN'), ('New Orleans', 'LA'), ('Denver', 'CO'),
+)
+# city centres; generated venues are scattered around them
+CENTRES = {
+    'San Francisco': (37.7749, -122.4194), 'Los Angeles': (34.0522, -118.2437), 'New York': (40.7128, -74.0060),
+    'Brooklyn': (40.6782, -73.9442), 'Chicago': (41.8781, -87.6298), 'Austin': (30.2672, -97.7431),
+    'Houston': (29.7604, -95.3698), 'Seattle': (47.6062, -122.3321), 'Portland': (45.5152, -122.6784),
+    'Nashville': (36.1627, -86.7816), 'New Orleans': (29.9511, -90.0715), 'Denver': (39.7392, -104.9903),
+}
+SCATTER = 0.15  # degrees, roughly 15 km
+GENRES = ('Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk', 'Funk', 'Hip-Hop',
+          'Heavy Metal', 'Instrumental', 'Jazz', 'Musical Theatre', 'Pop', 'Punk', 'R&B', 'Reggae',
+          'Rock n Roll', 'Soul', 'Other')
+ADJECTIVES = ('Blue', 'Golden', 'Electric', 'Velvet', 'Silent', 'Wild', 'Crimson', 'Hollow', 'Lucky',
+              'Midnight', 'Neon', 'Rusty', 'Silver', 'Sunny', 'Wandering', 'Young')
+NOUNS = ('Hop', 'Room', 'Lounge', 'Garden', 'Cellar', 'Hall', 'Tavern', 'Owls', 'Petals', 'Wolves',
+         'Strings', 'Drums', 'Kings', 'Echoes', 'Riders', 'Sparrows')
+# artists on a show: mostly one or two
+LINEUP_SIZES, LINEUP_WEIGHTS = (1, 2, 3, 4), (55, 30, 10, 5)
+DURATIONS = (60, 90, 120, 180)
+START = datetime(2024, 1, 1)
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+def _name(rng, index):
+    return '%s %s %d' % (rng.choice(ADJECTIVES), rng.choice(NOUNS), index)
+
+
+def _profile(rng, index, kind):
+    city, state = rng.choice(CITIES)
+    record = {
+        'id': index,
+        'name': _name(rng, index),
+        'city': city,
+        'state': state,
+        'phone': '%03d-%03d-%04d' % (rng.randrange(200, 999), rng.randrange(1000), rng.randrange(10000)),
+        'image_link': 'https://images.example.com/%s/%d.jpg' % (kind, index),
+        'facebook_link': 'https://www.facebook.com/%s%d' % (kind, index),
+        'website_link': 'https://%s%d.example.com' % (kind, index),
+        'seek_des': None,
+        'genres': rng.sample(GENRES, rng.choice((1, 1, 2, 2, 3))),
+    }
+    seeking = rng.random() < 0.3
+    if seeking:
+        record['seek_des'] = 'Looking for %s acts' % record['genres'][0].lower()
+    if kind == 'venue':
+        record['address'] = '%d %s Street' % (rng.randrange(1, 2000), rng.choice(NOUNS))
+        record['look_talent'] = 'y' if seeking else 'n'
+    else:
+        record['seeking_venue'] = 'y' if seeking else 'n'
+    return record
+
+
+def generate(venues, artists, shows, seed=0, start=START):
+    """Return ``{'venues': [...], 'artists': [...], 'shows': [...]}`` import records.
+
+    Ids run from 1 in each table. Venues and artists are chosen with weights
+    that fall off with their id, and each venue books its shows one after the
+    other with gaps of a few hours to a few days from ``start``. Venues get
+    coordinates scattered around their city's centre.
+    """
+    rng = random.Random(seed)
+    data = {
+        'venues': [_profile(rng, id_, 'venue') for id_ in range(1, venues + 1)],
+        'artists': [_profile(rng, id_, 'artist') for id_ in range(1, artists + 1)],
+        'shows': [],
+    }
+    # a separate stream, so adding coordinates left the other columns unchanged
+    scatter = random.Random(-1 - seed)
+    for venue in data['venues']:
+        lat, lng = CENTRES[venue['city']]
+        venue['latitude'] = round(scatter.gauss(lat, SCATTER), 6)
+        venue['longitude'] = round(scatter.gauss(lng, SCATTER), 6)
+    if not shows:
+        return data
+    venue_ids, artist_ids = list(range(1, venues + 1)), list(range(1, artists + 1))
+    venue_weights = [1.0 / id_ ** 0.8 for id_ in venue_ids]
+    artist_weights = [1.0 / id_ ** 1.1 for id_ in artist_ids]
+    free_at = {id_: start + timedelta(hours=rng.randrange(18, 23)) for id_ in venue_ids}
+    for id_, venue_id in enumerate(rng.choices(venue_ids, venue_weights, k=shows), 1):
+        duration = rng.choice(DURATIONS)
+        time_ = free_at[venue_id]
+        free_at[venue_id] = time_ + timedelta(minutes=duration + rng.randrange(30, 3 * 24 * 60, 30))
+        lineup = set(rng.choices(artist_ids, artist_weights, k=rng.choices(LINEUP_SIZES, LINEUP_WEIGHTS)[0]))
+        data['shows'].append({
+            'id': id_,
+            'venue_id': venue_id,
+            'time': time_.isoformat(),
+            'duration': duration,
+            'artist_ids': sorted(lineup),
+        })
+    return data
+
+
+def create_schema(app):
+    """Create the tables: by migrating on Postgres, so the shows are partitioned
+    as in production, and with create_all elsewhere."""
+    if db.engine.dialect.name == 'postgresql':
+        Migrate(app, db, directory=MIGRATIONS)
+        upgrade(directory=MIGRATIONS)
+    else:
+        db.create_all()
+
+
+def load(data, batch_size=1000):
+    """Import generated records in the current app context; return ``{kind: ImportStats}``."""
+    stats = {}
+    for kind in ('venues', 'artists', 'shows'):
+        stats[kind] = run_import(kind, enumerate(data[kind], 1), batch_size, max_errors=0)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--venues', type=int, default=200)
+    parser.add_argument('--artists', type=int, default=1000)
+    parser.add_argument('--shows', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'CACHE_BACKEND': 'null', 'DEBUG': False})
+    began = time.perf_counter()
+    data = generate(args.venues, args.artists, args.shows, args.seed)
+    with app.app_context():
+        create_schema(app)
+        for kind, stats in load(data, args.batch_size).items():
+            print('%s: %d imported in %.2fs (%.0f rows/s)' % (kind, stats.imported, stats.elapsed, stats.rate))
+    print('generated and loaded in %.2fs' % (time.perf_counter() - began))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Drive listing, detail, search and booking requests from many threads and report latency.
+
+Against a throwaway SQLite file, generating the catalogue first::
+
+    python benchmarks/load.py --database-url sqlite:////tmp/bench.db --generate --threads 8 --duration 30
+
+Against a running server whose database was filled by datagen.py with the
+same sizes and seed::
+
+    python benchmarks/load.py --url http://localhost:8080 --threads 32 --duration 60
+
+Without ``--url`` the app is served in-process by werkzeug's threaded server,
+with the response cache off unless ``--cache-backend`` says otherwise. Each
+scenario reports requests, errors, req/s and p50/p95/p99. ``--save-baseline``
+writes those numbers to a JSON file; ``--baseline`` compares a run against it
+and exits with status 1 on a regression beyond ``--tolerance`` or on failed
+requests.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+from app import create_app  # noqa: E402
+from datagen import GENRES, create_schema, generate, load  # noqa: E402
+from report import compare, format_table, read_baseline, summarize, write_baseline  # noqa: E402
+
+
+BOOKING_START = datetime(2100, 1, 1)
+BOOKING_SLOTS = 2000  # half-hour start slots per venue, so some bookings collide
+
+
+def listing(rng, sizes):
+    path = rng.choice(('/venues', '/artists', '/shows'))
+    if path != '/shows' and rng.random() < 0.3:
+        return 'GET', '%s?genre=%s' % (path, quote(rng.choice(GENRES))), None
+    return 'GET', path, None
+
+
+def detail(rng, sizes):
+    kind = rng.choice(('venues', 'artists', 'shows'))
+    return 'GET', '/%s/%d' % (kind, rng.randint(1, sizes[kind])), None
+
+
+def search(rng, sizes):
+    term = rng.choice(GENRES + ('blue', 'gold', 'hall', 'wolves', 'san', 'new'))
+    return 'GET', '/search?type=%s&q=%s' % (rng.choice(('venues', 'artists')), quote(term[:4])), None
+
+
+def booking(rng, sizes):
+    body = {
+        'venue_id': rng.randint(1, sizes['venues']),
+        'artist_ids': [rng.randint(1, sizes['artists'])],
+        'time': (BOOKING_START + timedelta(minutes=30 * rng.randrange(BOOKING_SLOTS))).isoformat(),
+        'duration': rng.choice((60, 90, 120)),
+    }
+    return 'POST', '/shows', json.dumps(body)
+
+
+SCENARIOS = {'listing': listing, 'detail': detail, 'search': search, 'booking': booking}
+# statuses that count as success; a booking that hits a taken slot is a normal outcome
+EXPECTED = {'booking': (201, 409)}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError('unknown scenario %r' % name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run(url, mix, sizes, threads, duration, warmup=0.0, seed=0):
+    """Send requests for ``warmup + duration`` seconds; summarize those after the warmup."""
+    target = urlsplit(url)
+    names, weights = list(mix), [mix[name] for name in mix]
+    began = time.perf_counter()
+    measured_from, deadline = began + warmup, began + warmup + duration
+    samples = []
+
+    def worker(index):
+        rng = random.Random('%s-%d' % (seed, index))
+        connection = http.client.HTTPConnection(target.hostname, target.port, timeout=30)
+        latencies = {name: [] for name in names}
+        errors = dict.fromkeys(names, 0)
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            name = rng.choices(names, weights)[0]
+            method, path, body = SCENARIOS[name](rng, sizes)
+            headers = {'Content-Type': 'application/json'} if body else {}
+            started = time.perf_counter()
+            try:
+                connection.request(method, target.path.rstrip('/') + path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status in EXPECTED.get(name, (200,))
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                ok = False
+            if started < measured_from:
+                continue
+            latencies[name].append(time.perf_counter() - started)
+            if not ok:
+                errors[name] += 1
+        connection.close()
+        samples.append((latencies, errors))
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - measured_from
+
+    results = {}
+    for name in names:
+        latencies = [value for sample in samples for value in sample[0][name]]
+        errors = sum(sample[1][name] for sample in samples)
+        results[name] = summarize(latencies, errors, elapsed)
+    results['total'] = summarize([value for sample in samples for values in sample[0].values() for value in values],
+                                 sum(sum(sample[1].values()) for sample in samples), elapsed)
+    return results
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='server to load; by default the app is served in-process')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--cache-backend', default='null', help='CACHE_BACKEND of the in-process app')
+    parser.add_argument('--generate', action='store_true', help='load the synthetic catalogue first')
+    parser.add_argument('--venues', type=int, default=200)
+    parser.add_argument('--artists', type=int, default=1000)
+    parser.add_argument('--shows', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds before measuring starts')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('listing=4,detail=4,search=2,booking=1'),
+                        help='scenario weights, e.g. listing=4,detail=4,search=2,booking=1')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', help='write this run\'s results to a JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown as a fraction of the baseline (default 0.2)')
+    parser.add_argument('--max-error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    sizes = {'venues': args.venues, 'artists': args.artists, 'shows': args.shows}
+
+    server = None
+    url = args.url
+    if url is None:
+        if not args.database_url:
+            parser.error('pass --url, or --database-url to serve the app in-process')
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': args.database_url,
+            'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': args.threads, 'max_overflow': 0},
+            'CACHE_BACKEND': args.cache_backend,
+            'DEBUG': False,
+        })
+        with app.app_context():
+            create_schema(app)
+            if args.generate:
+                load(generate(args.venues, args.artists, args.shows, args.seed))
+        server = serve(app)
+        url = 'http://127.0.0.1:%d' % server.server_port
+    elif args.generate:
+        parser.error('--generate needs the in-process server; run datagen.py against the remote database')
+
+    try:
+        results = run(url, args.mix, sizes, args.threads, args.duration, args.warmup, args.seed)
+    finally:
+        if server is not None:
+            server.shutdown()
+    print('threads=%d duration=%.0fs' % (args.threads, args.duration))
+    print(format_table(results))
+    if args.save_baseline:
+        write_baseline(args.save_baseline, results)
+    baseline = read_baseline(args.baseline) if args.baseline else {}
+    failures = compare(results, baseline, args.tolerance, args.max_error_rate)
+    for failure in failures:
+        print('REGRESSION ' + failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""Time GET /venues/near against a large synthetic set of geocoded venues.
+
+    python benchmarks/near.py --database-url postgresql://localhost/fyyur --generate --venues 1000000
+
+With ``--generate`` the (empty) database is filled with venues scattered
+around the datagen cities, and every ``--active``-th venue is marked as
+having upcoming shows, which is all the endpoint filters on. Queries are
+centred at random points near those cities with radii from ``--radii``;
+p50/p95/p99 per radius are printed, and ``--max-p95-ms`` fails the run
+when any radius is slower than that.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+
+from app import create_app  # noqa: E402
+from datagen import CENTRES, create_schema, generate, load  # noqa: E402
+from model import db  # noqa: E402
+from report import format_table, summarize  # noqa: E402
+
+
+def populate(venues, active, batch_size):
+    began = time.perf_counter()
+    data = generate(venues, 0, 0)
+    load(data, batch_size)
+    db.session.execute(text('UPDATE venue SET upcoming_show_count = 1 WHERE id %% %d = 0' % active))
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('ANALYZE venue'))
+        db.session.commit()
+    print('loaded %d venues in %.1fs' % (venues, time.perf_counter() - began))
+
+
+def measure(client, radius, requests, limit, rng):
+    latencies, errors = [], 0
+    centres = list(CENTRES.values())
+    began = time.perf_counter()
+    for _ in range(requests):
+        lat, lng = rng.choice(centres)
+        url = '/venues/near?lat=%f&lng=%f&radius_km=%s&limit=%d' % (
+            rng.gauss(lat, 0.1), rng.gauss(lng, 0.1), radius, limit)
+        started = time.perf_counter()
+        res = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        errors += res.status_code != 200
+    return summarize(latencies, errors, time.perf_counter() - began)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--generate', action='store_true', help='load the venues first')
+    parser.add_argument('--venues', type=int, default=1000000)
+    parser.add_argument('--active', type=int, default=3, help='every Nth venue has upcoming shows')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--radii', type=lambda value: [float(r) for r in value.split(',')], default=[5, 25, 100])
+    parser.add_argument('--requests', type=int, default=200, help='per radius')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--max-p95-ms', type=float)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'CACHE_BACKEND': 'null', 'SLOW_QUERY_MS': 0,
+                      'DEBUG': False})
+    with app.app_context():
+        if args.generate:
+            create_schema(app)
+            populate(args.venues, args.active, args.batch_size)
+        client = app.test_client()
+        rng = random.Random(0)
+        measure(client, args.radii[0], 20, args.limit, rng)  # warm up
+        results = {'near %gkm' % radius: measure(client, radius, args.requests, args.limit, rng)
+                   for radius in args.radii}
+    print(format_table(results))
+    slow = [name for name, summary in results.items()
+            if args.max_p95_ms is not None and summary['p95_ms'] > args.max_p95_ms]
+    if slow:
+        print('REGRESSION p95 above %.1fms: %s' % (args.max_p95_ms, ', '.join(slow)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
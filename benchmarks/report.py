@@ -0,0 +1,65 @@
+"""Latency summaries and regression checks shared by the benchmark scripts."""
+import json
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def summarize(latencies, errors, elapsed):
+    """Request count, error count, throughput and p50/p95/p99 in milliseconds."""
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def format_table(results):
+    lines = ['%-10s %8s %7s %9s %9s %9s %9s' % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for name, summary in sorted(results.items()):
+        lines.append('%-10s %8d %7d %9.1f %9.1f %9.1f %9.1f' % (
+            name, summary['requests'], summary['errors'], summary['rps'],
+            summary['p50_ms'], summary['p95_ms'], summary['p99_ms']))
+    return '\n'.join(lines)
+
+
+def compare(results, baseline, tolerance=0.2, max_error_rate=0.0):
+    """Regressions of ``results`` against a saved ``baseline``, as messages.
+
+    A percentile more than ``tolerance`` (a fraction) above the baseline, a
+    throughput more than ``tolerance`` below it, or an error rate above
+    ``max_error_rate`` is a regression. Scenarios missing from the baseline
+    are only checked for errors.
+    """
+    failures = []
+    for name, summary in sorted(results.items()):
+        if summary['requests'] and summary['errors'] / float(summary['requests']) > max_error_rate:
+            failures.append('%s: %d of %d requests failed' % (name, summary['errors'], summary['requests']))
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if key in expected and summary[key] > expected[key] * (1 + tolerance):
+                failures.append('%s: %s %.1f exceeds baseline %.1f by more than %d%%'
+                                % (name, key, summary[key], expected[key], tolerance * 100))
+        if 'rps' in expected and summary['rps'] < expected['rps'] * (1 - tolerance):
+            failures.append('%s: %.1f req/s is more than %d%% below baseline %.1f'
+                            % (name, summary['rps'], tolerance * 100, expected['rps']))
+    return failures
+
+
+def read_baseline(path):
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def write_baseline(path, results):
+    with open(path, 'w') as stream:
+        json.dump(results, stream, indent=2, sort_keys=True)
+        stream.write('\n')
@@ -0,0 +1,101 @@
+"""Compare ORM-object serialization with serializers.py on the listing pages.
+
+    python benchmarks/serialization.py --venues 2000 --artists 10000 --shows 50000
+    python benchmarks/serialization.py --database-url postgresql://localhost/fyyur --generate
+
+Each kind is walked page by page with keyset_page, either the old way (ORM
+objects with their links eager-loaded, ``format()``, ``json.dumps``) or through
+its Serializer and ``serializers.dumps``. Objects per second and the peak
+memory traced while building one page are printed per kind and mode. Without
+``--database-url`` the catalogue goes into a temporary SQLite file.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy.orm import selectinload
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from datagen import create_schema, generate, load  # noqa: E402
+from model import db, Venue, Artist, Show  # noqa: E402
+from pagination import keyset_page  # noqa: E402
+from serializers import ARTISTS, SHOWS, VENUES, dumps  # noqa: E402
+
+
+KINDS = {
+    'venues': (Venue, lambda: selectinload(Venue.genre_rows), VENUES, lambda: [Venue.id]),
+    'artists': (Artist, lambda: selectinload(Artist.genre_rows), ARTISTS, lambda: [Artist.id]),
+    'shows': (Show, lambda: selectinload(Show.artist), SHOWS, lambda: [Show.time, Show.id]),
+}
+
+
+def orm_page(kind, cursor, limit):
+    model, links, _, columns = KINDS[kind]
+    items, cursor = keyset_page(model.query.options(links()), columns(), cursor, limit)
+    return len(items), json.dumps([item.format() for item in items]).encode(), cursor
+
+
+def serializer_page(kind, cursor, limit):
+    _, _, serializer, columns = KINDS[kind]
+    rows, cursor = keyset_page(serializer.query(), columns(), cursor, limit)
+    items = serializer.render(rows)
+    return len(items), dumps(items), cursor
+
+
+def walk(page, kind, limit, trace):
+    """``(objects, seconds, peak KiB)`` for rendering every page of ``kind``."""
+    objects, elapsed, peak, cursor = 0, 0.0, 0, None
+    while True:
+        # a fresh session per page, as a request would have
+        db.session.remove()
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        count, _, cursor = page(kind, cursor, limit)
+        elapsed += time.perf_counter() - started
+        if trace:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        objects += count
+        if cursor is None:
+            return objects, elapsed, peak / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--generate', action='store_true', help='load the synthetic catalogue first')
+    parser.add_argument('--venues', type=int, default=2000)
+    parser.add_argument('--artists', type=int, default=10000)
+    parser.add_argument('--shows', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    url = args.database_url
+    if not url:
+        url = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'serialization.db')
+        args.generate = True
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'CACHE_BACKEND': 'null', 'SLOW_QUERY_MS': 0,
+                      'DEBUG': False})
+    with app.app_context():
+        if args.generate:
+            create_schema(app)
+            load(generate(args.venues, args.artists, args.shows))
+        print('%-8s %-11s %9s %12s %14s' % ('kind', 'mode', 'objects', 'objects/s', 'peak KiB/page'))
+        for kind in KINDS:
+            for mode, page in (('orm', orm_page), ('serializer', serializer_page)):
+                # timed without tracemalloc, whose hooks slow allocation down
+                objects, elapsed, _ = walk(page, kind, args.page_size, trace=False)
+                _, _, peak = walk(page, kind, args.page_size, trace=True)
+                print('%-8s %-11s %9d %12.0f %14.1f' % (kind, mode, objects, objects / elapsed, peak))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Measure how long a fresh worker takes to import, build and serve the app.
+
+    python benchmarks/startup.py --runs 20
+    python benchmarks/startup.py --database-url postgresql://localhost/fyyur --max-ms 800
+
+Each run starts a new interpreter that imports ``wsgi`` the way gunicorn
+does and reports the time spent importing modules, in create_app, and, when
+a database is given, on the first request and on the first request of a
+worker forked after import (the --preload case). Medians and p95 of those,
+plus resident memory and whether Alembic got imported, are printed.
+``--max-ms`` fails the run when median import + create_app time exceeds it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from report import percentile  # noqa: E402
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# runs in the child interpreter; prints one JSON object
+PROBE = r'''
+import json, os, sys, time
+began = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+import wsgi
+built = time.perf_counter()
+result = {
+    'import_ms': (imported - began) * 1000,
+    'create_app_ms': (built - imported) * 1000,
+    'modules': len(sys.modules),
+    'alembic_loaded': 'alembic' in sys.modules,
+}
+with open('/proc/self/status') as status:
+    result['rss_mib'] = [int(line.split()[1]) / 1024.0 for line in status if line.startswith('VmRSS:')][0]
+if os.environ.get('PROBE_REQUEST'):
+    client = wsgi.app.test_client()
+    started = time.perf_counter()
+    assert client.get('/venues').status_code == 200
+    result['first_request_ms'] = (time.perf_counter() - started) * 1000
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        started = time.perf_counter()
+        ok = client.get('/venues').status_code == 200
+        os.write(write, json.dumps((time.perf_counter() - started) * 1000 if ok else -1).encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    result['forked_first_request_ms'] = json.loads(os.read(read, 64))
+print(json.dumps(result))
+'''
+
+
+def probe(database_url):
+    env = dict(os.environ, FYYUR_ENV='production', SECRET_KEY=os.environ.get('SECRET_KEY', 'startup-benchmark'),
+               CACHE_BACKEND='null')
+    if database_url:
+        env.update(DATABASE_URL=database_url, PROBE_REQUEST='1')
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, check=True,
+                            stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='also time first requests against this database')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, help='fail when median import + create_app exceeds this')
+    args = parser.parse_args()
+
+    runs = [probe(args.database_url) for _ in range(args.runs)]
+    keys = ['import_ms', 'create_app_ms', 'first_request_ms', 'forked_first_request_ms', 'rss_mib']
+    print('%-24s %9s %9s' % ('', 'median', 'p95'))
+    for key in keys:
+        values = [run[key] for run in runs if key in run]
+        if values:
+            print('%-24s %9.1f %9.1f' % (key, statistics.median(values), percentile(values, 0.95)))
+    print('modules loaded: %d, alembic imported: %s' % (runs[0]['modules'], runs[0]['alembic_loaded']))
+    startup = statistics.median(run['import_ms'] + run['create_app_ms'] for run in runs)
+    if args.max_ms is not None and startup > args.max_ms:
+        print('REGRESSION startup %.1fms exceeds %.1fms' % (startup, args.max_ms), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
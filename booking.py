@@ -0,0 +1,225 @@
+import bisect
+import random
+import time
+from datetime import timedelta
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+import series
+from model import db, Venue, Artist, Show, ShowSeries
+
+
+MAX_DURATION = 24 * 60  # minutes; matches ck_shows_duration
+# first key of the two-int pg_advisory_xact_lock; the second is the venue id
+VENUE_LOCK_NAMESPACE = 7301
+RETRY_CODES = ('40001', '40P01')  # serialization_failure, deadlock_detected
+EXCLUSION_VIOLATION = '23P01'
+# how far ahead a new open-ended series is checked for clashes
+CONFLICT_HORIZON = timedelta(days=366)
+
+
+class BookingConflict(Exception):
+    """The requested slot overlaps the listed shows or series at the same venue."""
+
+    def __init__(self, show_ids=(), series_ids=()):
+        super(BookingConflict, self).__init__(list(show_ids), list(series_ids))
+        self.show_ids = list(show_ids)
+        self.series_ids = list(series_ids)
+
+
+def pgcode(error):
+    return getattr(getattr(error, 'orig', None), 'pgcode', None)
+
+
+def lock_venue(venue_id):
+    # serializes bookings per venue until the transaction ends; the exclusion
+    # constraint still catches writers that skip this (bulk imports, psql)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:namespace, :venue_id)'),
+                           {'namespace': VENUE_LOCK_NAMESPACE, 'venue_id': venue_id})
+
+
+def overlapping(venue_id, start, duration, exclude_id=None):
+    """Ids of shows at ``venue_id`` whose interval intersects [start, start + duration)."""
+    end = start + timedelta(minutes=duration)
+    # no show is longer than MAX_DURATION, so earlier starts cannot reach this slot
+    # and the range scan stays on ix_shows_venue_id_time
+    query = db.session.query(Show.id, Show.time, Show.duration) \
+        .filter(Show.venue_id == venue_id,
+                Show.time < end,
+                Show.time > start - timedelta(minutes=MAX_DURATION))
+    if exclude_id is not None:
+        query = query.filter(Show.id != exclude_id)
+    with db.session.no_autoflush:
+        rows = query.all()
+    return [id for id, time, minutes in rows if time + timedelta(minutes=minutes) > start]
+
+
+def overlapping_series(venue_id, start, duration, exclude=None):
+    """Ids of series at ``venue_id`` with an occurrence intersecting [start, start + duration)."""
+    end = start + timedelta(minutes=duration)
+    return sorted({item.id for item, _ in series.slots(start, end, venue_id, exclude)})
+
+
+def ensure_free(show):
+    """Lock the show's venue and raise BookingConflict if its slot is taken."""
+    if not 0 < show.duration <= MAX_DURATION:
+        raise ValueError(show.duration)
+    lock_venue(show.venue_id)
+    conflicts = overlapping(show.venue_id, show.time, show.duration, show.id)
+    # an edited occurrence does not clash with the slot it replaces
+    own = (show.series_id, show.occurrence) if show.series_id is not None else None
+    series_conflicts = overlapping_series(show.venue_id, show.time, show.duration, own)
+    if conflicts or series_conflicts:
+        raise BookingConflict(conflicts, series_conflicts)
+
+
+def run_in_transaction(work, attempts=5, base_delay=0.01):
+    """Call ``work()`` and commit, retrying serialization failures and deadlocks.
+
+    The session is rolled back before each retry and whenever ``work`` or the
+    commit fails. A Postgres exclusion violation surfaces as BookingConflict.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except DBAPIError as e:
+            db.session.rollback()
+            code = pgcode(e)
+            if code == EXCLUSION_VIOLATION:
+                raise BookingConflict()
+            if code not in RETRY_CODES or attempt == attempts:
+                raise
+            time.sleep(base_delay * 2 ** attempt * random.random())
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def book(venue_id, artist_ids, start, duration=120, attempts=5):
+    """Create a show at ``venue_id`` unless the slot overlaps another show there.
+
+    Raises ValueError for an unknown venue or artist and BookingConflict when
+    the slot is taken.
+    """
+    artist_ids = set(artist_ids)
+
+    def work():
+        if Venue.query.get(venue_id) is None:
+            raise ValueError(venue_id)
+        artists = load_artists(artist_ids)
+        show = Show(venue_id, None, start)
+        show.duration = duration
+        ensure_free(show)
+        show.artist = artists
+        db.session.add(show)
+        return show
+
+    return run_in_transaction(work, attempts)
+
+
+def load_artists(artist_ids):
+    artists = Artist.query.filter(Artist.id.in_(artist_ids)).all() if artist_ids else []
+    if len(artists) != len(artist_ids):
+        raise ValueError(artist_ids)
+    return artists
+
+
+def series_conflicts(item):
+    """Shows and series at the new series' venue that any of its occurrences
+    overlaps, over its whole run or the next CONFLICT_HORIZON when open-ended."""
+    start = item.starts_at
+    end = min(item.ends_at or start + CONFLICT_HORIZON, start + CONFLICT_HORIZON)
+    slot = timedelta(minutes=item.duration)
+    taken = [(time, time + timedelta(minutes=minutes), ('show', id)) for id, time, minutes in
+             db.session.query(Show.id, Show.time, Show.duration).filter(
+                 Show.venue_id == item.venue_id, Show.time < end,
+                 Show.time > start - timedelta(minutes=MAX_DURATION))]
+    taken.extend((time, time + timedelta(minutes=other.duration), ('series', other.id))
+                 for other, time in series.slots(start, end, item.venue_id))
+    taken.sort(key=lambda interval: interval[0])
+    starts = [interval[0] for interval in taken]
+    show_ids, series_ids = set(), set()
+    for time in series.occurrences(item, start, end):
+        # taken slots are at most MAX_DURATION long, so only those starting
+        # in (time - MAX_DURATION, time + slot) can overlap this occurrence
+        low = bisect.bisect_right(starts, time - timedelta(minutes=MAX_DURATION))
+        for begins, ends, (kind, id) in taken[low:bisect.bisect_left(starts, time + slot)]:
+            if ends > time:
+                (show_ids if kind == 'show' else series_ids).add(id)
+    return sorted(show_ids), sorted(series_ids)
+
+
+def book_series(venue_id, artist_ids, rule, start, duration=120, attempts=5):
+    """Create a recurring series at ``venue_id`` from RRULE text ``rule``.
+
+    Raises ValueError for an unknown venue or artist or an invalid rule, and
+    BookingConflict when an occurrence overlaps a show or another series.
+    """
+    artist_ids = set(artist_ids)
+    if not 0 < duration <= MAX_DURATION:
+        raise ValueError(duration)
+    text, ends_at = series.normalize(rule, start, duration)
+
+    def work():
+        if Venue.query.get(venue_id) is None:
+            raise ValueError(venue_id)
+        artists = load_artists(artist_ids)
+        item = ShowSeries(venue_id=venue_id, rrule=text, starts_at=start, ends_at=ends_at, duration=duration)
+        lock_venue(venue_id)
+        with db.session.no_autoflush:
+            show_ids, series_ids = series_conflicts(item)
+        if show_ids or series_ids:
+            raise BookingConflict(show_ids, series_ids)
+        item.artists = artists
+        db.session.add(item)
+        return item
+
+    return run_in_transaction(work, attempts)
+
+
+def find_occurrence(series_id, occurrence):
+    """The series and, if it was materialized, the Show for one occurrence.
+
+    Raises LookupError unless the rule generates ``occurrence`` and it has
+    not been cancelled.
+    """
+    item = ShowSeries.query.get(series_id)
+    if item is None:
+        raise LookupError(series_id)
+    show = Show.query.filter_by(series_id=series_id, occurrence=occurrence).one_or_none()
+    if show is None and (not series.is_occurrence(item, occurrence) or series.is_cancelled(series_id, occurrence)):
+        raise LookupError(occurrence)
+    return item, show
+
+
+def materialize(series_id, occurrence):
+    """The Show row for an occurrence, creating it from the series if needed.
+
+    Only occurrences that are edited get a row; it takes over the generated
+    slot, so creating it cannot conflict.
+    """
+    item, show = find_occurrence(series_id, occurrence)
+    if show is None:
+        show = Show(item.venue_id, None, occurrence)
+        show.duration = item.duration
+        show.series_id = item.id
+        show.occurrence = occurrence
+        show.artist = list(item.artists)
+        db.session.add(show)
+    return show
+
+
+def cancel_occurrence(series_id, occurrence, attempts=5):
+    """Cancel one occurrence, dropping its Show row if it had been edited."""
+
+    def work():
+        item, show = find_occurrence(series_id, occurrence)
+        if show is not None:
+            db.session.delete(show)
+        series.cancel(item, occurrence)
+
+    return run_in_transaction(work, attempts)
@@ -0,0 +1,237 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request
+from sqlalchemy import event, inspect, select
+
+from jobs import handler, jobs
+from model import Venue, Artist, Show, artist_shows
+from queries import region_tags
+from routing import RoutingSession
+
+
+class NullBackend(object):
+
+    shared = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags):
+        pass
+
+    def invalidate(self, tags):
+        pass
+
+
+class LRUBackend(object):
+    """In-process LRU with a TTL; each tag remembers the keys stored under it."""
+
+    # only this process can clear it, so a worker process running the
+    # invalidation job would leave it stale
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value, tags = entry
+            if expires < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend(object):
+    """Any client with the redis-py get/setex/sadd/expire/smembers/delete API."""
+
+    shared = True
+
+    def __init__(self, client, ttl=60, prefix='fyyur:cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, tags):
+        self.client.setex(self.prefix + key, self.ttl, value)
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            self.client.sadd(tag_key, self.prefix + key)
+            self.client.expire(tag_key, self.ttl)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = list(self.client.smembers(tag_key))
+            self.client.delete(tag_key, *keys)
+
+
+def make_backend(config):
+    name = config.get('CACHE_BACKEND', 'memory')
+    ttl = config.get('CACHE_TTL', 60)
+    if name == 'memory':
+        return LRUBackend(config.get('CACHE_MAXSIZE', 1024), ttl)
+    if name == 'redis':
+        import redis
+        return RedisBackend(redis.Redis.from_url(config['CACHE_REDIS_URL']), ttl)
+    return NullBackend()
+
+
+class ResponseCache(object):
+    """Cache JSON responses under model-identity keys such as ``venue:5``.
+
+    A cached view names its key, optionally varies it on the query string, and
+    declares the identities it rendered with :meth:`depends_on`. Writes to
+    Venue, Artist and Show invalidate exactly the tags they touch once they
+    commit: a process-local backend right away, in the committing process, and
+    a shared one (Redis) in a job, which may run in any process.
+    """
+
+    def init_app(self, app, backend=None):
+        app.extensions['cache'] = backend or make_backend(app.config)
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def depends_on(self, *tags):
+        if 'cache_tags' in g:
+            g.cache_tags.update(tags)
+
+    def cached(self, key, vary_on_args=False):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                cache_key = key.format(**kwargs)
+                if vary_on_args and request.args:
+                    cache_key += '?' + '&'.join('%s=%s' % item for item in sorted(request.args.items()))
+                if 'etag' in g:
+                    # set by etags.conditional; a body rendered under an older
+                    # ETag (a show has since started, or its invalidation is
+                    # still pending) is never answered with the new one
+                    cache_key += '#' + g.etag
+                hit = self.backend.get(cache_key)
+                if hit is not None:
+                    return current_app.response_class(hit, mimetype='application/json', headers={'X-Cache': 'HIT'})
+                g.cache_tags = {key.format(**kwargs)}
+                response = current_app.make_response(view(**kwargs))
+                if response.status_code == 200:
+                    self.backend.set(cache_key, response.get_data(), g.cache_tags)
+                    response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+
+cache = ResponseCache()
+
+
+def write_tags(session, obj):
+    """Cache tags affected by writing ``obj`` (new, changed or deleted)."""
+    if isinstance(obj, Venue):
+        state = inspect(obj)
+        tags = {'venue:%s' % obj.id, 'venues'}
+        # both the region the venue left and the one it moved to
+        for city in set(state.attrs.city.history.sum()) | {obj.city}:
+            for region_state in set(state.attrs.state.history.sum()) | {obj.state}:
+                tags.update(region_tags(city, region_state))
+        return tags
+    if isinstance(obj, Artist):
+        return {'artist:%s' % obj.id, 'artists'}
+    if isinstance(obj, Show):
+        state = inspect(obj)
+        venue_ids = set(state.attrs.venue_id.history.sum()) | {obj.venue_id}
+        artist_ids = {artist.id for artist in state.attrs.artist.history.sum()}
+        if 'artist' in state.unloaded:
+            # the artists' pages render this show too
+            artist_ids.update(session.connection().execute(
+                select(artist_shows.c.artist_id).where(artist_shows.c.show_id == obj.id)).scalars())
+        # listings carry each venue's and artist's show counters
+        tags = {'show:%s' % obj.id, 'shows', 'venues', 'artists'}
+        tags.update('venue:%s' % venue_id for venue_id in venue_ids if venue_id is not None)
+        tags.update('artist:%s' % artist_id for artist_id in artist_ids)
+        venue_ids.discard(None)
+        if venue_ids:
+            # by-region listings carry the venues' upcoming counts
+            for city, region_state in session.connection().execute(
+                    select(Venue.city, Venue.state).where(Venue.id.in_(venue_ids))):
+                tags.update(region_tags(city, region_state))
+        return tags
+    return set()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _collect_tags(session, flush_context):
+    backend = session.app.extensions.get('cache')
+    if backend is None:
+        return
+    tags = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tags.update(write_tags(session, obj))
+    if not tags:
+        return
+    if backend.shared:
+        jobs.defer(session, 'cache.invalidate', tags=sorted(tags))
+    else:
+        session.info.setdefault('cache_tags', set()).update(tags)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _invalidate(session):
+    tags = session.info.pop('cache_tags', None)
+    backend = session.app.extensions.get('cache')
+    if tags and backend is not None:
+        backend.invalidate(tags)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard(session):
+    session.info.pop('cache_tags', None)
+
+
+@handler('cache.invalidate')
+def invalidate_job(tags):
+    backend = current_app.extensions.get('cache')
+    if backend is not None:
+        backend.invalidate(tags)
@@ -0,0 +1,187 @@
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, event, func, inspect, select
+
+from model import db, Venue, Artist, Show, artist_shows, show_counter_watermark
+from routing import RoutingSession
+
+
+UPCOMING, PAST = 'upcoming_show_count', 'past_show_count'
+# attributes whose change moves a show between counters
+COUNTED = ('time', 'venue_id', 'venue', 'artist')
+# ids per statement when reconciling a given set of rows
+RECONCILE_BATCH = 1000
+
+
+def watermark(connection, lock=None):
+    """Read the roll watermark; ``lock`` is 'share' for writers, 'update' for rolls."""
+    query = select(show_counter_watermark.c.rolled_at).where(show_counter_watermark.c.id == 1)
+    if lock is not None:
+        query = query.with_for_update(read=lock == 'share')
+    return connection.execute(query).scalar()
+
+
+def stored_shows(connection, ids):
+    """``{show id: (venue_id, time, artist ids)}`` as the database has them now."""
+    if not ids:
+        return {}
+    shows = {id: (venue_id, time, []) for id, venue_id, time in connection.execute(
+        select(Show.id, Show.venue_id, Show.time).where(Show.id.in_(ids)))}
+    for artist_id, show_id in connection.execute(
+            select(artist_shows.c.artist_id, artist_shows.c.show_id).where(artist_shows.c.show_id.in_(ids))):
+        shows[show_id][2].append(artist_id)
+    return shows
+
+
+def count(deltas, mark, shows, sign):
+    for venue_id, time, artist_ids in shows:
+        name = UPCOMING if time > mark else PAST
+        deltas[Venue, name][venue_id] += sign
+        for artist_id in artist_ids:
+            deltas[Artist, name][artist_id] += sign
+
+
+def apply_deltas(connection, deltas):
+    for (model, name), changes in deltas.items():
+        rows = [{'row_id': id, 'delta': delta} for id, delta in changes.items() if delta]
+        if not rows:
+            continue
+        table = model.__table__
+        connection.execute(
+            table.update().where(table.c.id == bindparam('row_id'))
+            .values({name: table.c[name] + bindparam('delta')}),
+            rows)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _uncount_old_state(session, flush_context, instances):
+    changed = [obj for obj in session.dirty if isinstance(obj, Show)
+               and any(inspect(obj).attrs[key].history.has_changes() for key in COUNTED)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Show)]
+    new = [obj for obj in session.new if isinstance(obj, Show)]
+    if not (changed or deleted or new):
+        return
+    connection = session.connection()
+    # the share lock keeps a roll from moving the watermark under this transaction
+    mark = watermark(connection, 'share')
+    deltas = defaultdict(Counter)
+    count(deltas, mark, stored_shows(connection, [obj.id for obj in changed + deleted]).values(), -1)
+    session.info['show_counts'] = (mark, deltas, changed + new)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _count_new_state(session, flush_context):
+    pending = session.info.pop('show_counts', None)
+    if pending is None:
+        return
+    mark, deltas, shows = pending
+    connection = session.connection()
+    count(deltas, mark, stored_shows(connection, [obj.id for obj in shows]).values(), 1)
+    apply_deltas(connection, deltas)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard(session):
+    session.info.pop('show_counts', None)
+
+
+def roll(connection, now=None):
+    """Move shows that started since the last roll from upcoming to past.
+
+    Returns the ids of the venues and artists whose counters changed.
+    """
+    now = now or datetime.now()
+    mark = watermark(connection, 'update')
+    if now <= mark:
+        return set(), set()
+    started = (Show.time > mark) & (Show.time <= now)
+    venues = dict(connection.execute(
+        select(Show.venue_id, func.count()).where(started).group_by(Show.venue_id)).all())
+    artists = dict(connection.execute(
+        select(artist_shows.c.artist_id, func.count())
+        .select_from(artist_shows.join(Show, Show.id == artist_shows.c.show_id))
+        .where(started).group_by(artist_shows.c.artist_id)).all())
+    deltas = {
+        (Venue, UPCOMING): {id: -n for id, n in venues.items()},
+        (Venue, PAST): venues,
+        (Artist, UPCOMING): {id: -n for id, n in artists.items()},
+        (Artist, PAST): artists,
+    }
+    apply_deltas(connection, deltas)
+    connection.execute(show_counter_watermark.update().where(show_counter_watermark.c.id == 1)
+                       .values(rolled_at=now))
+    return set(venues), set(artists)
+
+
+def expected_counts(model, mark):
+    """Correlated (upcoming, past) count subqueries for ``model`` rows."""
+    if model is Venue:
+        shows = select(func.count()).where(Show.venue_id == Venue.id)
+    else:
+        shows = select(func.count()).select_from(artist_shows.join(Show, Show.id == artist_shows.c.show_id)) \
+            .where(artist_shows.c.artist_id == Artist.id)
+    return shows.where(Show.time > mark).scalar_subquery(), shows.where(Show.time <= mark).scalar_subquery()
+
+
+def reconcile(connection, venue_ids=None, artist_ids=None):
+    """Recount venues and artists against the watermark; return the ids that had drifted.
+
+    Every row is recounted unless ``venue_ids`` and ``artist_ids`` name the
+    ones to check. Writers wait on the watermark lock for as long as this
+    runs, so callers that know what they changed should pass it.
+    """
+    mark = watermark(connection, 'update')
+    scope = {Venue: venue_ids, Artist: artist_ids}
+    repaired = {}
+    for model in (Venue, Artist):
+        upcoming, past = expected_counts(model, mark)
+        table = model.__table__
+        drifted = (table.c[UPCOMING] != upcoming) | (table.c[PAST] != past)
+        if venue_ids is None and artist_ids is None:
+            ids = connection.execute(select(table.c.id).where(drifted)).scalars().all()
+        else:
+            wanted = sorted(scope[model] or ())
+            ids = []
+            for start in range(0, len(wanted), RECONCILE_BATCH):
+                ids.extend(connection.execute(select(table.c.id).where(
+                    table.c.id.in_(wanted[start:start + RECONCILE_BATCH]) & drifted)).scalars())
+        for start in range(0, len(ids), RECONCILE_BATCH):
+            connection.execute(table.update().where(table.c.id.in_(ids[start:start + RECONCILE_BATCH]))
+                               .values({UPCOMING: upcoming, PAST: past}))
+        repaired[model] = ids
+    return set(repaired[Venue]), set(repaired[Artist])
+
+
+def invalidate(venue_ids, artist_ids):
+    backend = current_app.extensions.get('cache')
+    if backend is None or not (venue_ids or artist_ids):
+        return
+    tags = {'venues', 'artists', 'regions'}
+    tags.update('venue:%d' % id for id in venue_ids)
+    tags.update('artist:%d' % id for id in artist_ids)
+    backend.invalidate(tags)
+
+
+counters_cli = AppGroup('counters', help='Maintain the per-venue and per-artist show counters.')
+
+
+@counters_cli.command('roll')
+def roll_command():
+    """Count shows that have started since the last roll as past (run it from cron)."""
+    with db.engine.begin() as connection:
+        venue_ids, artist_ids = roll(connection)
+    invalidate(venue_ids, artist_ids)
+    click.echo('rolled counters of %d venues and %d artists' % (len(venue_ids), len(artist_ids)))
+
+
+@counters_cli.command('reconcile')
+def reconcile_command():
+    """Recompute every counter from the shows table and report the drift repaired."""
+    with db.engine.begin() as connection:
+        venue_ids, artist_ids = reconcile(connection)
+    invalidate(venue_ids, artist_ids)
+    click.echo('repaired %d venues and %d artists' % (len(venue_ids), len(artist_ids)))
@@ -0,0 +1,260 @@
+import threading
+import time
+
+import click
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exc, orm, text
+from sqlalchemy.pool import NullPool, QueuePool
+
+from routing import RoutingSession
+
+
+# create_engine arguments only QueuePool understands
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class PoolMetrics(object):
+    """Checkout counters for one pool; wait time is how long _do_get blocked."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_total,
+                'wait_seconds_max': self.wait_max,
+            }
+
+
+class PoolExhausted(exc.TimeoutError):
+    pass
+
+
+class TimedPoolMixin(object):
+
+    def _timed_get(self, get):
+        if not hasattr(self, 'metrics'):
+            self.metrics = PoolMetrics()
+        start = time.perf_counter()
+        try:
+            record = get()
+        except exc.TimeoutError:
+            self.metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        return record
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+
+    def _do_get(self):
+        return self._timed_get(super(TimedQueuePool, self)._do_get)
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.metrics = getattr(self, 'metrics', PoolMetrics())
+        return pool
+
+    def stats(self):
+        return {
+            'pool': 'queue',
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+        }
+
+
+class Psycopg2Pool(TimedPoolMixin, NullPool):
+    """Hand out connections from a psycopg2_pool.ThreadSafeConnectionPool.
+
+    SQLAlchemy keeps no connections of its own: checkout borrows one from the
+    psycopg2 pool and closing it gives it back instead of disconnecting.
+    psycopg2_pool only counts freshly opened connections against maxconn, so
+    the limit (and the wait for a free slot) is enforced here.
+    """
+
+    def __init__(self, source, timeout=30, **kw):
+        self._source = source
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(source.maxconn)
+        self._checked_out = 0
+        self._count_lock = threading.Lock()
+        super(Psycopg2Pool, self).__init__(self._getconn, **kw)
+
+    def _getconn(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolExhausted('psycopg2 pool limit of %d reached, connection timed out, '
+                                'timeout %0.2f' % (self._source.maxconn, self._timeout))
+        try:
+            connection = self._source.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._count_lock:
+            self._checked_out += 1
+        return connection
+
+    def _do_get(self):
+        return self._timed_get(super(Psycopg2Pool, self)._do_get)
+
+    def _close_connection(self, connection, terminate=False):
+        if terminate:
+            connection.close()
+        self._source.putconn(connection)
+        with self._count_lock:
+            self._checked_out -= 1
+        self._slots.release()
+
+    def recreate(self):
+        pool = self.__class__(
+            self._source,
+            timeout=self._timeout,
+            recycle=self._recycle,
+            echo=self.echo,
+            logging_name=self._orig_logging_name,
+            reset_on_return=self._reset_on_return,
+            pre_ping=self._pre_ping,
+            _dispatch=self.dispatch,
+            dialect=self._dialect,
+        )
+        pool.metrics = getattr(self, 'metrics', PoolMetrics())
+        return pool
+
+    def dispose(self):
+        self._source.clear()
+
+    def stats(self):
+        return {
+            'pool': 'psycopg2',
+            'size': self._source.minconn,
+            'checked_out': self._checked_out,
+            'overflow': max(self._checked_out - self._source.minconn, 0),
+        }
+
+
+def psycopg2_pool_for(sa_url, options):
+    import psycopg2_pool
+    connect_args = dict(options.pop('connect_args', {}))
+    connect_args.update(sa_url.translate_connect_args(username='user', database='dbname'))
+    connect_args.update(sa_url.query)
+    size = options.pop('pool_size', 5)
+    overflow = options.pop('max_overflow', 10)
+    source = psycopg2_pool.ThreadSafeConnectionPool(
+        minconn=size, maxconn=size + max(overflow, 0), **connect_args)
+    return Psycopg2Pool(
+        source,
+        timeout=options.pop('pool_timeout', 30),
+        recycle=options.pop('pool_recycle', -1),
+        pre_ping=options.pop('pool_pre_ping', False),
+    )
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if not hasattr(pool, 'stats'):
+        return {'pool': pool.status()}
+    stats = pool.stats()
+    stats.update(getattr(pool, 'metrics', PoolMetrics()).as_dict())
+    return stats
+
+
+def is_partitioned(connection, table):
+    """Whether ``table`` is a partitioned table (Postgres only, see partitions.py)."""
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(text('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)'),
+                              {'table': table}).first() is not None
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy with pool settings taken from SQLALCHEMY_ENGINE_OPTIONS.
+
+    Two extra keys are understood there: ``pool`` ('queue' or 'psycopg2') and
+    ``statement_timeout`` in milliseconds (Postgres only). Sessions are
+    RoutingSessions, so read-only requests can be served by a replica.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername == 'sqlite' and sa_url.database not in (None, '', ':memory:'):
+            # Flask-SQLAlchemy 2.4 rewrites the path on the URL in place, which
+            # SQLAlchemy 1.4 URLs do not allow; paths are used as given instead
+            options['poolclass'] = NullPool
+            return
+        super(Database, self).apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        options = dict(engine_opts)
+        pool = options.pop('pool', 'queue')
+        statement_timeout = options.pop('statement_timeout', None)
+        if sa_url.get_backend_name() == 'postgresql' and statement_timeout:
+            connect_args = dict(options.get('connect_args', {}))
+            connect_args['options'] = '-c statement_timeout=%d' % statement_timeout
+            options['connect_args'] = connect_args
+        if 'poolclass' in options:
+            # the driver hacks picked a StaticPool/NullPool (SQLite)
+            for key in QUEUE_POOL_OPTIONS:
+                options.pop(key, None)
+        elif pool == 'psycopg2' and sa_url.get_backend_name() == 'postgresql':
+            options['pool'] = psycopg2_pool_for(sa_url, options)
+        else:
+            options['poolclass'] = TimedQueuePool
+        return super(Database, self).create_engine(sa_url, options)
+
+
+def dispose_engines(app):
+    """Forget the engines a forked process inherited from its parent.
+
+    The parent's pooled connections are dereferenced without being closed,
+    since closing them from the child would end the parent's sessions too;
+    the child creates fresh engines and pools on first use.
+    """
+    state = app.extensions['sqlalchemy']
+    for connector in list(state.connectors.values()):
+        if connector._engine is not None:
+            connector._engine.dispose(close=False)
+    state.connectors.clear()
+
+
+class MigrateGroup(click.Group):
+    """``flask db``, importing Flask-Migrate and Alembic only when it is used.
+
+    The first lookup registers Flask-Migrate on the app, which replaces this
+    group with Flask-Migrate's own.
+    """
+
+    def __init__(self, app, db):
+        super(MigrateGroup, self).__init__('db', help='Perform database migrations.')
+        self.app = app
+        self.db = db
+
+    def commands_group(self):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as commands
+        if 'migrate' not in self.app.extensions:
+            Migrate(self.app, self.db, directory=self.app.config['MIGRATIONS_DIRECTORY'])
+        return commands
+
+    def list_commands(self, ctx):
+        return self.commands_group().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self.commands_group().get_command(ctx, name)
@@ -0,0 +1,88 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+
+from flask import abort, current_app, g, request
+from sqlalchemy import case, func
+
+from model import db, Venue, Artist, Show, artist_shows
+
+
+def make_etag(kind, parts):
+    digest = hashlib.sha1(repr(tuple(parts)).encode()).hexdigest()[:20]
+    return '%s-%s' % (kind, digest)
+
+
+def _show_fingerprint(now):
+    # count, version sum and newest id change on any insert, update or delete
+    # of the shows; the upcoming count changes when one of them moves to past
+    return (
+        func.count(Show.id),
+        func.coalesce(func.sum(Show.version), 0),
+        func.max(Show.id),
+        func.count(case((Show.time > now, Show.id))),
+    )
+
+
+def venue_etag(venue_id, now=None):
+    row = db.session.query(Venue.version, *_show_fingerprint(now or datetime.now())) \
+        .outerjoin(Show, Show.venue_id == Venue.id) \
+        .filter(Venue.id == venue_id) \
+        .group_by(Venue.id, Venue.version).one_or_none()
+    if row is None:
+        return None
+    return make_etag('venue', (venue_id,) + tuple(row))
+
+
+def artist_etag(artist_id, now=None):
+    # the artist page also shows each venue's name
+    venues = func.coalesce(func.sum(Venue.version), 0)
+    row = db.session.query(Artist.version, venues, *_show_fingerprint(now or datetime.now())) \
+        .outerjoin(artist_shows, artist_shows.c.artist_id == Artist.id) \
+        .outerjoin(Show, Show.id == artist_shows.c.show_id) \
+        .outerjoin(Venue, Venue.id == Show.venue_id) \
+        .filter(Artist.id == artist_id) \
+        .group_by(Artist.id, Artist.version).one_or_none()
+    if row is None:
+        return None
+    return make_etag('artist', (artist_id,) + tuple(row))
+
+
+def show_etag(show_id, now=None):
+    row = db.session.query(Show.version, Venue.version) \
+        .join(Venue, Venue.id == Show.venue_id) \
+        .filter(Show.id == show_id).one_or_none()
+    if row is None:
+        return None
+    return make_etag('show', (show_id,) + tuple(row))
+
+
+def conditional(etag_for):
+    """Answer If-None-Match with 304 before the view runs, and tag its response.
+
+    ``etag_for`` gets the view arguments and returns the current ETag, or None
+    when the resource does not exist. The ETag is left in ``g.etag``, where
+    cache.cached puts it in the cache key, so a cached body is only ever
+    served with the ETag it was rendered under.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            etag = etag_for(*kwargs.values())
+            if etag is None:
+                abort(404)
+            g.etag = etag
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(**kwargs))
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+
+def require_match(etag):
+    """Abort with 412 unless a sent If-Match names ``etag`` (or is ``*``)."""
+    if request.if_match and not request.if_match.contains(etag):
+        abort(412)
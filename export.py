@@ -0,0 +1,149 @@
+import csv
+import io
+import itertools
+import json
+import zlib
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from importer import ArtistImport, VenueImport, batches
+from model import db, Venue, Artist, Show, Genre, artist_shows, venue_genres, artist_genres
+
+
+# columns of each export; list values are joined with ';' (artist_ids, artist_names)
+# or ',' (genres) in CSV, so a CSV export can be fed back to `flask import`;
+# genres, the last of the import's computed columns, is read from the genre tables
+EXPORT_COLUMNS = {
+    'shows': ('id', 'time', 'duration', 'venue_id', 'venue_name', 'venue_city', 'venue_state', 'artist_ids', 'artist_names'),
+    'venues': ('id',) + VenueImport.fields + VenueImport.computed,
+    'artists': ('id',) + ArtistImport.fields + ArtistImport.computed,
+}
+LIST_SEPARATORS = {'artist_ids': ';', 'artist_names': ';', 'genres': ','}
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _groups(connection, statement, batch_size):
+    # rows come ordered by the parent id; only the current group is held in memory
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(statement)
+    try:
+        for _, rows in itertools.groupby(result, key=lambda row: row[0]):
+            yield list(rows)
+    finally:
+        result.close()
+
+
+def show_records(connection, batch_size, where=None):
+    shows, venue, artist = Show.__table__, Venue.__table__, Artist.__table__
+    statement = select(
+        shows.c.id, shows.c.time, shows.c.duration, shows.c.venue_id, venue.c.name, venue.c.city, venue.c.state,
+        artist.c.id.label('artist_id'), artist.c.name.label('artist_name'),
+    ).select_from(
+        shows.join(venue, venue.c.id == shows.c.venue_id)
+        .outerjoin(artist_shows, artist_shows.c.show_id == shows.c.id)
+        .outerjoin(artist, artist.c.id == artist_shows.c.artist_id)
+    ).order_by(shows.c.id, artist_shows.c.artist_id)  # matches ix_artist_shows_show_id_artist_id
+    if where is not None:
+        statement = statement.where(where)
+    for rows in _groups(connection, statement, batch_size):
+        show = rows[0]
+        linked = [row for row in rows if row.artist_id is not None]
+        yield {
+            'id': show.id,
+            'time': show.time.isoformat(),
+            'duration': show.duration,
+            'venue_id': show.venue_id,
+            'venue_name': show.name,
+            'venue_city': show.city,
+            'venue_state': show.state,
+            'artist_ids': [row.artist_id for row in linked],
+            'artist_names': [row.artist_name for row in linked],
+        }
+
+
+def _profile_records(model, link, fields):
+    def records(connection, batch_size):
+        owner, genre = model.__table__, Genre.__table__
+        statement = select(
+            *[owner.c[name] for name in fields], genre.c.name.label('genre'),
+        ).select_from(
+            owner.outerjoin(link, link.c[owner.name + '_id'] == owner.c.id)
+            .outerjoin(genre, genre.c.id == link.c.genre_id)
+        ).order_by(owner.c.id, genre.c.name)
+        for rows in _groups(connection, statement, batch_size):
+            record = {name: rows[0][name] for name in fields}
+            record['genres'] = [row.genre for row in rows if row.genre is not None]
+            yield record
+    return records
+
+
+EXPORTS = {
+    'shows': show_records,
+    'venues': _profile_records(Venue, venue_genres, EXPORT_COLUMNS['venues'][:-1]),
+    'artists': _profile_records(Artist, artist_genres, EXPORT_COLUMNS['artists'][:-1]),
+}
+
+
+def encode(records, kind, fmt, batch_size):
+    """Yield text chunks of ``batch_size`` records as NDJSON or CSV (with a header)."""
+    columns = EXPORT_COLUMNS[kind]
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+    for chunk in batches(records, batch_size):
+        if fmt == 'ndjson':
+            yield ''.join(json.dumps(record) + '\n' for record in chunk)
+            continue
+        for record in chunk:
+            writer.writerow([
+                LIST_SEPARATORS[name].join(map(str, record[name])) if name in LIST_SEPARATORS else record[name]
+                for name in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(kind, fmt='ndjson', compress=False, batch_size=1000, engine=None):
+    """Stream every ``kind`` record as bytes, holding one batch in memory at a time.
+
+    The rows are read through a server-side cursor on its own connection,
+    which is released when the generator is exhausted or closed.
+    """
+    engine = engine or db.engine
+    with engine.connect() as connection:
+        records = EXPORTS[kind](connection, batch_size)
+        try:
+            chunks = (text.encode('utf-8') for text in encode(records, kind, fmt, batch_size))
+            if compress:
+                chunks = gzipped(chunks)
+            for chunk in chunks:
+                yield chunk
+        finally:
+            # close the server-side cursor before its connection goes back to the pool
+            records.close()
+
+
+@click.command('export')
+@click.argument('kind', type=click.Choice(sorted(EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)), default='ndjson', show_default=True)
+@click.option('--output', '-o', default='-', help="File to write; '-' for stdout. A .gz name implies --gzip.")
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched per round trip.')
+@with_appcontext
+def export_command(kind, fmt, output, compress, batch_size):
+    """Dump every show, venue or artist as NDJSON or CSV."""
+    compress = compress or output.endswith('.gz')
+    with click.open_file(output, 'wb') as stream:
+        for chunk in export(kind, fmt, compress, batch_size):
+            stream.write(chunk)
@@ -0,0 +1,84 @@
+"""Catch up the genre tables with writes to the legacy comma-joined columns.
+
+Instances that predate the genre tables (migration b7d30e51c9a2) read and
+write only ``venue.genres`` and ``artist.genres``. Current instances write both
+(see model.sync_genre_names and ProfileImport), so while both are serving a
+row whose column disagrees with its links was last written by an old
+instance. ``flask genres sync`` carries those writes over; run it once the
+last old instance has stopped (and as often as you like before that).
+"""
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+
+from importer import dialect_insert
+from model import db, Venue, Artist, Genre, venue_genres, artist_genres, split_genres
+
+BATCH_SIZE = 1000
+OWNERS = ((Venue, venue_genres, 'venue'), (Artist, artist_genres, 'artist'))
+
+
+def sync(connection, model, link_table, low, high):
+    """Reconcile the rows with ``low < id <= high``; return the ids whose links were replaced."""
+    owner, genre = model.__table__, Genre.__table__
+    owner_id = link_table.c.keys()[0]
+    # locked, so a current instance cannot rewrite a row between the read and the relink
+    rows = connection.execute(select(owner.c.id, owner.c.genres).where(
+        owner.c.id > low, owner.c.id <= high).with_for_update()).all()
+    linked = defaultdict(set)
+    for id_, name in connection.execute(
+            select(link_table.c[owner_id], genre.c.name).join(genre, genre.c.id == link_table.c.genre_id)
+            .where(link_table.c[owner_id] > low, link_table.c[owner_id] <= high)):
+        linked[id_].add(name)
+
+    relinked = {}
+    for id_, legacy in rows:
+        if legacy is None:
+            # written by a current instance before it kept the column too
+            if linked[id_]:
+                connection.execute(owner.update().where(owner.c.id == id_).values(
+                    genres=','.join(sorted(linked[id_]))))
+        elif set(split_genres(legacy)) != linked[id_]:
+            relinked[id_] = split_genres(legacy)
+    if not relinked:
+        return []
+
+    names = {name for value in relinked.values() for name in value}
+    genre_ids = {}
+    if names:
+        connection.execute(dialect_insert(connection, genre).on_conflict_do_nothing(index_elements=['name']),
+                           [{'name': name} for name in sorted(names)])
+        genre_ids = dict(connection.execute(select(genre.c.name, genre.c.id).where(genre.c.name.in_(names))).all())
+    connection.execute(link_table.delete().where(link_table.c[owner_id].in_(relinked)))
+    links = [{owner_id: id_, 'genre_id': genre_ids[name]} for id_, value in relinked.items() for name in value]
+    if links:
+        connection.execute(link_table.insert(), links)
+    # the representation changed, so move the ETag on
+    connection.execute(owner.update().where(owner.c.id.in_(relinked)).values(version=owner.c.version + 1))
+    return sorted(relinked)
+
+
+genres_cli = AppGroup('genres', help='Maintain the genre tables.')
+
+
+@genres_cli.command('sync')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows per transaction.')
+def sync_command(batch_size):
+    """Apply writes that old instances made to the comma-joined genres columns."""
+    backend = current_app.extensions.get('cache')
+    for model, link_table, kind in OWNERS:
+        with db.engine.connect() as connection:
+            last_id = connection.execute(select(func.max(model.id))).scalar() or 0
+        changed = []
+        for low in range(0, last_id, batch_size):
+            # short transactions, so writers are never held up for long
+            with db.engine.begin() as connection:
+                changed.extend(sync(connection, model, link_table, low, low + batch_size))
+        if backend is not None and changed:
+            tags = {'%ss' % kind}
+            tags.update('%s:%d' % (kind, id_) for id_ in changed)
+            backend.invalidate(tags)
+        click.echo('relinked the genres of %d %ss' % (len(changed), kind))
@@ -0,0 +1,177 @@
+"""Venue coordinates: pluggable geocoding and distance helpers.
+
+A geocoder turns a venue's address, city and state into ``(latitude,
+longitude)`` or None. GEOCODER picks one: ``null``, ``table`` (an offline
+lookup in the GEOCODER_TABLE CSV) or ``package.module:factory``, which is
+called with the app config. Venues written through the ORM are geocoded by a
+job after the commit that changed their address, unless coordinates were given;
+imports geocode while cleaning rows, and ``flask geocode`` backfills the rest.
+"""
+import csv
+import importlib
+import math
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, event, inspect, or_
+
+from jobs import handler, jobs
+from model import db, Venue
+from routing import RoutingSession
+
+
+EARTH_RADIUS_KM = 6371.0088
+ADDRESS_FIELDS = ('address', 'city', 'state')
+
+
+def _key(*parts):
+    return tuple(' '.join((part or '').lower().split()) for part in parts)
+
+
+class NullGeocoder(object):
+
+    def lookup(self, address, city, state):
+        return None
+
+
+class TableGeocoder(object):
+    """Look addresses up in a local table, falling back to the city's entry.
+
+    ``rows`` are ``(address, city, state, latitude, longitude)``; a row with
+    an empty address stands for the whole city.
+    """
+
+    def __init__(self, rows=()):
+        self.places = {_key(address, city, state): (float(lat), float(lng))
+                       for address, city, state, lat, lng in rows}
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path, encoding='utf-8', newline='') as source:
+            return cls((row.get('address'), row['city'], row['state'], row['latitude'], row['longitude'])
+                       for row in csv.DictReader(source))
+
+    def lookup(self, address, city, state):
+        return self.places.get(_key(address, city, state)) or self.places.get(_key(None, city, state))
+
+
+class LazyGeocoder(object):
+    # builds the real geocoder on first use, so create_app does not read the table
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.geocoder = None
+
+    def lookup(self, address, city, state):
+        if self.geocoder is None:
+            self.geocoder = self.factory()
+        return self.geocoder.lookup(address, city, state)
+
+
+def make_geocoder(config):
+    name = config.get('GEOCODER', 'null')
+    if name == 'table':
+        return LazyGeocoder(lambda: TableGeocoder.from_csv(config['GEOCODER_TABLE']))
+    if ':' in name:
+        module, _, factory = name.partition(':')
+        return LazyGeocoder(lambda: getattr(importlib.import_module(module), factory)(config))
+    return NullGeocoder()
+
+
+def init_app(app, geocoder=None):
+    app.extensions['geocoder'] = geocoder or make_geocoder(app.config)
+
+
+def geocode(geocoder, venue):
+    """Set the venue's coordinates from its address; False if it was not found."""
+    found = geocoder.lookup(venue.address, venue.city, venue.state)
+    venue.latitude, venue.longitude = found or (None, None)
+    return found is not None
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _geocode_changed_venues(session, flush_context):
+    geocoder = session.app.extensions.get('geocoder')
+    if geocoder is None or isinstance(geocoder, NullGeocoder):
+        return
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Venue):
+            continue
+        state = inspect(obj)
+        if state.attrs.latitude.history.has_changes() or state.attrs.longitude.history.has_changes():
+            continue  # coordinates given explicitly win
+        if obj in session.new or any(state.attrs[name].history.has_changes() for name in ADDRESS_FIELDS):
+            jobs.defer(session, 'geocode_venue', venue_id=obj.id, address=[obj.address, obj.city, obj.state],
+                       coordinates=[obj.latitude, obj.longitude])
+
+
+@handler('geocode_venue')
+def geocode_job(venue_id, address, coordinates):
+    """Geocode a venue after its address was written, unless it changed since:
+    a newer address has a job of its own, and coordinates set by hand win."""
+    venue = db.session.get(Venue, venue_id)
+    if venue is None or [venue.address, venue.city, venue.state] != address \
+            or [venue.latitude, venue.longitude] != coordinates:
+        return
+    geocode(current_app.extensions['geocoder'], venue)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in kilometres."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """``(min_lat, max_lat, [(min_lng, max_lng), ...])`` enclosing the circle.
+
+    The longitude span widens towards the poles; it is split in two where it
+    crosses the antimeridian and covers everything when a pole is inside.
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    min_lat, max_lat = latitude - math.degrees(angle), latitude + math.degrees(angle)
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), min(max_lat, 90.0), [(-180.0, 180.0)]
+    span = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(latitude))))
+    low, high = longitude - span, longitude + span
+    if low < -180:
+        return min_lat, max_lat, [(low + 360, 180.0), (-180.0, high)]
+    if high > 180:
+        return min_lat, max_lat, [(low, 180.0), (-180.0, high - 360)]
+    return min_lat, max_lat, [(low, high)]
+
+
+def within_box(latitude, longitude, radius_km):
+    """Filter on ix_venue_latitude_longitude selecting the circle's bounding box."""
+    min_lat, max_lat, spans = bounding_box(latitude, longitude, radius_km)
+    return and_(Venue.latitude.between(min_lat, max_lat),
+                or_(*[Venue.longitude.between(low, high) for low, high in spans]))
+
+
+geocode_cli = AppGroup('geocode', help='Fill in venue coordinates.')
+
+
+@geocode_cli.command('venues')
+@click.option('--all', 'everything', is_flag=True, help='re-geocode venues that already have coordinates')
+@click.option('--batch-size', default=500, show_default=True)
+def geocode_command(everything, batch_size):
+    """Geocode venues without coordinates, committing each batch."""
+    geocoder = current_app.extensions['geocoder']
+    found = missed = last_id = 0
+    while True:
+        query = Venue.query.filter(Venue.id > last_id)
+        if not everything:
+            query = query.filter(Venue.latitude.is_(None))
+        batch = query.order_by(Venue.id).limit(batch_size).all()
+        if not batch:
+            break
+        for venue in batch:
+            if geocode(geocoder, venue):
+                found += 1
+            else:
+                missed += 1
+        last_id = batch[-1].id
+        db.session.commit()
+    click.echo('geocoded %d venues, %d not found' % (found, missed))
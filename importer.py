@@ -0,0 +1,495 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import column, delete, exc, exists, func, select, table, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from booking import EXCLUSION_VIOLATION, MAX_DURATION, pgcode
+from counters import reconcile
+from database import is_partitioned
+from model import db, Venue, Artist, Show, Genre, artist_shows, venue_genres, artist_genres, split_genres
+
+
+class RowError(ValueError):
+    pass
+
+
+def open_source(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_records(stream, fmt):
+    """Yield ``(line, record)`` pairs; a JSON line that does not parse yields a RowError."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line, raw in enumerate(stream, 1):
+        if not raw.strip():
+            continue
+        try:
+            record = json.loads(raw)
+        except ValueError as e:
+            record = RowError('invalid JSON: %s' % e)
+        yield line, record
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _text(record, field, column):
+    value = record.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    if column.type.length and len(value) > column.type.length:
+        raise RowError('%s is longer than %d characters' % (field, column.type.length))
+    return value
+
+
+def _integer(value, field):
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RowError('%s must be an integer' % field)
+
+
+def _float(value, field):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RowError('%s must be a number' % field)
+
+
+def _integers(value, field):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.replace(';', ',').split(',')
+    return sorted({_integer(item, field) for item in value if str(item).strip()})
+
+
+def dialect_insert(connection, target):
+    if connection.dialect.name == 'postgresql':
+        return postgresql.insert(target)
+    return sqlite.insert(target)
+
+
+def copy_rows(connection, name, columns, rows):
+    """COPY ``rows`` (tuples in ``columns`` order) into ``name`` with psycopg2's copy_expert."""
+    buffer = io.StringIO()
+    # csv.writer renders None as an unquoted empty field, which COPY reads as NULL
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (name, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+class TableImport(object):
+    """Validate and write one kind of record in batches.
+
+    Rows are upserted on ``id``; rows without one get ids from the table's
+    sequence (or after ``max(id)`` on SQLite). On Postgres a batch is COPYed
+    into a temporary staging table and merged with ``INSERT ... SELECT ... ON
+    CONFLICT``; other backends use executemany with ``ON CONFLICT``.
+    """
+
+    model = None
+    fields = ()
+    # columns written with the fields but filled in by clean() rather than read as text
+    computed = ()
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.table = self.model.__table__
+        self.columns = ('id',) + self.fields + self.computed
+        self.postgresql = connection.dialect.name == 'postgresql'
+        self.explicit_ids = False
+        if self.postgresql:
+            self.staging = 'import_%s' % self.table.name
+            connection.execute(text(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS %s ON COMMIT DELETE ROWS AS '
+                'SELECT %s FROM %s WITH NO DATA' % (self.staging, ', '.join(self.columns), self.table.name)))
+
+    def clean(self, record):
+        raise NotImplementedError
+
+    def write(self, rows):
+        """Write one batch of cleaned rows; return (rejected rows, cache tags)."""
+        raise NotImplementedError
+
+    def describe(self, error, row):
+        """Message for a row the database refused."""
+        return str(error.orig).strip().splitlines()[0]
+
+    def assign_ids(self, rows):
+        # a later row with the same id replaces an earlier one in the batch,
+        # since ON CONFLICT cannot touch one row twice in a statement
+        by_id = {}
+        missing = []
+        for row in rows:
+            if row['id'] is None:
+                missing.append(row)
+            else:
+                self.explicit_ids = True
+                by_id[row['id']] = row
+        for row, id_ in zip(missing, self.next_ids(len(missing))):
+            row['id'] = id_
+            by_id[id_] = row
+        return list(by_id.values())
+
+    def next_ids(self, count):
+        if not count:
+            return []
+        if self.postgresql:
+            return self.connection.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+                {'table': self.table.name, 'count': count}).scalars().all()
+        start = self.connection.execute(select(func.coalesce(func.max(self.table.c.id), 0))).scalar()
+        return list(range(start + 1, start + 1 + count))
+
+    def upsert(self, rows):
+        insert = dialect_insert(self.connection, self.table)
+        if self.postgresql:
+            copy_rows(self.connection, self.staging, self.columns,
+                      [tuple(row[name] for name in self.columns) for row in rows])
+            staging = table(self.staging, *[column(name) for name in self.columns])
+            insert = insert.from_select(self.columns, select(*staging.c))
+        changes = {name: insert.excluded[name] for name in self.fields + self.computed}
+        changes['version'] = self.table.c.version + 1
+        statement = insert.on_conflict_do_update(index_elements=['id'], set_=changes)
+        if self.postgresql:
+            self.connection.execute(statement)
+        else:
+            self.connection.execute(statement, [{name: row[name] for name in self.columns} for row in rows])
+
+    def replace_links(self, link_table, owner, target, links, ids):
+        """Replace the ``link_table`` rows of ``ids`` with ``links`` (owner, target) pairs."""
+        self.connection.execute(delete(link_table).where(link_table.c[owner].in_(ids)))
+        if not links:
+            return
+        if self.postgresql:
+            copy_rows(self.connection, link_table.name, (owner, target), links)
+        else:
+            self.connection.execute(link_table.insert(), [{owner: a, target: b} for a, b in links])
+
+    def finish(self):
+        """Tidy up after the last batch; return cache tags to invalidate."""
+        # explicit ids bypass the sequence, so move it past them
+        if self.postgresql and self.explicit_ids:
+            sequence = self.connection.execute(
+                text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': self.table.name}).scalar()
+            self.connection.execute(text(
+                'SELECT setval(:sequence, greatest((SELECT max(id) FROM %s), (SELECT last_value FROM %s)))'
+                % (self.table.name, sequence)), {'sequence': sequence})
+        return set()
+
+
+class ProfileImport(TableImport):
+    """Venues and artists: profile columns plus a ``genres`` list or comma-joined string."""
+
+    genre_table = None
+    kind = None
+    # the legacy comma-joined column, kept current like sync_genre_names does
+    computed = ('genres',)
+
+    def clean(self, record):
+        row = {'id': _integer(record.get('id'), 'id')}
+        for field in self.fields:
+            row[field] = _text(record, field, self.table.c[field])
+        if row['name'] is None:
+            raise RowError('name is required')
+        row['genre_names'] = split_genres(record.get('genres'))
+        for name in row['genre_names']:
+            if len(name) > Genre.__table__.c.name.type.length:
+                raise RowError('genre %r is too long' % name)
+        row['genres'] = ','.join(sorted(row['genre_names'])) or None
+        return row
+
+    def write(self, rows):
+        rows = self.assign_ids(rows)
+        self.upsert(rows)
+        genre_ids = self.resolve_genres({name for row in rows for name in row['genre_names']})
+        owner = self.genre_table.c.keys()[0]
+        links = [(row['id'], genre_ids[name]) for row in rows for name in row['genre_names']]
+        ids = [row['id'] for row in rows]
+        self.replace_links(self.genre_table, owner, 'genre_id', links, ids)
+        tags = {'%ss' % self.kind, 'regions'}
+        tags.update('%s:%d' % (self.kind, id_) for id_ in ids)
+        return [], tags
+
+    def resolve_genres(self, names):
+        if not names:
+            return {}
+        genre = Genre.__table__
+        insert = dialect_insert(self.connection, genre).on_conflict_do_nothing(index_elements=['name'])
+        self.connection.execute(insert, [{'name': name} for name in sorted(names)])
+        return dict(self.connection.execute(select(genre.c.name, genre.c.id).where(genre.c.name.in_(names))).all())
+
+
+class VenueImport(ProfileImport):
+    model = Venue
+    kind = 'venue'
+    genre_table = venue_genres
+    fields = ('name', 'city', 'state', 'address', 'phone', 'image_link', 'facebook_link',
+              'website_link', 'look_talent', 'seek_des')
+    computed = ('latitude', 'longitude') + ProfileImport.computed
+
+    def clean(self, record):
+        # coordinates in the record win; otherwise the app's geocoder finds them
+        row = super(VenueImport, self).clean(record)
+        row['latitude'] = _float(record.get('latitude'), 'latitude')
+        row['longitude'] = _float(record.get('longitude'), 'longitude')
+        if (row['latitude'] is None) != (row['longitude'] is None):
+            raise RowError('latitude and longitude go together')
+        if row['latitude'] is None:
+            found = current_app.extensions['geocoder'].lookup(row['address'], row['city'], row['state'])
+            row['latitude'], row['longitude'] = found or (None, None)
+        elif not (-90 <= row['latitude'] <= 90 and -180 <= row['longitude'] <= 180):
+            raise RowError('coordinates out of range')
+        return row
+
+
+class ArtistImport(ProfileImport):
+    model = Artist
+    kind = 'artist'
+    genre_table = artist_genres
+    fields = ('name', 'city', 'state', 'phone', 'image_link', 'facebook_link',
+              'website_link', 'seeking_venue', 'seek_des')
+
+
+class ShowImport(TableImport):
+    """Shows: ``venue_id``, an ISO 8601 ``time``, an optional ``duration`` in
+    minutes and ``artist_ids`` (a list, or ids joined by , or ;)."""
+
+    model = Show
+    fields = ('venue_id', 'time', 'duration')
+
+    def __init__(self, connection):
+        super(ShowImport, self).__init__(connection)
+        self.partitioned = is_partitioned(connection, self.table.name)
+        # whose counters finish() has to recount: the new owners of the
+        # imported shows and the previous owners of the ones updated
+        self.venue_ids, self.artist_ids = set(), set()
+
+    def upsert(self, rows):
+        if not self.partitioned:
+            return super(ShowImport, self).upsert(rows)
+        # partitioned by month (see partitions.py), shows has no unique index
+        # on id alone for ON CONFLICT, so existing ids are updated (moving
+        # rows between months as needed) and the rest inserted
+        copy_rows(self.connection, self.staging, self.columns,
+                  [tuple(row[name] for name in self.columns) for row in rows])
+        staging = table(self.staging, *[column(name) for name in self.columns])
+        changes = {name: staging.c[name] for name in self.fields}
+        changes['version'] = self.table.c.version + 1
+        self.connection.execute(self.table.update().where(self.table.c.id == staging.c.id).values(changes))
+        self.connection.execute(self.table.insert().from_select(self.columns, select(*staging.c).where(
+            ~exists().where(self.table.c.id == staging.c.id))))
+
+    def clean(self, record):
+        row = {'id': _integer(record.get('id'), 'id'), 'venue_id': _integer(record.get('venue_id'), 'venue_id')}
+        if row['venue_id'] is None:
+            raise RowError('venue_id is required')
+        try:
+            row['time'] = datetime.fromisoformat(str(record.get('time') or '').strip())
+        except ValueError:
+            raise RowError('time must be an ISO 8601 date and time')
+        row['duration'] = _integer(record.get('duration'), 'duration') or 120
+        if not 0 < row['duration'] <= MAX_DURATION:
+            raise RowError('duration must be between 1 and %d minutes' % MAX_DURATION)
+        row['artist_ids'] = _integers(record.get('artist_ids'), 'artist_ids')
+        return row
+
+    def write(self, rows):
+        venue_ids = {row['venue_id'] for row in rows}
+        artist_ids = {id_ for row in rows for id_ in row['artist_ids']}
+        venues = set(self.connection.execute(select(Venue.id).where(Venue.id.in_(venue_ids))).scalars())
+        artists = set(self.connection.execute(select(Artist.id).where(Artist.id.in_(artist_ids))).scalars())
+        accepted, rejected = [], []
+        for row in rows:
+            if row['venue_id'] not in venues:
+                rejected.append((row, 'venue %d does not exist' % row['venue_id']))
+            elif not artists.issuperset(row['artist_ids']):
+                missing = sorted(set(row['artist_ids']) - artists)
+                rejected.append((row, 'artists %s do not exist' % ', '.join(map(str, missing))))
+            else:
+                accepted.append(row)
+        if not accepted:
+            return rejected, set()
+        # pages that listed an updated show before the import go stale too
+        tags = self.previous_tags([row['id'] for row in accepted if row['id'] is not None])
+        accepted = self.assign_ids(accepted)
+        self.upsert(accepted)
+        ids = [row['id'] for row in accepted]
+        links = [(artist_id, row['id']) for row in accepted for artist_id in row['artist_ids']]
+        self.replace_links(artist_shows, 'artist_id', 'show_id', links, ids)
+        tags.update(('shows', 'venues', 'artists', 'regions'))
+        for row in accepted:
+            self.venue_ids.add(row['venue_id'])
+            self.artist_ids.update(row['artist_ids'])
+            tags.add('show:%d' % row['id'])
+            tags.add('venue:%d' % row['venue_id'])
+            tags.update('artist:%d' % artist_id for artist_id in row['artist_ids'])
+        return rejected, tags
+
+    def describe(self, error, row):
+        if pgcode(error) == EXCLUSION_VIOLATION:
+            return 'overlaps another show at venue %d' % row['venue_id']
+        return super(ShowImport, self).describe(error, row)
+
+    def finish(self):
+        tags = super(ShowImport, self).finish()
+        # bulk writes skip the session events that keep the show counters current
+        venue_ids, artist_ids = reconcile(self.connection, self.venue_ids, self.artist_ids)
+        tags.update('venue:%d' % id for id in venue_ids)
+        tags.update('artist:%d' % id for id in artist_ids)
+        return tags
+
+    def previous_tags(self, ids):
+        if not ids:
+            return set()
+        venue_ids = set(self.connection.execute(select(Show.venue_id).where(Show.id.in_(ids))).scalars())
+        artist_ids = set(self.connection.execute(
+            select(artist_shows.c.artist_id).where(artist_shows.c.show_id.in_(ids))).scalars())
+        self.venue_ids.update(venue_ids)
+        self.artist_ids.update(artist_ids)
+        tags = {'venue:%d' % venue_id for venue_id in venue_ids}
+        tags.update('artist:%d' % artist_id for artist_id in artist_ids)
+        return tags
+
+
+IMPORTS = {'venues': VenueImport, 'artists': ArtistImport, 'shows': ShowImport}
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return (self.imported + self.rejected) / max(self.elapsed, 1e-9)
+
+
+def run_import(kind, records, batch_size=1000, max_errors=100, on_error=None, engine=None):
+    """Import ``(line, record)`` pairs into ``kind``, committing one transaction per batch.
+
+    Memory use is bounded by ``batch_size``. Invalid rows are reported through
+    ``on_error(line, message)`` and skipped; more than ``max_errors`` of them
+    raises RowError, leaving the batches written so far committed.
+    """
+    stats = ImportStats()
+    on_error = on_error or (lambda line, message: None)
+    engine = engine or db.engine
+    backend = current_app.extensions.get('cache')
+
+    def reject(line, message):
+        stats.rejected += 1
+        on_error(line, message)
+        if stats.rejected > max_errors:
+            raise RowError('more than %d invalid rows, stopping' % max_errors)
+
+    with engine.connect() as connection:
+        importer = IMPORTS[kind](connection)
+        for batch in batches(records, batch_size):
+            rows = []
+            for line, record in batch:
+                try:
+                    if isinstance(record, RowError):
+                        raise record
+                    if not isinstance(record, dict):
+                        raise RowError('expected an object')
+                    row = importer.clean(record)
+                except RowError as e:
+                    reject(line, str(e))
+                    continue
+                row['line'] = line
+                rows.append(row)
+            if not rows:
+                continue
+            try:
+                with connection.begin():
+                    rejected, tags = importer.write(rows)
+            except exc.IntegrityError:
+                # a constraint refused the batch; write it a row at a time to find the culprits
+                rejected, tags = [], set()
+                for row in rows:
+                    try:
+                        with connection.begin():
+                            refused, row_tags = importer.write([row])
+                    except exc.IntegrityError as e:
+                        refused, row_tags = [(row, importer.describe(e, row))], set()
+                    rejected.extend(refused)
+                    tags.update(row_tags)
+            stats.imported += len(rows) - len(rejected)
+            for row, message in rejected:
+                reject(row['line'], message)
+            if backend is not None and tags:
+                backend.invalidate(tags)
+        with connection.begin():
+            tags = importer.finish()
+        if backend is not None and tags:
+            backend.invalidate(tags)
+    return stats
+
+
+@click.command('import')
+@click.argument('kind', type=click.Choice(sorted(IMPORTS)))
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format; guessed from the file extension by default.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per transaction.')
+@click.option('--max-errors', default=100, show_default=True, help='Stop after this many invalid rows.')
+@with_appcontext
+def import_command(kind, path, fmt, batch_size, max_errors):
+    """Bulk load venues, artists or shows from a CSV or JSON Lines file ('-' for stdin)."""
+    if fmt is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        fmt = 'csv' if name.endswith('.csv') else 'jsonl'
+
+    def on_error(line, message):
+        click.echo('line %d: %s' % (line, message), err=True)
+
+    with open_source(path) as stream:
+        try:
+            stats = run_import(kind, read_records(stream, fmt), batch_size, max_errors, on_error)
+        except RowError as e:
+            raise click.ClickException(str(e))
+    click.echo('%s: %d imported, %d rejected in %.2fs (%.0f rows/s)'
+               % (kind, stats.imported, stats.rejected, stats.elapsed, stats.rate))
@@ -0,0 +1,236 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database import pool_stats
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOWEST_KEPT = 3
+# string and numeric literals written into the SQL itself; bound parameters are never logged
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# a plan is only asked for plain reads: EXPLAIN ANALYZE would take these locks again
+ROW_LOCK = re.compile(r'\bFOR\s+(?:UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)\b', re.IGNORECASE)
+
+
+def redact(statement):
+    return LITERAL.sub('?', ' '.join(statement.split()))
+
+
+class RequestStats(object):
+    """Statement count, database time and the slowest statements of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.slowest = []
+
+    def record(self, duration, statement):
+        self.statements += 1
+        self.db_time += duration
+        if len(self.slowest) < SLOWEST_KEPT or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, statement))
+            self.slowest.sort(key=lambda item: -item[0])
+            del self.slowest[SLOWEST_KEPT:]
+
+
+class Metrics(object):
+    """Process-wide request and database counters, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.latency_sum = defaultdict(float)
+        self.latency_count = defaultdict(int)
+        self.statements = defaultdict(int)
+        self.db_time = defaultdict(float)
+        self.slow_queries = 0
+
+    def observe(self, method, endpoint, status, duration, stats):
+        with self._lock:
+            self.requests[method, endpoint, status] += 1
+            buckets = self.latency[endpoint]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            self.latency_sum[endpoint] += duration
+            self.latency_count[endpoint] += 1
+            self.statements[endpoint] += stats.statements
+            self.db_time[endpoint] += stats.db_time
+
+    def slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self, pools):
+        lines = []
+
+        def family(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        def sample(name, labels, value):
+            label_text = ','.join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+            lines.append('%s{%s} %s' % (name, label_text, _number(value)) if labels else '%s %s' % (name, _number(value)))
+
+        with self._lock:
+            family('fyyur_http_requests_total', 'counter', 'HTTP requests served.')
+            for (method, endpoint, status), value in sorted(self.requests.items()):
+                sample('fyyur_http_requests_total', (('method', method), ('endpoint', endpoint), ('status', status)), value)
+            family('fyyur_http_request_duration_seconds', 'histogram', 'Time to produce a response.')
+            for endpoint in sorted(self.latency):
+                for bound, value in zip(LATENCY_BUCKETS, self.latency[endpoint]):
+                    sample('fyyur_http_request_duration_seconds_bucket', (('endpoint', endpoint), ('le', bound)), value)
+                sample('fyyur_http_request_duration_seconds_bucket', (('endpoint', endpoint), ('le', '+Inf')),
+                       self.latency_count[endpoint])
+                sample('fyyur_http_request_duration_seconds_sum', (('endpoint', endpoint),), self.latency_sum[endpoint])
+                sample('fyyur_http_request_duration_seconds_count', (('endpoint', endpoint),),
+                       self.latency_count[endpoint])
+            family('fyyur_db_statements_total', 'counter', 'SQL statements sent while serving requests.')
+            for endpoint, value in sorted(self.statements.items()):
+                sample('fyyur_db_statements_total', (('endpoint', endpoint),), value)
+            family('fyyur_db_time_seconds_total', 'counter', 'Time spent in SQL statements while serving requests.')
+            for endpoint, value in sorted(self.db_time.items()):
+                sample('fyyur_db_time_seconds_total', (('endpoint', endpoint),), value)
+            family('fyyur_db_slow_queries_total', 'counter', 'Statements slower than SLOW_QUERY_MS.')
+            sample('fyyur_db_slow_queries_total', (), self.slow_queries)
+
+        for name, kind, key, help in (
+                ('fyyur_db_pool_checked_out', 'gauge', 'checked_out', 'Connections in use.'),
+                ('fyyur_db_pool_size', 'gauge', 'size', 'Connections the pool keeps.'),
+                ('fyyur_db_pool_overflow', 'gauge', 'overflow', 'Connections beyond the pool size.'),
+                ('fyyur_db_pool_checkouts_total', 'counter', 'checkouts', 'Connections handed out.'),
+                ('fyyur_db_pool_timeouts_total', 'counter', 'timeouts', 'Checkouts that timed out.'),
+                ('fyyur_db_pool_wait_seconds_total', 'counter', 'wait_seconds_total', 'Time spent waiting for a connection.')):
+            values = [(bind, stats[key]) for bind, stats in sorted(pools.items()) if key in stats]
+            if values:
+                family(name, kind, help)
+                for bind, value in values:
+                    sample(name, (('bind', bind),), value)
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def explain(cursor, statement, parameters, dialect, analyze=False):
+    """Plan of a slow SELECT, run on a raw cursor so it is not instrumented itself.
+
+    With ``analyze`` Postgres runs the statement again to time it.
+    """
+    if dialect == 'postgresql':
+        sql, savepoint = ('EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN ') + statement, True
+    elif dialect == 'sqlite':
+        sql, savepoint = 'EXPLAIN QUERY PLAN ' + statement, False
+    else:
+        return None
+    explain_cursor = cursor.connection.cursor()
+    try:
+        # a failed EXPLAIN must not abort the request's transaction
+        if savepoint:
+            explain_cursor.execute('SAVEPOINT explain_slow_query')
+        try:
+            explain_cursor.execute(sql, parameters)
+            rows = explain_cursor.fetchall()
+        finally:
+            if savepoint:
+                explain_cursor.execute('ROLLBACK TO SAVEPOINT explain_slow_query')
+                explain_cursor.execute('RELEASE SAVEPOINT explain_slow_query')
+    finally:
+        explain_cursor.close()
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.instrumentation_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'instrumentation_started', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    if has_request_context() and 'sql_stats' in g:
+        g.sql_stats.record(duration, statement)
+    if not has_app_context():
+        return
+    threshold = current_app.config.get('SLOW_QUERY_MS')
+    if not threshold or duration * 1000 < threshold:
+        return
+    metrics = current_app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.slow_query()
+    record = {'event': 'slow_query', 'ms': round(duration * 1000, 3), 'statement': redact(statement)}
+    if explainable(statement, context, executemany) \
+            and random.random() < current_app.config.get('SLOW_QUERY_EXPLAIN', 0):
+        try:
+            record['plan'] = explain(cursor, statement, parameters, conn.dialect.name,
+                                     current_app.config.get('SLOW_QUERY_EXPLAIN_ANALYZE'))
+        except Exception as e:
+            record['plan_error'] = str(e).strip()
+    logger.warning(json.dumps(record))
+
+
+def explainable(statement, context, executemany):
+    # a server-side cursor has only declared its query when this runs, and
+    # its rows are still being read from the connection
+    return not executemany and not context.execution_options.get('stream_results') \
+        and statement.lstrip()[:6].upper() in ('SELECT', 'WITH') and not ROW_LOCK.search(statement)
+
+
+def pools(app, db):
+    replicas = app.extensions['replicas']
+    stats = {'primary': pool_stats(db.get_engine(app))}
+    stats.update((key, pool_stats(replicas.engine(key))) for key in replicas.keys)
+    return stats
+
+
+def init_app(app):
+    """Time every request and its SQL; log one JSON line per request and feed /metrics."""
+    metrics = app.extensions['metrics'] = Metrics()
+
+    @app.before_request
+    def start_request():
+        g.sql_stats = RequestStats()
+
+    @app.after_request
+    def finish_request(response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+        duration = time.perf_counter() - stats.started
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe(request.method, endpoint, str(response.status_code), duration, stats)
+        response.headers['Server-Timing'] = 'db;dur=%.1f, total;dur=%.1f' % (stats.db_time * 1000, duration * 1000)
+        logger.info(json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'ms': round(duration * 1000, 3),
+            'db_ms': round(stats.db_time * 1000, 3),
+            'statements': stats.statements,
+            'slowest': [{'ms': round(d * 1000, 3), 'statement': redact(s)} for d, s in stats.slowest],
+        }))
+        return response
@@ -0,0 +1,355 @@
+"""Background jobs for the work a write sets off but need not wait for.
+
+A write defers a job with ``jobs.defer(session, name, **payload)``; it runs
+after the write's transaction commits, and not at all if that rolls back.
+JOBS_BACKEND picks where jobs wait until then:
+
+``memory``
+    a queue in this process, served by JOBS_WORKERS threads. Jobs still
+    queued when the process exits are lost.
+``database``
+    the ``jobs`` table. The row is inserted in the deferring transaction, so
+    the job exists exactly when the write does. Workers (the in-process
+    threads and ``flask worker``) claim due rows with ``FOR UPDATE SKIP
+    LOCKED`` on Postgres and lease them for JOBS_LEASE seconds, so a job
+    whose worker died is taken over once its lease runs out.
+``inline``
+    each job runs as its transaction commits, before commit() returns.
+
+Every job runs in an app context on a session of its own, committed when the
+handler returns. A failing job is retried after JOBS_BACKOFF seconds,
+doubling per attempt, until it has run JOBS_MAX_ATTEMPTS times. Since a job
+can run more than once (a retry, an expired lease, a crash between the
+handler's commit and the job's removal), handlers must be idempotent: they
+read the current state and bring things in line with it, rather than apply
+a change recorded in the payload.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, or_, select
+
+from model import db, jobs as job_table
+from routing import RoutingSession
+
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def handler(name):
+    """Register the function that runs jobs called ``name``."""
+    def register(fn):
+        HANDLERS[name] = fn
+        return fn
+    return register
+
+
+class Job(object):
+
+    def __init__(self, name, payload, attempts=0, run_at=None, id=None):
+        self.name = name
+        self.payload = payload
+        self.attempts = attempts
+        self.run_at = run_at or datetime.now()
+        self.id = id
+
+    def __repr__(self):
+        return '<Job %s %s>' % (self.name, self.id if self.id is not None else self.payload)
+
+
+def run(app, job):
+    """Run ``job`` on a session of its own; return the error it raised, or None."""
+    with app.app_context():
+        try:
+            HANDLERS[job.name](**job.payload)
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            logger.warning('job %r failed on attempt %d', job, job.attempts, exc_info=True)
+            return error
+        finally:
+            db.session.remove()
+    return None
+
+
+def describe(error):
+    return '%s: %s' % (type(error).__name__, error)
+
+
+class JobQueue(object):
+    """Where deferred jobs wait, plus the worker threads that run them."""
+
+    durable = False
+
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self._threads = []
+        self._pid = None
+        self._stop = threading.Event()
+
+    def backoff(self, attempts):
+        """Seconds before retrying a job that has failed ``attempts`` times, with jitter."""
+        delay = min(self.config['JOBS_BACKOFF'] * 2 ** (attempts - 1), self.config['JOBS_BACKOFF_MAX'])
+        return delay * random.uniform(0.5, 1.0)
+
+    def finish(self, job, error):
+        if error is None:
+            self.done(job)
+        elif job.attempts >= self.config['JOBS_MAX_ATTEMPTS']:
+            logger.error('job %r gave up after %d attempts: %s', job, job.attempts, describe(error))
+            self.fail(job, error)
+        else:
+            self.retry(job, error, self.backoff(job.attempts))
+
+    def work(self, limit, timeout=0):
+        """Run up to ``limit`` due jobs; return how many ran."""
+        claimed = self.claim(limit, timeout)
+        for job in claimed:
+            self.finish(job, run(self.app, job))
+        return len(claimed)
+
+    def start(self, size=None):
+        """Start the worker threads, once per process (again after a fork)."""
+        size = self.config['JOBS_WORKERS'] if size is None else size
+        if self._pid == os.getpid() or size <= 0:
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._loop, name='jobs-%d' % n, daemon=True)
+                         for n in range(size)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Let each worker finish the job in hand, then end the threads."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def _loop(self):
+        poll = self.config['JOBS_POLL_INTERVAL']
+        while not self._stop.is_set():
+            try:
+                ran = self.work(1, poll)
+            except Exception:
+                logger.exception('job worker error')
+                ran = 0
+            if not ran and self.durable:
+                self._stop.wait(poll)
+
+
+class MemoryQueue(JobQueue):
+    """Jobs in a heap ordered by when they are due, in this process only."""
+
+    def __init__(self, app):
+        super(MemoryQueue, self).__init__(app)
+        self._heap = []
+        self._order = itertools.count()
+        self._ready = threading.Condition()
+
+    def __len__(self):
+        with self._ready:
+            return len(self._heap)
+
+    def put(self, job):
+        with self._ready:
+            heapq.heappush(self._heap, (job.run_at, next(self._order), job))
+            self._ready.notify()
+
+    def submit(self, jobs):
+        self.start()
+        for job in jobs:
+            self.put(job)
+
+    def claim(self, limit, timeout=0):
+        # one job at a time; waits up to ``timeout`` seconds for one to fall due
+        deadline = time.monotonic() + timeout
+        with self._ready:
+            while True:
+                now = datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    job = heapq.heappop(self._heap)[2]
+                    job.attempts += 1
+                    return [job]
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                if self._heap:
+                    left = min(left, (self._heap[0][0] - now).total_seconds())
+                self._ready.wait(left)
+
+    def done(self, job):
+        pass
+
+    def retry(self, job, error, delay):
+        job.run_at = datetime.now() + timedelta(seconds=delay)
+        self.put(job)
+
+    def fail(self, job, error):
+        pass
+
+
+class InlineQueue(JobQueue):
+    """Run jobs as they are submitted, retrying straight away."""
+
+    def submit(self, jobs):
+        for job in jobs:
+            # on a thread of its own, so the handler gets its own session
+            # while the committing one is still finishing its commit
+            worker = threading.Thread(target=self.run_now, args=(job,))
+            worker.start()
+            worker.join()
+
+    def run_now(self, job):
+        while True:
+            job.attempts += 1
+            error = run(self.app, job)
+            if error is None or job.attempts >= self.config['JOBS_MAX_ATTEMPTS']:
+                break
+        if error is not None:
+            logger.error('job %r gave up after %d attempts: %s', job, job.attempts, describe(error))
+
+    def start(self, size=None):
+        pass
+
+
+class DatabaseQueue(JobQueue):
+    """Jobs as rows of the ``jobs`` table, claimed with SKIP LOCKED."""
+
+    durable = True
+
+    def insert(self, connection, jobs):
+        connection.execute(job_table.insert(), [
+            {'name': job.name, 'payload': json.dumps(job.payload), 'run_at': job.run_at} for job in jobs])
+
+    def submit(self, jobs):
+        with db.engine.begin() as connection:
+            self.insert(connection, jobs)
+
+    def claim(self, limit, timeout=0):
+        now = datetime.now()
+        claimable = (job_table.c.failed_at.is_(None) & (job_table.c.run_at <= now)
+                     & or_(job_table.c.locked_until.is_(None), job_table.c.locked_until < now))
+        claimed = []
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                select(job_table.c.id, job_table.c.name, job_table.c.payload, job_table.c.attempts)
+                .where(claimable).order_by(job_table.c.run_at, job_table.c.id).limit(limit)
+                .with_for_update(skip_locked=True)).fetchall()
+            for id, name, payload, attempts in rows:
+                # already ours on Postgres; on SQLite, which has no row locks,
+                # the guard keeps two workers from taking the same row
+                taken = connection.execute(
+                    job_table.update().where((job_table.c.id == id) & claimable)
+                    .values(locked_until=now + timedelta(seconds=self.config['JOBS_LEASE']),
+                            attempts=attempts + 1)).rowcount
+                if taken:
+                    claimed.append(Job(name, json.loads(payload), attempts + 1, id=id))
+        return claimed
+
+    def done(self, job):
+        with db.engine.begin() as connection:
+            connection.execute(job_table.delete().where(job_table.c.id == job.id))
+
+    def retry(self, job, error, delay):
+        with db.engine.begin() as connection:
+            connection.execute(job_table.update().where(job_table.c.id == job.id).values(
+                run_at=datetime.now() + timedelta(seconds=delay), locked_until=None,
+                last_error=describe(error)))
+
+    def fail(self, job, error):
+        with db.engine.begin() as connection:
+            connection.execute(job_table.update().where(job_table.c.id == job.id).values(
+                failed_at=datetime.now(), locked_until=None, last_error=describe(error)))
+
+
+QUEUES = {'memory': MemoryQueue, 'database': DatabaseQueue, 'inline': InlineQueue}
+
+
+class Jobs(object):
+
+    def init_app(self, app):
+        name = app.config.get('JOBS_BACKEND', 'memory')
+        if name not in QUEUES:
+            raise ValueError('unknown JOBS_BACKEND %r, expected one of %s' % (name, ', '.join(sorted(QUEUES))))
+        queue = app.extensions['jobs'] = QUEUES[name](app)
+
+        # started on the first request rather than here, so the threads
+        # belong to the process serving (not a preloading parent that forks)
+        @app.before_request
+        def start_workers():
+            queue.start()
+
+    def defer(self, session, name, **payload):
+        """Run ``name`` once the session's transaction commits."""
+        queue = session.app.extensions.get('jobs')
+        if queue is None:
+            return
+        job = Job(name, payload)
+        if queue.durable:
+            queue.insert(session.connection(), [job])
+        else:
+            session.info.setdefault('jobs', []).append(job)
+
+    def submit(self, name, **payload):
+        """Queue ``name`` now, outside any transaction."""
+        current_app.extensions['jobs'].submit([Job(name, payload)])
+
+
+jobs = Jobs()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _submit_deferred(session):
+    deferred = session.info.pop('jobs', None)
+    if deferred:
+        session.app.extensions['jobs'].submit(deferred)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard(session):
+    session.info.pop('jobs', None)
+
+
+@click.command('worker')
+@click.option('--threads', type=int, help='Worker threads; JOBS_WORKERS by default.')
+@click.option('--once', is_flag=True, help='Run the jobs that are due, then exit.')
+@with_appcontext
+def worker_command(threads, once):
+    """Run queued background jobs (needs JOBS_BACKEND=database)."""
+    queue = current_app.extensions['jobs']
+    if not queue.durable:
+        raise click.UsageError('JOBS_BACKEND=%s runs jobs in the process that queues them; '
+                               'use the database backend for a separate worker'
+                               % current_app.config['JOBS_BACKEND'])
+    threads = threads or current_app.config['JOBS_WORKERS'] or 1
+    if once:
+        ran = 0
+        while True:
+            batch = queue.work(threads)
+            if not batch:
+                break
+            ran += batch
+        click.echo('ran %d jobs' % ran)
+        return
+    queue.start(threads)
+    click.echo('running jobs on %d threads' % threads)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        queue.stop()
@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+
+from model import Show
+
+
+class QueryProfile(object):
+    """How one endpoint loads its object graph, and how many statements that may take."""
+
+    def __init__(self, name, budget, shape):
+        self.name = name
+        self.budget = budget
+        self.shape = shape
+
+    def apply(self, query):
+        return self.shape(query)
+
+
+PROFILES = {}
+
+
+def register(name, budget):
+    def decorator(shape):
+        PROFILES[name] = QueryProfile(name, budget, shape)
+        return shape
+    return decorator
+
+
+@register('venue_detail', budget=8)
+def _venue_detail(query):
+    # ETag, venue, its genres, show counts, then upcoming and past shows plus their artists
+    return query.options(selectinload(Show.artist))
+
+
+@register('artist_detail', budget=8)
+def _artist_detail(query):
+    return query.options(joinedload(Show.venue), selectinload(Show.artist))
+
+
+@register('show_detail', budget=3)
+def _show_detail(query):
+    return query.join(Show.venue).options(contains_eager(Show.venue), selectinload(Show.artist))
+
+
+def apply_profile(query, name):
+    return PROFILES[name].apply(query)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter(object):
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine):
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+@contextmanager
+def query_budget(engine, name, budget=None):
+    """Fail if the wrapped block sends more statements than ``budget``.
+
+    ``budget`` defaults to that of profile ``name``; listings, which render
+    through serializers.py, pass their Serializer's.
+    """
+    if budget is None:
+        budget = PROFILES[name].budget
+    with count_queries(engine) as counter:
+        yield counter
+    if len(counter) > budget:
+        raise QueryBudgetExceeded('%s sent %d statements (budget %d):\n%s' % (
+            name, len(counter), budget, '\n'.join(counter.statements)))
@@ -1,10 +1,16 @@
 import logging
+import os
+import sys
 from logging.config import fileConfig
 
 from flask import current_app
 
 from alembic import context
 
+# revisions import their helpers from this directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from online_ops import LockReport  # noqa: E402
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -62,14 +68,23 @@ def run_migrations_offline():
     Calls to context.execute() here emit the given string to the
     script output.
 
+    Every statement also goes through a LockReport, which is written to
+    stderr at the end; pass table sizes as -x rows=shows:5000000,...
+
     """
     url = config.get_main_option("sqlalchemy.url")
+    report = LockReport(LockReport.parse_rows(
+        context.get_x_argument(as_dictionary=True).get('rows')))
     context.configure(
-        url=url, target_metadata=get_metadata(), literal_binds=True
+        url=url, target_metadata=get_metadata(), literal_binds=True,
+        transaction_per_migration=True,
+        output_buffer=report.tee(config.output_buffer or sys.stdout),
+        on_version_apply=report.version_applied
     )
 
     with context.begin_transaction():
         context.run_migrations()
+    report.write(sys.stderr)
 
 
 def run_migrations_online():
@@ -100,6 +115,7 @@ def run_migrations_online():
         context.configure(
             connection=connection,
             target_metadata=get_metadata(),
+            transaction_per_migration=True,
             **conf_args
         )
 
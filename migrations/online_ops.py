@@ -0,0 +1,352 @@
+"""Schema changes that stay online on large tables, and a lock report for them.
+
+Revisions import these instead of the plain ``op`` calls when a table is big
+enough for a long lock to hurt::
+
+    from online_ops import add_column, backfill, create_index, add_foreign_key, set_not_null
+
+    def upgrade():
+        add_column('shows', sa.Column('hall_id', sa.Integer()))
+        backfill('shows', 'hall_id = (SELECT id FROM hall WHERE hall.venue_id = shows.venue_id)')
+        create_index('ix_shows_hall_id', 'shows', ['hall_id'])
+        add_foreign_key('shows_hall_id_fkey', 'shows', 'hall', ['hall_id'], ['id'])
+        set_not_null('shows', 'hall_id', existing_type=sa.Integer())
+
+Columns go in nullable, which is a catalog-only change; backfills update
+short key ranges, each committed on its own, with a pause in between; indexes
+are built ``CONCURRENTLY`` outside the migration transaction; constraints are
+added ``NOT VALID`` and validated afterwards, which only blocks schema
+changes. Other backends get the plain batch operations.
+
+``flask db upgrade --sql`` writes what each revision would lock, and for how
+long, to stderr (see LockReport). Estimates use row counts passed as
+``-x rows=shows:5000000,venue:200000``.
+"""
+import logging
+import re
+import sys
+import time
+from collections import OrderedDict
+
+from alembic import op
+import sqlalchemy as sa
+
+
+logger = logging.getLogger('alembic.online_ops')
+
+BATCH_SIZE = 1000
+BATCH_PAUSE = 0.05
+BATCH_MARKER = '-- online_ops: batched backfill of %s rows'
+
+
+def _offline():
+    return op.get_context().as_sql
+
+
+def _postgresql():
+    return op.get_context().dialect.name == 'postgresql'
+
+
+def add_column(table, column):
+    """Add ``column`` as nullable; set_not_null it once it is backfilled.
+
+    A constant server default is fine on Postgres 11+ (it is not written to
+    existing rows), a volatile one rewrites the table.
+    """
+    column.nullable = True
+    with op.batch_alter_table(table, schema=None) as batch_op:
+        batch_op.add_column(column)
+
+
+def backfill(table, assignments, where=None, key='id', params=None, batch_size=BATCH_SIZE, pause=BATCH_PAUSE):
+    """``UPDATE table SET assignments`` a ``key`` range at a time.
+
+    Every batch commits on its own, so row locks are held for one batch and
+    the table's writers only wait for that long; ``pause`` seconds between
+    batches leave room for them and for replication. Progress is logged per
+    batch. Offline, one unbatched UPDATE is written, marked as batched for
+    the lock report.
+    """
+    statement = 'UPDATE %s SET %s' % (table, assignments)
+    if where:
+        # parenthesized, so an OR in it cannot escape the key range added below
+        statement += ' WHERE (%s)' % where
+    params = dict(params or {})
+    if _offline():
+        op.get_context().impl.static_output(BATCH_MARKER % batch_size)
+        op.execute(sa.text(statement).bindparams(**params))
+        return
+    statement += (' AND ' if where else ' WHERE ') + '{key} > :low AND {key} <= :high'.format(key=key)
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        low, last = bind.execute(sa.text('SELECT min(%s) - 1, max(%s) FROM %s' % (key, key, table))).first()
+        if last is None:
+            return
+        first, updated, started = low, 0, time.monotonic()
+        while low < last:
+            high = low + batch_size
+            with bind.begin():
+                updated += bind.execute(sa.text(statement), dict(params, low=low, high=high)).rowcount
+            low = high
+            logger.info('backfill %s: %d rows updated, %s %d of %d (%.0f%%) in %.1fs', table, updated, key,
+                        min(high, last), last, 100.0 * (min(high, last) - first) / (last - first),
+                        time.monotonic() - started)
+            time.sleep(pause)
+
+
+def create_index(name, table, columns, unique=False, **kw):
+    """Build an index ``CONCURRENTLY``, outside the migration's transaction.
+
+    A concurrent build that failed half way leaves an invalid index behind,
+    which is dropped first so the revision can simply be run again.
+    """
+    with op.get_context().autocommit_block():
+        if _postgresql() and not _offline():
+            invalid = op.get_bind().execute(sa.text(
+                'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+                'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'), {'name': name}).scalar()
+            if invalid:
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+        op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True, **kw)
+
+
+def drop_index(name, table):
+    with op.get_context().autocommit_block():
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+
+def _validate(table, name):
+    # in a transaction of its own, after the one that added the constraint
+    # (and took its short lock) has committed
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, name))
+
+
+def add_foreign_key(name, source, referent, local_cols, remote_cols, **kw):
+    """Add a foreign key ``NOT VALID`` and validate existing rows afterwards."""
+    if not _postgresql():
+        with op.batch_alter_table(source, schema=None) as batch_op:
+            batch_op.create_foreign_key(name, referent, local_cols, remote_cols, **kw)
+        return
+    op.create_foreign_key(name, source, referent, local_cols, remote_cols, postgresql_not_valid=True, **kw)
+    _validate(source, name)
+
+
+def add_check_constraint(name, table, condition):
+    """Add a check constraint ``NOT VALID`` and validate existing rows afterwards."""
+    if not _postgresql():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_check_constraint(name, condition)
+        return
+    op.create_check_constraint(name, table, condition, postgresql_not_valid=True)
+    _validate(table, name)
+
+
+def set_not_null(table, column, existing_type=None):
+    """Make a backfilled column NOT NULL without scanning under an exclusive lock.
+
+    On Postgres 12+ a validated ``CHECK (column IS NOT NULL)`` lets ``SET NOT
+    NULL`` skip its scan; the check is dropped again afterwards.
+    """
+    if not _postgresql():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column(column, existing_type=existing_type, nullable=False)
+        return
+    check = 'ck_%s_%s_not_null' % (table, column)
+    add_check_constraint(check, table, '%s IS NOT NULL' % column)
+    op.alter_column(table, column, existing_type=existing_type, nullable=False)
+    op.drop_constraint(check, table, type_='check')
+
+
+# Rows per second, measured on Postgres 16 against shows, whose indexes and
+# exclusion constraint make every rewritten row expensive. Other tables are
+# faster, so these err on the long side.
+RATES = {
+    'rewrite': 10000,  # every row written again (ADD COLUMN with a volatile default, ALTER TYPE)
+    'update': 7000,  # UPDATE
+    'index': 1000000,  # CREATE INDEX
+    'scan': 1500000,  # a constraint or NOT NULL checked against every row
+}
+DEFAULT_ROWS = 1000000
+
+# defaults evaluated per row, which rewrite the table when a column is added
+VOLATILE = ('RANDOM(', 'CLOCK_TIMESTAMP(', 'TIMEOFDAY(', 'NEXTVAL(', 'GEN_RANDOM_UUID(', 'UUID_GENERATE_')
+
+# how hard a lock blocks others: ACCESS EXCLUSIVE stops reads too, the rest
+# stop writes; SHARE UPDATE EXCLUSIVE and row locks on batches stop neither
+BLOCKS = {
+    'ACCESS EXCLUSIVE': 'reads and writes',
+    'SHARE ROW EXCLUSIVE': 'writes',
+    'SHARE': 'writes',
+    'ROW EXCLUSIVE': 'writes to the same rows',
+    'SHARE UPDATE EXCLUSIVE': 'schema changes only',
+}
+
+_IDENT = r'"?([\w.]+)"?'
+_ALTER = re.compile(r'ALTER TABLE (?:ONLY )?(?:IF EXISTS )?%s\s+(.*)' % _IDENT, re.S | re.I)
+_INDEX = re.compile(r'CREATE (?:UNIQUE )?INDEX (CONCURRENTLY )?.*? ON (?:ONLY )?%s' % _IDENT, re.S | re.I)
+_DROP_INDEX = re.compile(r'DROP INDEX (CONCURRENTLY )?', re.I)
+_UPDATE = re.compile(r'UPDATE %s SET' % _IDENT, re.I)
+_DELETE = re.compile(r'DELETE FROM %s' % _IDENT, re.I)
+_NOT_NULL_CHECK = re.compile(r'ADD CONSTRAINT %s CHECK \(\s*"?(\w+)"? IS NOT NULL\s*\) NOT VALID' % _IDENT, re.I)
+_VALIDATE = re.compile(r'VALIDATE CONSTRAINT %s' % _IDENT, re.I)
+_SET_NOT_NULL = re.compile(r'ALTER COLUMN "?(\w+)"? SET NOT NULL', re.I)
+_ADD_COLUMN = re.compile(r'ADD (?:COLUMN )?"?(\w+)"? (.*)', re.S | re.I)
+
+
+class Statement(object):
+    """One statement with the strongest lock it takes and for how long."""
+
+    def __init__(self, sql, table=None, lock=None, cost=None, rows=0, note=None, batch=None):
+        self.sql = sql
+        self.table = table
+        self.lock = lock
+        self.cost = cost
+        self.rows = rows
+        self.note = note
+        self.batch = batch
+
+    @property
+    def seconds(self):
+        if self.cost is None or self.lock == 'SHARE UPDATE EXCLUSIVE':
+            return 0.0
+        return float(self.rows) / RATES[self.cost]
+
+
+class LockReport(object):
+    """Classify the SQL an offline run writes, per revision.
+
+    ``tee()`` wraps the output buffer given to ``context.configure`` and
+    ``version_applied`` is its ``on_version_apply`` hook; ``write()`` prints
+    the report once the run is done. Statements are judged by Postgres
+    locking rules; row counts come from ``rows`` (``{table: count}``), other
+    tables are assumed to have DEFAULT_ROWS.
+    """
+
+    def __init__(self, rows=None):
+        self.rows = dict(rows or {})
+        self.revisions = OrderedDict()
+        self.pending = []
+        self.batched = None
+        self.not_null_checks = {}
+        self.proven = set()
+
+    @staticmethod
+    def parse_rows(value):
+        """``{table: count}`` from ``shows:5000000,venue:200000``."""
+        rows = {}
+        for item in (value or '').split(','):
+            if item.strip():
+                table, count = item.split(':')
+                rows[table.strip()] = int(count)
+        return rows
+
+    def tee(self, buffer):
+        report = self
+
+        class Tee(object):
+            def write(self, text):
+                report.feed(text)
+                return buffer.write(text)
+
+            def flush(self):
+                buffer.flush()
+        return Tee()
+
+    def count(self, table):
+        return self.rows.get(table, DEFAULT_ROWS)
+
+    def feed(self, text):
+        sql = text.strip().rstrip(';').strip()
+        if not sql:
+            return
+        if sql.startswith('-- online_ops: batched backfill of '):
+            self.batched = int(sql.split()[-2])
+            return
+        if sql.startswith('--') or 'alembic_version' in sql or sql.upper() in ('BEGIN', 'COMMIT'):
+            return
+        self.pending.append(self.classify(sql))
+
+    def version_applied(self, ctx, step, heads, run_args):
+        label = '%s %s' % (step.up_revision_id, 'upgrade' if step.is_upgrade else 'downgrade')
+        self.revisions[label] = self.pending
+        self.pending = []
+
+    def classify(self, sql):
+        batched, self.batched = self.batched, None
+        match = _INDEX.match(sql)
+        if match:
+            concurrently, table = match.groups()
+            if concurrently:
+                return Statement(sql, table, 'SHARE UPDATE EXCLUSIVE', 'index', self.count(table))
+            return Statement(sql, table, 'SHARE', 'index', self.count(table))
+        match = _DROP_INDEX.match(sql)
+        if match:
+            return Statement(sql, None, 'SHARE UPDATE EXCLUSIVE' if match.group(1) else 'ACCESS EXCLUSIVE')
+        match = _UPDATE.match(sql) or _DELETE.match(sql)
+        if match:
+            table = match.group(1)
+            if batched:
+                return Statement(sql, table, 'ROW EXCLUSIVE', 'update', min(batched, self.count(table)),
+                                 'per batch of %d' % batched, batch=batched)
+            return Statement(sql, table, 'ROW EXCLUSIVE', 'update', self.count(table), 'one transaction')
+        match = _ALTER.match(sql)
+        if match:
+            return self.classify_alter(sql, *match.groups())
+        if re.match(r'(CREATE|DROP) TABLE', sql, re.I):
+            return Statement(sql, None, 'ACCESS EXCLUSIVE')
+        return Statement(sql)
+
+    def classify_alter(self, sql, table, action):
+        rows = self.count(table)
+        match = _NOT_NULL_CHECK.search(action)
+        if match:
+            self.not_null_checks[match.group(1)] = (table, match.group(2))
+        if re.search(r'\bNOT VALID\b', action, re.I):
+            return Statement(sql, table, 'SHARE ROW EXCLUSIVE' if 'FOREIGN KEY' in action.upper()
+                             else 'ACCESS EXCLUSIVE', note='existing rows not checked')
+        match = _VALIDATE.search(action)
+        if match:
+            if match.group(1) in self.not_null_checks:
+                self.proven.add(self.not_null_checks[match.group(1)])
+            return Statement(sql, table, 'SHARE UPDATE EXCLUSIVE', 'scan', rows)
+        match = _SET_NOT_NULL.search(action)
+        if match:
+            if (table, match.group(1)) in self.proven:
+                return Statement(sql, table, 'ACCESS EXCLUSIVE', note='proven by a validated check')
+            return Statement(sql, table, 'ACCESS EXCLUSIVE', 'scan', rows)
+        upper = action.upper()
+        if 'FOREIGN KEY' in upper:
+            return Statement(sql, table, 'SHARE ROW EXCLUSIVE', 'scan', rows)
+        if re.search(r'\b(UNIQUE|PRIMARY KEY|EXCLUDE)\b', upper):
+            return Statement(sql, table, 'ACCESS EXCLUSIVE', 'index', rows)
+        if re.search(r'ADD CONSTRAINT .* CHECK\b', upper):
+            return Statement(sql, table, 'ACCESS EXCLUSIVE', 'scan', rows)
+        if re.search(r'ALTER COLUMN .* TYPE (VARCHAR|TEXT)\b', upper):
+            return Statement(sql, table, 'ACCESS EXCLUSIVE', note='no rewrite if only widening')
+        if re.search(r'ALTER COLUMN .* TYPE\b', upper):
+            return Statement(sql, table, 'ACCESS EXCLUSIVE', 'rewrite', rows)
+        match = _ADD_COLUMN.match(action)
+        if match and not upper.startswith('ADD CONSTRAINT'):
+            definition = match.group(2).upper()
+            if 'GENERATED' in definition and 'STORED' in definition:
+                return Statement(sql, table, 'ACCESS EXCLUSIVE', 'rewrite', rows)
+            if 'SERIAL' in definition or any(call in definition for call in VOLATILE):
+                return Statement(sql, table, 'ACCESS EXCLUSIVE', 'rewrite', rows, 'volatile default')
+            if 'NOT NULL' in definition and 'DEFAULT' not in definition:
+                return Statement(sql, table, 'ACCESS EXCLUSIVE', note='fails unless the table is empty')
+        return Statement(sql, table, 'ACCESS EXCLUSIVE')
+
+    def write(self, out=None):
+        out = out or sys.stderr
+        out.write('-- estimated locks (%s)\n' % ', '.join(
+            ['%s: %d rows' % item for item in sorted(self.rows.items())] + ['others: %d rows' % DEFAULT_ROWS]))
+        for label, statements in self.revisions.items():
+            locking = [s for s in statements if s.lock]
+            blocking = sum(s.seconds for s in locking if not s.batch)
+            out.write('%-22s %8.1fs blocking\n' % (label, blocking))
+            for statement in locking:
+                first_line = ' '.join(statement.sql.split())[:60]
+                out.write('    %-22s %-24s %8.1fs  %s%s\n' % (
+                    statement.lock, BLOCKS[statement.lock], statement.seconds, first_line,
+                    ' (%s)' % statement.note if statement.note else ''))
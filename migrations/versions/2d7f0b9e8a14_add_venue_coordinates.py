@@ -0,0 +1,35 @@
+"""add venue latitude/longitude with a range index
+
+Revision ID: 2d7f0b9e8a14
+Revises: 6c2e8a41f937
+Create Date: 2026-10-18 20:03:55.281906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d7f0b9e8a14'
+down_revision = '6c2e8a41f937'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # nullable without a default, so existing rows are not rewritten;
+    # `flask geocode venues` fills them in afterwards
+    with op.batch_alter_table('venue', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('latitude', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('longitude', sa.Float(), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_venue_latitude_longitude', 'venue', ['latitude', 'longitude'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_venue_latitude_longitude', table_name='venue', postgresql_concurrently=True)
+    with op.batch_alter_table('venue', schema=None) as batch_op:
+        batch_op.drop_column('longitude')
+        batch_op.drop_column('latitude')
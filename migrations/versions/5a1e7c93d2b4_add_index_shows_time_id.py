@@ -0,0 +1,27 @@
+"""add index on shows time, id
+
+Revision ID: 5a1e7c93d2b4
+Revises: d13e50b4dd49
+Create Date: 2026-10-18 09:12:41.503112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1e7c93d2b4'
+down_revision = 'd13e50b4dd49'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keyset pagination of /shows seeks on (time, id)
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.create_index('ix_shows_time_id', ['time', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.drop_index('ix_shows_time_id')
@@ -0,0 +1,63 @@
+"""add recurring show series
+
+Revision ID: 6c2e8a41f937
+Revises: b91e4d7a3c20
+Create Date: 2026-10-18 19:12:40.517203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c2e8a41f937'
+down_revision = 'b91e4d7a3c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('show_series',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), server_default='1', nullable=False),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.Column('rrule', sa.String(length=500), nullable=False),
+    sa.Column('starts_at', sa.DateTime(), nullable=False),
+    sa.Column('ends_at', sa.DateTime(), nullable=True),
+    sa.Column('duration', sa.Integer(), server_default='120', nullable=False),
+    sa.CheckConstraint('duration > 0 AND duration <= 1440', name='ck_show_series_duration'),
+    sa.ForeignKeyConstraint(['venue_id'], ['venue.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_show_series_venue_id_starts_at', 'show_series', ['venue_id', 'starts_at'], unique=False)
+    op.create_table('series_artists',
+    sa.Column('series_id', sa.Integer(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['artist.id'], ),
+    sa.ForeignKeyConstraint(['series_id'], ['show_series.id'], ),
+    sa.PrimaryKeyConstraint('series_id', 'artist_id')
+    )
+    op.create_table('series_cancellations',
+    sa.Column('series_id', sa.Integer(), nullable=False),
+    sa.Column('occurrence', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['series_id'], ['show_series.id'], ),
+    sa.PrimaryKeyConstraint('series_id', 'occurrence')
+    )
+    # both nullable, so adding them does not rewrite shows
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('series_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('occurrence', sa.DateTime(), nullable=True))
+        batch_op.create_foreign_key('shows_series_id_fkey', 'show_series', ['series_id'], ['id'])
+        batch_op.create_unique_constraint('uq_shows_series_id_occurrence', ['series_id', 'occurrence'])
+
+
+def downgrade():
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_shows_series_id_occurrence', type_='unique')
+        batch_op.drop_constraint('shows_series_id_fkey', type_='foreignkey')
+        batch_op.drop_column('occurrence')
+        batch_op.drop_column('series_id')
+    op.drop_table('series_cancellations')
+    op.drop_table('series_artists')
+    op.drop_index('ix_show_series_venue_id_starts_at', table_name='show_series')
+    op.drop_table('show_series')
@@ -0,0 +1,38 @@
+"""add the jobs table for the durable job queue
+
+Revision ID: 7f3c1a9d5b26
+Revises: 2d7f0b9e8a14
+Create Date: 2026-10-18 22:41:07.318254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3c1a9d5b26'
+down_revision = '2d7f0b9e8a14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=120), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('locked_until', sa.DateTime(), nullable=True),
+    sa.Column('failed_at', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # workers only ever look for jobs that have not failed for good
+    op.create_index('ix_jobs_run_at', 'jobs', ['run_at'], unique=False,
+                    postgresql_where=sa.text('failed_at IS NULL'), sqlite_where=sa.text('failed_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_jobs_run_at', table_name='jobs')
+    op.drop_table('jobs')
@@ -0,0 +1,35 @@
+"""add indexes for upcoming/past show split
+
+Revision ID: 8e2f4a6b0c13
+Revises: 5a1e7c93d2b4
+Create Date: 2026-10-18 10:02:17.284519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2f4a6b0c13'
+down_revision = '5a1e7c93d2b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # nothing has indexed shows.venue_id since unique_venue_time was dropped
+    # in 4b1791972076. artist_shows(artist_id, show_id) is already covered by
+    # the primary key, so only the reverse lookup by show_id is missing.
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.create_index('ix_shows_venue_id_time', ['venue_id', 'time'], unique=False)
+
+    with op.batch_alter_table('artist_shows', schema=None) as batch_op:
+        batch_op.create_index('ix_artist_shows_show_id_artist_id', ['show_id', 'artist_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('artist_shows', schema=None) as batch_op:
+        batch_op.drop_index('ix_artist_shows_show_id_artist_id')
+
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.drop_index('ix_shows_venue_id_time')
@@ -0,0 +1,59 @@
+"""add denormalized upcoming/past show counters to venue and artist
+
+Revision ID: a3d81f6c2e57
+Revises: f7b2c9e04d15
+Create Date: 2026-10-18 17:05:31.447920
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_ops import backfill
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d81f6c2e57'
+down_revision = 'f7b2c9e04d15'
+branch_labels = None
+depends_on = None
+
+BACKFILL = {
+    'venue': 'SELECT count(*) FROM shows WHERE shows.venue_id = venue.id AND shows.time %s :mark',
+    'artist': 'SELECT count(*) FROM artist_shows JOIN shows ON shows.id = artist_shows.show_id '
+              'WHERE artist_shows.artist_id = artist.id AND shows.time %s :mark',
+}
+
+
+def upgrade():
+    watermark = op.create_table('show_counter_watermark',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('rolled_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    mark = datetime.now()
+    if op.get_context().as_sql:
+        # --sql output cannot render datetime parameters, so the mark goes in as text
+        mark = mark.isoformat(' ')
+        op.execute(sa.text('INSERT INTO show_counter_watermark (id, rolled_at) VALUES (1, :mark)')
+                   .bindparams(mark=mark))
+    else:
+        op.bulk_insert(watermark, [{'id': 1, 'rolled_at': mark}])
+    for table in ('venue', 'artist'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('upcoming_show_count', sa.Integer(), server_default='0', nullable=False))
+            batch_op.add_column(sa.Column('past_show_count', sa.Integer(), server_default='0', nullable=False))
+        # by id range, a commit per batch, so writers wait on one batch at most;
+        # the correlated counts use ix_shows_venue_id_time and the artist_shows
+        # primary key
+        backfill(table, 'upcoming_show_count = (%s), past_show_count = (%s)'
+                 % (BACKFILL[table] % '>', BACKFILL[table] % '<='), params={'mark': mark})
+
+
+def downgrade():
+    for table in ('artist', 'venue'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('past_show_count')
+            batch_op.drop_column('upcoming_show_count')
+    op.drop_table('show_counter_watermark')
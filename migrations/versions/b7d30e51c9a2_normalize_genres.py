@@ -0,0 +1,116 @@
+"""normalize genres into genre, venue_genres and artist_genres
+
+Revision ID: b7d30e51c9a2
+Revises: 8e2f4a6b0c13
+Create Date: 2026-10-18 11:26:05.917340
+
+"""
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d30e51c9a2'
+down_revision = '8e2f4a6b0c13'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+BATCH_PAUSE = 0.05
+
+# the legacy comma-joined columns stay in place: instances still running the
+# old code read and write only them, current ones write both, and `flask
+# genres sync` (genres.py) catches the new tables up with the old instances'
+# writes once they have stopped
+OWNERS = (
+    ('venue', 'venue_genres', 'venue_id'),
+    ('artist', 'artist_genres', 'artist_id'),
+)
+
+
+def upgrade():
+    op.create_table('genre',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=120), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    for owner, link, owner_id in OWNERS:
+        op.create_table(link,
+        sa.Column(owner_id, sa.Integer(), nullable=False),
+        sa.Column('genre_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint([owner_id], ['%s.id' % owner], ),
+        sa.ForeignKeyConstraint(['genre_id'], ['genre.id'], ),
+        sa.PrimaryKeyConstraint(owner_id, 'genre_id')
+        )
+        op.create_index('ix_%s_genre_id_%s' % (link, owner_id), link, ['genre_id', owner_id], unique=False)
+
+    if context_is_offline():
+        return
+    # copy the legacy values in short, separately committed id-range batches so
+    # readers and writers of venue/artist are never blocked for long
+    with op.get_context().autocommit_block():
+        for owner, link, owner_id in OWNERS:
+            backfill(owner, link, owner_id)
+
+
+def downgrade():
+    for owner, link, owner_id in reversed(OWNERS):
+        op.drop_index('ix_%s_genre_id_%s' % (link, owner_id), table_name=link)
+        op.drop_table(link)
+    op.drop_table('genre')
+
+
+def context_is_offline():
+    return op.get_context().as_sql
+
+
+def backfill(owner, link, owner_id):
+    bind = op.get_bind()
+    last_id = bind.execute(sa.text('SELECT max(id) FROM %s' % owner)).scalar() or 0
+    convert = convert_postgresql if bind.dialect.name == 'postgresql' else convert_generic
+    for low in range(0, last_id, BATCH_SIZE):
+        with bind.begin():
+            convert(bind, owner, link, owner_id, low, low + BATCH_SIZE)
+        time.sleep(BATCH_PAUSE)
+
+
+def convert_postgresql(bind, owner, link, owner_id, low, high):
+    params = {'low': low, 'high': high}
+    bind.execute(sa.text(
+        "INSERT INTO genre (name) "
+        "SELECT DISTINCT btrim(g) FROM {owner}, regexp_split_to_table({owner}.genres, ',') AS g "
+        "WHERE {owner}.id > :low AND {owner}.id <= :high AND btrim(g) <> '' "
+        "ON CONFLICT (name) DO NOTHING".format(owner=owner)), params)
+    bind.execute(sa.text(
+        "INSERT INTO {link} ({owner_id}, genre_id) "
+        "SELECT DISTINCT {owner}.id, genre.id "
+        "FROM {owner}, regexp_split_to_table({owner}.genres, ',') AS g "
+        "JOIN genre ON genre.name = btrim(g) "
+        "WHERE {owner}.id > :low AND {owner}.id <= :high "
+        "ON CONFLICT DO NOTHING".format(owner=owner, link=link, owner_id=owner_id)), params)
+
+
+def convert_generic(bind, owner, link, owner_id, low, high):
+    rows = bind.execute(sa.text(
+        'SELECT id, genres FROM %s WHERE id > :low AND id <= :high AND genres IS NOT NULL' % owner),
+        {'low': low, 'high': high}).fetchall()
+    genre_ids = {}
+    for owner_row_id, genres in rows:
+        for name in set(g.strip() for g in genres.split(',')) - {''}:
+            if name not in genre_ids:
+                genre_ids[name] = bind.execute(
+                    sa.text('SELECT id FROM genre WHERE name = :name'), {'name': name}).scalar()
+            if genre_ids[name] is None:
+                bind.execute(sa.text('INSERT INTO genre (name) VALUES (:name)'), {'name': name})
+                genre_ids[name] = bind.execute(
+                    sa.text('SELECT id FROM genre WHERE name = :name'), {'name': name}).scalar()
+            exists = bind.execute(sa.text(
+                'SELECT 1 FROM %s WHERE %s = :owner AND genre_id = :genre' % (link, owner_id)),
+                {'owner': owner_row_id, 'genre': genre_ids[name]}).scalar()
+            if not exists:
+                bind.execute(sa.text(
+                    'INSERT INTO %s (%s, genre_id) VALUES (:owner, :genre)' % (link, owner_id)),
+                    {'owner': owner_row_id, 'genre': genre_ids[name]})
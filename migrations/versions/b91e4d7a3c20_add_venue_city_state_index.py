@@ -0,0 +1,28 @@
+"""add composite index on venue (city, state)
+
+Revision ID: b91e4d7a3c20
+Revises: a3d81f6c2e57
+Create Date: 2026-10-18 17:48:09.125734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b91e4d7a3c20'
+down_revision = 'a3d81f6c2e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # built concurrently so venue writes are not blocked while it builds
+    with op.get_context().autocommit_block():
+        op.create_index('ix_venue_city_state', 'venue', ['city', 'state'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_venue_city_state', table_name='venue', postgresql_concurrently=True)
@@ -0,0 +1,45 @@
+"""add generated search_vector columns with GIN indexes
+
+Revision ID: c41f8d2e6a70
+Revises: b7d30e51c9a2
+Create Date: 2026-10-18 13:40:52.661208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f8d2e6a70'
+down_revision = 'b7d30e51c9a2'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '')), 'B')"
+)
+
+
+def upgrade():
+    # Postgres only; other backends use the Python fallback in search.py.
+    # Adding a stored generated column rewrites the table, so run this
+    # revision in a maintenance window on large tables.
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    for table in ('venue', 'artist'):
+        op.execute(
+            'ALTER TABLE %s ADD COLUMN search_vector tsvector '
+            'GENERATED ALWAYS AS (%s) STORED' % (table, SEARCH_VECTOR))
+    with op.get_context().autocommit_block():
+        for table in ('venue', 'artist'):
+            op.create_index('ix_%s_search_vector' % table, table, ['search_vector'], unique=False,
+                            postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    for table in ('venue', 'artist'):
+        op.drop_index('ix_%s_search_vector' % table, table_name=table)
+        op.drop_column(table, 'search_vector')
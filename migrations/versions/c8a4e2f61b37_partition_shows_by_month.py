@@ -0,0 +1,137 @@
+"""partition shows by month on Postgres
+
+Revision ID: c8a4e2f61b37
+Revises: 7f3c1a9d5b26
+Create Date: 2026-10-18 23:52:16.204871
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8a4e2f61b37'
+down_revision = '7f3c1a9d5b26'
+branch_labels = None
+depends_on = None
+
+# months created past the current one; `flask partitions ensure` keeps it up
+MONTHS_AHEAD = 3
+
+SLOT_EXCLUSION = (
+    'ALTER TABLE {table} ADD CONSTRAINT {name} EXCLUDE USING gist '
+    "(int4range(venue_id, venue_id, '[]') WITH =, tsrange(time, time + duration * interval '1 minute') WITH &&)")
+SERIES_UNIQUE = 'ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE (series_id, occurrence)'
+
+
+def add_months(month, n):
+    months = month.year * 12 + month.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def partition_constraints(table):
+    # a partitioned table can have neither, so every partition gets its own
+    op.execute(SLOT_EXCLUSION.format(table=table, name=table + '_slot_excl'))
+    op.execute(SERIES_UNIQUE.format(table=table, name='uq_%s_series_id_occurrence' % table))
+
+
+def history_end():
+    """The first month past every existing show, and never before the current one."""
+    this_month = date.today().replace(day=1)
+    if op.get_context().as_sql:
+        # offline there is no telling; VALIDATE below fails if a show is later
+        return add_months(this_month, MONTHS_AHEAD + 1)
+    latest = op.get_bind().execute(sa.text('SELECT max(time) FROM shows')).scalar()
+    if latest is None:
+        return this_month
+    return max(this_month, add_months(latest.date().replace(day=1), 1))
+
+
+def upgrade():
+    # Postgres only: elsewhere shows stays a plain table (see partitions.py).
+    # The existing table becomes the partition shows_history for everything
+    # before history_end(), so no row is copied; months from there on get
+    # partitions of their own.
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    end = history_end()
+
+    # the checks attaching a partition makes are answered by a validated
+    # CHECK matching its bound and by existing indexes and constraints, so
+    # the scans happen here, without blocking reads or writes; a show booked
+    # past the end while this runs is refused by the CHECK
+    with op.get_context().autocommit_block():
+        # left behind by an earlier run that failed
+        op.execute('ALTER TABLE shows DROP CONSTRAINT IF EXISTS ck_shows_history_time')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS shows_history_id_time_key')
+        op.execute("ALTER TABLE shows ADD CONSTRAINT ck_shows_history_time "
+                   "CHECK (time IS NOT NULL AND time < '%s') NOT VALID" % end)
+        op.execute('ALTER TABLE shows VALIDATE CONSTRAINT ck_shows_history_time')
+        op.create_index('shows_history_id_time_key', 'shows', ['id', 'time'], unique=True,
+                        postgresql_concurrently=True)
+
+    # a foreign key cannot reference a partitioned table without the
+    # partition key, which artist_shows does not have
+    op.execute('ALTER TABLE artist_shows DROP CONSTRAINT artist_shows_show_id_fkey')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY NONE')
+    op.execute('ALTER TABLE shows RENAME TO shows_history')
+    op.execute('ALTER TABLE shows_history ADD CONSTRAINT shows_history_id_time_key '
+               'UNIQUE USING INDEX shows_history_id_time_key')
+    # free the names for the parent, and name the rest like other partitions'
+    op.execute('ALTER TABLE shows_history RENAME CONSTRAINT shows_pkey TO shows_history_pkey')
+    op.execute('ALTER INDEX ix_shows_time_id RENAME TO shows_history_time_id_idx')
+    op.execute('ALTER INDEX ix_shows_venue_id_time RENAME TO shows_history_venue_id_time_idx')
+    op.execute('ALTER TABLE shows_history RENAME CONSTRAINT shows_venue_id_slot_excl TO shows_history_slot_excl')
+    op.execute('ALTER TABLE shows_history RENAME CONSTRAINT uq_shows_series_id_occurrence '
+               'TO uq_shows_history_series_id_occurrence')
+
+    op.execute('CREATE TABLE shows (LIKE shows_history INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+               'PARTITION BY RANGE (time)')
+    op.execute('ALTER TABLE shows DROP CONSTRAINT ck_shows_history_time')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY shows.id')
+    # on the empty parent these are instant; attaching reuses the history's
+    # matching indexes and foreign keys instead of building or checking them
+    op.create_primary_key('shows_pkey', 'shows', ['id', 'time'])
+    op.create_index('ix_shows_time_id', 'shows', ['time', 'id'], unique=False)
+    op.create_index('ix_shows_venue_id_time', 'shows', ['venue_id', 'time'], unique=False)
+    op.create_foreign_key('shows_venue_id_fkey', 'shows', 'venue', ['venue_id'], ['id'])
+    op.create_foreign_key('shows_series_id_fkey', 'shows', 'show_series', ['series_id'], ['id'])
+    op.execute("ALTER TABLE shows ATTACH PARTITION shows_history FOR VALUES FROM (MINVALUE) TO ('%s')" % end)
+    op.execute('ALTER TABLE shows_history DROP CONSTRAINT ck_shows_history_time')
+
+    names = []
+    month = end
+    while month <= add_months(date.today().replace(day=1), MONTHS_AHEAD):
+        names.append('shows_%04d_%02d' % (month.year, month.month))
+        op.execute("CREATE TABLE %s PARTITION OF shows FOR VALUES FROM ('%s') TO ('%s')"
+                   % (names[-1], month, add_months(month, 1)))
+        month = add_months(month, 1)
+    names.append('shows_default')
+    op.execute('CREATE TABLE shows_default PARTITION OF shows DEFAULT')
+    for name in names:
+        partition_constraints(name)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    # the history takes back the rows of the monthly partitions
+    op.execute('ALTER TABLE shows DETACH PARTITION shows_history')
+    op.execute('INSERT INTO shows_history SELECT * FROM shows')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY NONE')
+    # takes every remaining partition with it
+    op.execute('DROP TABLE shows')
+    op.execute('ALTER TABLE shows_history RENAME TO shows')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY shows.id')
+
+    op.execute('ALTER TABLE shows DROP CONSTRAINT shows_history_id_time_key')
+    op.execute('ALTER TABLE shows RENAME CONSTRAINT shows_history_pkey TO shows_pkey')
+    op.execute('ALTER INDEX shows_history_time_id_idx RENAME TO ix_shows_time_id')
+    op.execute('ALTER INDEX shows_history_venue_id_time_idx RENAME TO ix_shows_venue_id_time')
+    op.execute('ALTER TABLE shows RENAME CONSTRAINT shows_history_slot_excl TO shows_venue_id_slot_excl')
+    op.execute('ALTER TABLE shows RENAME CONSTRAINT uq_shows_history_series_id_occurrence '
+               'TO uq_shows_series_id_occurrence')
+    # links to shows archived while partitioned went with them (see partitions.archive)
+    op.create_foreign_key('artist_shows_show_id_fkey', 'artist_shows', 'shows', ['show_id'], ['id'])
@@ -0,0 +1,36 @@
+"""widen the legacy genres columns that current instances write again
+
+Revision ID: d5e1f7a93b60
+Revises: c8a4e2f61b37
+Create Date: 2026-10-19 09:14:32.508117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e1f7a93b60'
+down_revision = 'c8a4e2f61b37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the app keeps the comma-joined column current for instances that still
+    # read it (see genres.py), and joined names can run past 120 characters;
+    # varchar to text needs no rewrite on Postgres, and SQLite ignores lengths
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    for table in ('venue', 'artist'):
+        op.alter_column(table, 'genres', existing_type=sa.String(length=120), type_=sa.Text(),
+                        existing_nullable=True)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    for table in ('venue', 'artist'):
+        op.execute('UPDATE %s SET genres = left(genres, 120) WHERE length(genres) > 120' % table)
+        op.alter_column(table, 'genres', existing_type=sa.Text(), type_=sa.String(length=120),
+                        existing_nullable=True)
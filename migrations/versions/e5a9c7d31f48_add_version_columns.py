@@ -0,0 +1,30 @@
+"""add version columns for optimistic locking and ETags
+
+Revision ID: e5a9c7d31f48
+Revises: c41f8d2e6a70
+Create Date: 2026-10-18 15:02:17.318540
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9c7d31f48'
+down_revision = 'c41f8d2e6a70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a constant server default is a metadata-only change on Postgres 11+,
+    # so existing rows start at version 1 without rewriting the tables
+    for table in ('venue', 'artist', 'shows'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    for table in ('shows', 'artist', 'venue'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('version')
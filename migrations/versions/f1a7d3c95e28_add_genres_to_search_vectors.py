@@ -0,0 +1,64 @@
+"""fold genre names into the search_vector columns
+
+Revision ID: f1a7d3c95e28
+Revises: d5e1f7a93b60
+Create Date: 2026-10-19 10:02:47.183560
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a7d3c95e28'
+down_revision = 'd5e1f7a93b60'
+branch_labels = None
+depends_on = None
+
+# genres is the comma-joined column the app keeps current (see genres.py);
+# with it in the vector a whole search is one @@ match on the GIN index
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(genres, '')), 'C')"
+)
+PREVIOUS_SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '')), 'B')"
+)
+
+
+def replace_search_vector(expression):
+    # a generated column's expression cannot be altered before Postgres 17, so
+    # it is added again, which rewrites the table: like c41f8d2e6a70, run this
+    # revision in a maintenance window on large tables
+    for table in ('venue', 'artist'):
+        op.drop_index('ix_%s_search_vector' % table, table_name=table)
+        op.drop_column(table, 'search_vector')
+        op.execute(
+            'ALTER TABLE %s ADD COLUMN search_vector tsvector '
+            'GENERATED ALWAYS AS (%s) STORED' % (table, expression))
+    with op.get_context().autocommit_block():
+        for table in ('venue', 'artist'):
+            op.create_index('ix_%s_search_vector' % table, table, ['search_vector'], unique=False,
+                            postgresql_using='gin', postgresql_concurrently=True)
+
+
+def upgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    # rows written before the app kept the column again (see genres.py)
+    for table, link, owner_id in (('venue', 'venue_genres', 'venue_id'), ('artist', 'artist_genres', 'artist_id')):
+        op.execute(
+            "UPDATE {table} SET genres = linked.names FROM ("
+            "SELECT {link}.{owner_id} AS id, string_agg(genre.name, ',' ORDER BY genre.name) AS names "
+            "FROM {link} JOIN genre ON genre.id = {link}.genre_id GROUP BY {link}.{owner_id}) AS linked "
+            "WHERE {table}.id = linked.id AND {table}.genres IS NULL".format(
+                table=table, link=link, owner_id=owner_id))
+    replace_search_vector(SEARCH_VECTOR)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    replace_search_vector(PREVIOUS_SEARCH_VECTOR)
@@ -0,0 +1,52 @@
+"""add show duration and forbid overlapping shows at a venue
+
+Revision ID: f7b2c9e04d15
+Revises: e5a9c7d31f48
+Create Date: 2026-10-18 16:21:44.902113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7b2c9e04d15'
+down_revision = 'e5a9c7d31f48'
+branch_labels = None
+depends_on = None
+
+OVERLAPS = """
+SELECT a.id, b.id FROM shows a JOIN shows b
+  ON a.venue_id = b.venue_id AND a.id < b.id
+ AND tsrange(a.time, a.time + a.duration * interval '1 minute')
+  && tsrange(b.time, b.time + b.duration * interval '1 minute')
+LIMIT 20
+"""
+
+
+def upgrade():
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('duration', sa.Integer(), server_default='120', nullable=False))
+        batch_op.create_check_constraint('ck_shows_duration', 'duration > 0 AND duration <= 1440')
+
+    # Postgres only; elsewhere booking.ensure_free is the only guard.
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    # 4b1791972076 dropped unique_venue_time, so existing rows may overlap;
+    # those have to be rescheduled by hand before the constraint can be built
+    # (checked only when migrating a live database, not when writing --sql)
+    clashes = [] if op.get_context().as_sql else op.get_bind().execute(sa.text(OVERLAPS)).fetchall()
+    if clashes:
+        raise RuntimeError('overlapping shows must be fixed first: %s'
+                           % ', '.join('%d/%d' % tuple(pair) for pair in clashes))
+    op.execute(
+        'ALTER TABLE shows ADD CONSTRAINT shows_venue_id_slot_excl EXCLUDE USING gist '
+        "(int4range(venue_id, venue_id, '[]') WITH =, tsrange(time, time + duration * interval '1 minute') WITH &&)")
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE shows DROP CONSTRAINT shows_venue_id_slot_excl')
+    with op.batch_alter_table('shows', schema=None) as batch_op:
+        batch_op.drop_constraint('ck_shows_duration', type_='check')
+        batch_op.drop_column('duration')
@@ -1,21 +1,133 @@
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import object_session, relationship
 
-db = SQLAlchemy()
+from database import Database
+from routing import RoutingSession
+
+db = Database()
 
 
 
 artist_shows = db.Table('artist_shows',
     db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'), primary_key=True),
-    db.Column('show_id', db.Integer, db.ForeignKey('shows.id'), primary_key=True)
+    db.Column('show_id', db.Integer, db.ForeignKey('shows.id'), primary_key=True),
+    db.Index('ix_artist_shows_show_id_artist_id', 'show_id', 'artist_id')
+)
+venue_genres = db.Table('venue_genres',
+    db.Column('venue_id', db.Integer, db.ForeignKey('venue.id'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id'), primary_key=True),
+    db.Index('ix_venue_genres_genre_id_venue_id', 'genre_id', 'venue_id')
+)
+artist_genres = db.Table('artist_genres',
+    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id'), primary_key=True),
+    db.Index('ix_artist_genres_genre_id_artist_id', 'genre_id', 'artist_id')
+)
+series_artists = db.Table('series_artists',
+    db.Column('series_id', db.Integer, db.ForeignKey('show_series.id'), primary_key=True),
+    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'), primary_key=True),
 )
-class Venue(db.Model):
+# occurrences of a series that will not take place
+series_cancellations = db.Table('series_cancellations',
+    db.Column('series_id', db.Integer, db.ForeignKey('show_series.id'), primary_key=True),
+    db.Column('occurrence', db.DateTime, primary_key=True),
+)
+# shows after rolled_at count as upcoming in the show counters (see counters.py);
+# it starts at the epoch, so every show is upcoming until the first roll
+show_counter_watermark = db.Table('show_counter_watermark',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('rolled_at', db.DateTime, nullable=False),
+)
+event.listen(show_counter_watermark, 'after_create', DDL(
+    "INSERT INTO show_counter_watermark (id, rolled_at) VALUES (1, '1970-01-01 00:00:00')"))
+# the durable job queue (see jobs.py): a row is due at run_at unless a
+# worker's lease on it (locked_until) is still running; failed_at marks a
+# job that ran out of attempts; finished jobs are deleted
+jobs = db.Table('jobs',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('name', db.String(120), nullable=False),
+    db.Column('payload', db.Text, nullable=False),
+    db.Column('attempts', db.Integer, nullable=False, server_default='0'),
+    db.Column('run_at', db.DateTime, nullable=False),
+    db.Column('locked_until', db.DateTime),
+    db.Column('failed_at', db.DateTime),
+    db.Column('last_error', db.Text),
+    db.Index('ix_jobs_run_at', 'run_at', postgresql_where=db.text('failed_at IS NULL'),
+             sqlite_where=db.text('failed_at IS NULL')),
+)
+
+
+def split_genres(value):
+    """Accept a comma-joined string or an iterable of names; return unique, stripped names."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    names = []
+    for name in value:
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+class Genre(db.Model):
+    __tablename__ = 'genre'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False, unique=True)
+
+    @classmethod
+    def resolve(cls, value, session=None):
+        """Return Genre rows for ``value``, creating the ones that do not exist yet.
+
+        Missing names are inserted with ON CONFLICT DO NOTHING and selected
+        again, so two writers introducing the same name both end up with the
+        one row instead of a unique violation at flush.
+        """
+        names = split_genres(value)
+        if not names:
+            return []
+        session = session or db.session
+        with session.no_autoflush:
+            found = {genre.name: genre for genre in session.query(cls).filter(cls.name.in_(names))}
+            missing = [name for name in names if name not in found]
+            if missing:
+                dialect = postgresql if session.get_bind().dialect.name == 'postgresql' else sqlite
+                session.execute(dialect.insert(cls.__table__).on_conflict_do_nothing(index_elements=['name']),
+                                [{'name': name} for name in missing])
+                found.update((genre.name, genre) for genre in session.query(cls).filter(cls.name.in_(missing)))
+        return [found[name] for name in names]
+
+
+class GenresMixin(object):
+    # `genres` reads as a list of names and accepts a list or a comma-joined string;
+    # genre_names mirrors it into the legacy comma-joined `genres` column (see
+    # sync_genre_names)
+
+    @property
+    def genres(self):
+        return [genre.name for genre in self.genre_rows]
+
+    @genres.setter
+    def genres(self, value):
+        self.genre_rows = Genre.resolve(value, object_session(self))
+
+
+class Venue(GenresMixin, db.Model):
     __tablename__ = 'venue'
+    __table_args__ = (
+        db.Index('ix_venue_city_state', 'city', 'state'),
+        db.Index('ix_venue_latitude_longitude', 'latitude', 'longitude'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     name = db.Column(db.String)
-    city = db.Column(db.String(120))
-    state = db.Column(db.String(120))
+    # active history keeps the old region around for cache invalidation
+    city = db.column_property(db.Column(db.String(120)), active_history=True)
+    state = db.column_property(db.Column(db.String(120)), active_history=True)
     address = db.Column(db.String(120))
     phone = db.Column(db.String(120))
     image_link = db.Column(db.String(500))
@@ -23,8 +135,15 @@ class Venue(db.Model):
     website_link = db.Column(db.String(500))
     look_talent = db.Column(db.String(2))
     seek_des = db.Column(db.String(500))
-    genres = db.Column(db.String(120))
+    # degrees, filled in by the geocoder (see geo.py); NULL until it finds the address
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    upcoming_show_count = db.Column(db.Integer, nullable=False, server_default='0')
+    past_show_count = db.Column(db.Integer, nullable=False, server_default='0')
+    genre_names = db.Column('genres', db.Text)
+    genre_rows = db.relationship('Genre', secondary=venue_genres, order_by='Genre.name', lazy=True)
     shows = db.relationship('Show', backref='venue', lazy=True)
+    __mapper_args__ = {'version_id_col': version}
     def __init__(self, name, city, state, address, phone, image_link, facebook_link, website_link, look_talent, seek_des, genres):
         self.name = name
         self.city = city
@@ -38,20 +157,45 @@ class Venue(db.Model):
         self.seek_des = seek_des
         self.genres = genres
 
-class Artist(db.Model):
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'city': self.city,
+            'state': self.state,
+            'address': self.address,
+            'phone': self.phone,
+            'image_link': self.image_link,
+            'facebook_link': self.facebook_link,
+            'website_link': self.website_link,
+            'look_talent': self.look_talent,
+            'seek_des': self.seek_des,
+            'genres': self.genres,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'upcoming_show_count': self.upcoming_show_count,
+            'past_show_count': self.past_show_count,
+        }
+
+class Artist(GenresMixin, db.Model):
     __tablename__ = 'artist'
 
     id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     name = db.Column(db.String)
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     phone = db.Column(db.String(120))
-    genres = db.Column(db.String(120))
+    genre_rows = db.relationship('Genre', secondary=artist_genres, order_by='Genre.name', lazy=True)
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     website_link = db.Column(db.String(500))
     seeking_venue = db.Column(db.String(2))
     seek_des = db.Column(db.String(500))
+    upcoming_show_count = db.Column(db.Integer, nullable=False, server_default='0')
+    past_show_count = db.Column(db.Integer, nullable=False, server_default='0')
+    genre_names = db.Column('genres', db.Text)
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, name, city, state, address, phone, image_link, facebook_link, website_link, seeking_venue, seek_des, genres):
         self.name = name
@@ -66,16 +210,132 @@ class Artist(db.Model):
         self.seek_des = seek_des
         self.genres = genres
 
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'city': self.city,
+            'state': self.state,
+            'phone': self.phone,
+            'genres': self.genres,
+            'image_link': self.image_link,
+            'facebook_link': self.facebook_link,
+            'website_link': self.website_link,
+            'seeking_venue': self.seeking_venue,
+            'seek_des': self.seek_des,
+            'upcoming_show_count': self.upcoming_show_count,
+            'past_show_count': self.past_show_count,
+        }
+
+# On Postgres the table is partitioned by month (migration c8a4e2f61b37, see
+# partitions.py) with the primary key (id, time), and artist_shows.show_id has
+# no foreign key; create_all still builds the plain table declared here.
 class Show(db.Model):
     __tablename__ = 'shows'
+    __table_args__ = (
+        db.Index('ix_shows_time_id', 'time', 'id'),
+        db.Index('ix_shows_venue_id_time', 'venue_id', 'time'),
+        db.CheckConstraint('duration > 0 AND duration <= 1440', name='ck_shows_duration'),
+        db.UniqueConstraint('series_id', 'occurrence', name='uq_shows_series_id_occurrence'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     time = db.Column(db.DateTime, nullable=False)
+    duration = db.Column(db.Integer, nullable=False, server_default='120')  # minutes
     venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'), nullable=False)
-    artist = db.relationship('Artist', secondary=artist_shows, lazy='subquery', backref=db.backref('shows', lazy=True))
+    # set when this row is an edited occurrence of a series; `occurrence` is
+    # the start the series rule gave it, which `time` may since have moved from
+    series_id = db.Column(db.Integer, db.ForeignKey('show_series.id'))
+    occurrence = db.Column(db.DateTime)
+    artist = db.relationship('Artist', secondary=artist_shows, lazy='select', backref=db.backref('shows', lazy=True))
+    __mapper_args__ = {'version_id_col': version}
     def __init__(self, venue_id, artist_id, time):
         self.time = time
         self.venue_id = venue_id
         self.artist_id = artist_id
 
+    def format(self):
+        return {
+            'id': self.id,
+            'venue_id': self.venue_id,
+            'time': self.time.isoformat(),
+            'duration': self.duration,
+            'artist_ids': [artist.id for artist in self.artist],
+            'series_id': self.series_id,
+        }
+
+
+class ShowSeries(db.Model):
+    """A recurring show; occurrences are expanded from ``rrule`` on demand (see series.py)."""
+    __tablename__ = 'show_series'
+    __table_args__ = (
+        db.Index('ix_show_series_venue_id_starts_at', 'venue_id', 'starts_at'),
+        db.CheckConstraint('duration > 0 AND duration <= 1440', name='ck_show_series_duration'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'), nullable=False)
+    rrule = db.Column(db.String(500), nullable=False)  # RFC 5545 RRULE, COUNT stored as UNTIL
+    starts_at = db.Column(db.DateTime, nullable=False)
+    ends_at = db.Column(db.DateTime)  # end of the last occurrence; NULL while the rule is open-ended
+    duration = db.Column(db.Integer, nullable=False, server_default='120')  # minutes
+    artists = db.relationship('Artist', secondary=series_artists, order_by='Artist.id', lazy='select')
+    __mapper_args__ = {'version_id_col': version}
+
+    def format(self):
+        return {
+            'id': self.id,
+            'venue_id': self.venue_id,
+            'rrule': self.rrule,
+            'starts_at': self.starts_at.isoformat(),
+            'ends_at': self.ends_at.isoformat() if self.ends_at else None,
+            'duration': self.duration,
+            'artist_ids': [artist.id for artist in self.artists],
+        }
+
+
+# what search.py matches on Postgres; see migration f1a7d3c95e28
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(city, '') || ' ' || coalesce(state, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(genres, '')), 'C')"
+)
+for _table in (Venue.__table__, Artist.__table__):
+    event.listen(_table, 'after_create', DDL(
+        'ALTER TABLE %(table)s ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (' + SEARCH_VECTOR + ') STORED'
+    ).execute_if(dialect='postgresql'))
+    event.listen(_table, 'after_create', DDL(
+        'CREATE INDEX ix_%(table)s_search_vector ON %(table)s USING gin (search_vector)'
+    ).execute_if(dialect='postgresql'))
+
+# no two shows at a venue may overlap; see migration f7b2c9e04d15
+event.listen(Show.__table__, 'after_create', DDL(
+    'ALTER TABLE shows ADD CONSTRAINT shows_venue_id_slot_excl EXCLUDE USING gist '
+    "(int4range(venue_id, venue_id, '[]') WITH =, tsrange(time, time + duration * interval '1 minute') WITH &&)"
+).execute_if(dialect='postgresql'))
+
+
+# collections that are part of a resource's representation
+VERSIONED_COLLECTIONS = {Venue: 'genre_rows', Artist: 'genre_rows', Show: 'artist', ShowSeries: 'artists'}
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def sync_genre_names(session, flush_context, instances):
+    # instances that predate the genre tables read and write only the
+    # comma-joined column, so keep it current for them; `flask genres sync`
+    # carries their writes over to the genre tables
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, GenresMixin) and inspect(obj).attrs.genre_rows.history.has_changes():
+            obj.genre_names = ','.join(sorted(obj.genres))
+
 
+@event.listens_for(RoutingSession, 'before_flush')
+def bump_versions(session, flush_context, instances):
+    # changing only genres or a show's artists emits no UPDATE of the row, so
+    # bump the version by hand to keep ETags and If-Match checks honest
+    for obj in session.dirty:
+        key = VERSIONED_COLLECTIONS.get(type(obj))
+        if key is not None and inspect(obj).attrs[key].history.has_changes():
+            obj.version = obj.version + 1
@@ -0,0 +1,76 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError('cannot encode %r in a cursor' % (value,))
+
+
+def _object_hook(obj):
+    if '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    return obj
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), default=_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, types):
+    """Decode ``token`` into one value of each of ``types``, in order."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw, object_hook=_object_hook)
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+    if not isinstance(values, list) or len(values) != len(types):
+        raise InvalidCursor(token)
+    for value, kind in zip(values, types):
+        # JSON true and false decode to bools, which pass for ints
+        if not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+            raise InvalidCursor(token)
+    return values
+
+
+def page_size(value, default, maximum):
+    if value is None:
+        return default
+    try:
+        size = int(value)
+    except ValueError:
+        raise InvalidCursor(value)
+    if size < 1:
+        raise InvalidCursor(value)
+    return min(size, maximum)
+
+
+def keyset_page(query, columns, cursor=None, limit=20):
+    """Return one page of ``query`` ordered by ``columns`` and the cursor for the next one.
+
+    The cursor carries the sort key of the last row, so every page is a single
+    index range scan (``WHERE (a, b) > (:a, :b) ORDER BY a, b LIMIT n``) no matter
+    how deep into the listing it is.
+    """
+    if cursor:
+        values = decode_cursor(cursor, [column.type.python_type for column in columns])
+        if len(columns) == 1:
+            query = query.filter(columns[0] > values[0])
+        else:
+            query = query.filter(tuple_(*columns) > tuple_(*values))
+    rows = query.order_by(*columns).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, c.key) for c in columns)
+    return rows, next_cursor
@@ -0,0 +1,353 @@
+"""Monthly partitions of the shows table, and archives of past months.
+
+On Postgres, migration c8a4e2f61b37 makes ``shows`` a table partitioned by
+RANGE (time): the table as it was becomes ``shows_history``, holding every
+month up to the one after its latest show, later months get a partition each
+named ``shows_YYYY_MM``, and ``shows_default`` takes rows in months that have
+none yet. Queries that bound ``time`` (upcoming shows, the slot checks of a
+booking, calendars, availability, counter rolls) are pruned to the months they
+can reach, so their cost follows those months rather than all of the history
+kept.
+
+Postgres 16 cannot put the overlap exclusion or the (series_id, occurrence)
+uniqueness on a partitioned table, so each partition has its own: two shows
+in different months are not checked against each other by the database.
+Bookings still are, under booking.lock_venue; only a bulk import can slip a
+show across midnight at the turn of a month onto one that starts there.
+
+``flask partitions ensure`` (run it from cron, like ``flask counters roll``)
+creates the partitions through PARTITION_MONTHS_AHEAD months from now and
+moves rows out of the default partition into partitions of their own.
+``flask partitions archive`` writes every month older than
+PARTITION_ARCHIVE_MONTHS to PARTITION_ARCHIVE_DIR as ``shows_YYYY_MM.csv.gz``
+in the format of ``flask export shows --format csv``, then drops the month:
+its partition, the artist links of its shows and its share of the show
+counters. ``flask partitions query`` searches the archives, and ``flask
+import shows`` loads one back. Archiving works on other databases too; there
+the month's rows are deleted from the plain table.
+"""
+import csv
+import gzip
+import json
+import os
+import re
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text
+
+import counters
+from database import is_partitioned
+from export import encode, gzipped, show_records
+from model import db, Venue, Artist, Show, artist_shows
+
+
+PARTITION_NAME = re.compile(r'^shows_(\d{4})_(\d{2})$')
+HISTORY = 'shows_history'
+HISTORY_BOUND = re.compile(r"TO \('(\d{4})-(\d{2})-01")
+ARCHIVE_NAME = re.compile(r'^shows_(\d{4})_(\d{2})(?:\.\d+)?\.csv\.gz$')
+
+SLOT_EXCLUSION = (
+    'ALTER TABLE {table} ADD CONSTRAINT {table}_slot_excl EXCLUDE USING gist '
+    "(int4range(venue_id, venue_id, '[]') WITH =, tsrange(time, time + duration * interval '1 minute') WITH &&)")
+SERIES_UNIQUE = 'ALTER TABLE {table} ADD CONSTRAINT uq_{table}_series_id_occurrence UNIQUE (series_id, occurrence)'
+# seconds archive_month waits for the lock on shows that detaching needs
+DETACH_LOCK_TIMEOUT = 5
+PARTITIONS = """
+SELECT child.relname, child.reltuples FROM pg_inherits
+  JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+  JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+ WHERE parent.relname = 'shows' AND parent.relkind = 'p'
+"""
+
+
+def add_months(month, n):
+    months = month.year * 12 + month.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def month_of(value):
+    return date(value.year, value.month, 1)
+
+
+def month_bounds(month):
+    """The ``[start, end)`` datetimes of ``month``."""
+    end = add_months(month, 1)
+    return datetime(month.year, month.month, 1), datetime(end.year, end.month, 1)
+
+
+def partition_name(month):
+    return 'shows_%04d_%02d' % (month.year, month.month)
+
+
+def partitions(connection):
+    """``{month: estimated rows}`` of the month partitions, oldest first."""
+    found = {}
+    for name, rows in connection.execute(text(PARTITIONS)):
+        match = PARTITION_NAME.match(name)
+        if match:
+            found[date(int(match.group(1)), int(match.group(2)), 1)] = max(int(rows), 0)
+    return dict(sorted(found.items()))
+
+
+def history_end(connection):
+    """The month ``shows_history`` runs up to (exclusive), or None without one."""
+    bound = connection.execute(text(
+        'SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE relname = :name AND relispartition'),
+        {'name': HISTORY}).scalar()
+    match = bound and HISTORY_BOUND.search(bound)
+    return match and date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def create_partition(connection, month):
+    """Add the partition of ``month``, moving its rows out of the default partition."""
+    table = partition_name(month)
+    start, end = month_bounds(month)
+    # Postgres refuses to attach a range the default partition has rows in
+    connection.execute(text(
+        'CREATE TEMPORARY TABLE shows_moving AS '
+        'WITH moved AS (DELETE FROM shows_default WHERE time >= :start AND time < :end RETURNING *) '
+        'SELECT * FROM moved'), {'start': start, 'end': end})
+    connection.execute(text("CREATE TABLE %s PARTITION OF shows FOR VALUES FROM ('%s') TO ('%s')"
+                            % (table, start, end)))
+    connection.execute(text(SLOT_EXCLUSION.format(table=table)))
+    connection.execute(text(SERIES_UNIQUE.format(table=table)))
+    moved = connection.execute(text('INSERT INTO shows SELECT * FROM shows_moving')).rowcount
+    connection.execute(text('DROP TABLE shows_moving'))
+    return moved
+
+
+def ensure(connection, ahead, today=None):
+    """Create the partitions missing through ``ahead`` months from ``today``.
+
+    Months with rows in the default partition get one as well, past months
+    included; months that ``shows_history`` covers do not. Returns
+    ``[(month, rows moved out of the default partition)]``.
+    """
+    this_month = month_of(today or date.today())
+    wanted = {add_months(this_month, n) for n in range(ahead + 1)}
+    wanted.update(month_of(value) for value in connection.execute(text(
+        "SELECT DISTINCT date_trunc('month', time) FROM shows_default")).scalars())
+    existing = partitions(connection)
+    start = history_end(connection) or date.min
+    return [(month, create_partition(connection, month)) for month in sorted(wanted)
+            if month not in existing and month >= start]
+
+
+def archive_path(directory, month):
+    # a month archived again (its shows were imported back) gets a new file
+    path = os.path.join(directory, partition_name(month) + '.csv.gz')
+    n = 0
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(directory, '%s.%d.csv.gz' % (partition_name(month), n))
+    return path
+
+
+def archive_months(connection, before):
+    """The months with shows (or a partition) that end by ``before``, oldest first."""
+    if is_partitioned(connection, 'shows'):
+        history = _months_with_shows(connection, min(before, history_end(connection) or date.min))
+        return history + [month for month in partitions(connection) if add_months(month, 1) <= before]
+    return _months_with_shows(connection, before)
+
+
+def _months_with_shows(connection, before):
+    oldest = connection.execute(select(func.min(Show.time))).scalar()
+    months, month = [], oldest and month_of(oldest)
+    while month is not None and add_months(month, 1) <= before:
+        start, end = month_bounds(month)
+        if connection.execute(select(Show.id).where(Show.time >= start, Show.time < end).limit(1)).first():
+            months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def archive_month(connection, month, path, batch_size=1000):
+    """Write the shows of ``month`` to ``path`` + ``.partial`` and remove them.
+
+    Returns ``(partial path, show ids, venue ids, artist ids)``; an empty
+    month's partition is dropped without writing a file, and the partial path
+    is None. The caller renames the file to ``path`` once the transaction has
+    committed (see publish), so a month still in the database never has an
+    archive; a ``.partial`` file whose month is gone is complete, only
+    unpublished. A month of ``shows_history`` is deleted from it rather than
+    detached.
+    """
+    start, end = month_bounds(month)
+    within = (Show.time >= start) & (Show.time < end)
+    partitioned = is_partitioned(connection, 'shows')
+    in_history = partitioned and month < (history_end(connection) or date.min)
+    # the share lock keeps a roll from moving the watermark under the deltas
+    mark = counters.watermark(connection, 'share')
+    if partitioned:
+        # nothing may be written to the month between its export and its removal
+        connection.execute(text('LOCK TABLE %s IN SHARE MODE' % (HISTORY if in_history else partition_name(month))))
+    partial = path + '.partial'
+    show_ids = []
+
+    def noted(records):
+        for record in records:
+            show_ids.append(record['id'])
+            yield record
+
+    records = show_records(connection, batch_size, within)
+    try:
+        with open(partial, 'wb') as stream:
+            chunks = encode(noted(records), 'shows', 'csv', batch_size)
+            for chunk in gzipped(piece.encode('utf-8') for piece in chunks):
+                stream.write(chunk)
+    finally:
+        records.close()
+    if not show_ids:
+        os.remove(partial)
+        partial = None
+
+    deltas = {}
+    venue_ids, artist_ids = set(), set()
+    for model, owner, statement in (
+            (Venue, Show.venue_id, select(Show.venue_id, Show.time > mark, func.count())),
+            (Artist, artist_shows.c.artist_id,
+             select(artist_shows.c.artist_id, Show.time > mark, func.count())
+             .select_from(artist_shows.join(Show, Show.id == artist_shows.c.show_id)))):
+        for id, upcoming, n in connection.execute(statement.where(within).group_by(owner, Show.time > mark)):
+            name = counters.UPCOMING if upcoming else counters.PAST
+            deltas.setdefault((model, name), {})[id] = -n
+            (venue_ids if model is Venue else artist_ids).add(id)
+    counters.apply_deltas(connection, deltas)
+
+    connection.execute(artist_shows.delete().where(
+        artist_shows.c.show_id.in_(select(Show.id).where(within).scalar_subquery())))
+    if partitioned and not in_history:
+        table = partition_name(month)
+        # detaching locks all of shows; give up rather than queue every
+        # query behind a long transaction (run the archive again later)
+        connection.execute(text("SET LOCAL lock_timeout = '%ds'" % DETACH_LOCK_TIMEOUT))
+        connection.execute(text('ALTER TABLE shows DETACH PARTITION %s' % table))
+        connection.execute(text('DROP TABLE %s' % table))
+    else:
+        connection.execute(Show.__table__.delete().where(within))
+    return partial, show_ids, venue_ids, artist_ids
+
+
+def publish(partial, path):
+    """Give a month's archive its name, once the removal of its rows has committed."""
+    os.rename(partial, path)
+
+
+def archives(directory):
+    """``[(month, path)]`` of the archive files in ``directory``, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = ARCHIVE_NAME.match(name)
+        if match:
+            found.append((date(int(match.group(1)), int(match.group(2)), 1), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def search_archives(directory, start=None, end=None, venue_id=None, artist_id=None):
+    """Yield archived shows as export records, reading only the months in [start, end)."""
+    for month, path in archives(directory):
+        if (start is not None and add_months(month, 1) <= month_of(start)) or (end is not None and month >= end.date()):
+            continue
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as stream:
+            for row in csv.DictReader(stream):
+                time = datetime.fromisoformat(row['time'])
+                artist_ids = [int(id) for id in row['artist_ids'].split(';') if id]
+                if ((start is not None and time < start) or (end is not None and time >= end)
+                        or (venue_id is not None and int(row['venue_id']) != venue_id)
+                        or (artist_id is not None and artist_id not in artist_ids)):
+                    continue
+                yield dict(row, id=int(row['id']), duration=int(row['duration']), venue_id=int(row['venue_id']),
+                           artist_ids=artist_ids, artist_names=[name for name in row['artist_names'].split(';') if name])
+
+
+partitions_cli = AppGroup('partitions', help='Manage the monthly partitions of shows and their archives.')
+
+
+def _require_partitioned(connection):
+    if not is_partitioned(connection, 'shows'):
+        raise click.UsageError('shows is only partitioned on Postgres, after migration c8a4e2f61b37')
+
+
+@partitions_cli.command('list')
+def list_command():
+    """Show the month partitions and the archived months."""
+    with db.engine.connect() as connection:
+        _require_partitioned(connection)
+        end = history_end(connection)
+        if end is not None:
+            click.echo('%s  months before %s' % (HISTORY, end.strftime('%Y-%m')))
+        for month, rows in partitions(connection).items():
+            click.echo('%s  ~%d rows' % (partition_name(month), rows))
+    for month, path in archives(current_app.config['PARTITION_ARCHIVE_DIR']):
+        click.echo('%s  archived in %s' % (partition_name(month), path))
+
+
+@partitions_cli.command('ensure')
+@click.option('--ahead', type=int, help='Months to create past this one; PARTITION_MONTHS_AHEAD by default.')
+def ensure_command(ahead):
+    """Create the coming months' partitions (run it from cron)."""
+    ahead = current_app.config['PARTITION_MONTHS_AHEAD'] if ahead is None else ahead
+    with db.engine.begin() as connection:
+        _require_partitioned(connection)
+        created = ensure(connection, ahead)
+    for month, moved in created:
+        click.echo('created %s, moved %d rows from shows_default' % (partition_name(month), moved))
+    click.echo('%d partitions created' % len(created))
+
+
+@partitions_cli.command('archive')
+@click.option('--months', type=int, help='Months kept in the database; PARTITION_ARCHIVE_MONTHS by default.')
+@click.option('--dir', 'directory', help='Where archives go; PARTITION_ARCHIVE_DIR by default.')
+@click.option('--dry-run', is_flag=True, help='List the months that would be archived.')
+def archive_command(months, directory, dry_run):
+    """Move the shows of months older than the kept ones to compressed CSV files."""
+    months = current_app.config['PARTITION_ARCHIVE_MONTHS'] if months is None else months
+    directory = directory or current_app.config['PARTITION_ARCHIVE_DIR']
+    before = add_months(month_of(date.today()), -months)
+    with db.engine.connect() as connection:
+        due = archive_months(connection, before)
+    if dry_run:
+        for month in due:
+            click.echo('would archive %s' % partition_name(month))
+        return
+    os.makedirs(directory, exist_ok=True)
+    for month in due:
+        path = archive_path(directory, month)
+        # a transaction per month, so a failure keeps the months done so far
+        try:
+            with db.engine.begin() as connection:
+                partial, show_ids, venue_ids, artist_ids = archive_month(connection, month, path)
+        except Exception:
+            # rolled back: the month is still in the database
+            if os.path.exists(path + '.partial'):
+                os.remove(path + '.partial')
+            raise
+        if partial is not None:
+            publish(partial, path)
+        counters.invalidate(venue_ids, artist_ids)
+        backend = current_app.extensions.get('cache')
+        if backend is not None and show_ids:
+            backend.invalidate({'shows'} | {'show:%d' % id for id in show_ids})
+        if partial is None:
+            click.echo('dropped %s, which was empty' % partition_name(month))
+        else:
+            click.echo('archived %d shows of %s to %s' % (len(show_ids), partition_name(month), path))
+
+
+@partitions_cli.command('query')
+@click.option('--start', type=click.DateTime(), help='First show time to include.')
+@click.option('--end', type=click.DateTime(), help='Show time to stop before.')
+@click.option('--venue', 'venue_id', type=int)
+@click.option('--artist', 'artist_id', type=int)
+@click.option('--dir', 'directory', help='Where the archives are; PARTITION_ARCHIVE_DIR by default.')
+def query_command(start, end, venue_id, artist_id, directory):
+    """Print archived shows as JSON Lines."""
+    directory = directory or current_app.config['PARTITION_ARCHIVE_DIR']
+    for record in search_archives(directory, start, end, venue_id, artist_id):
+        click.echo(json.dumps(record))
@@ -0,0 +1,165 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import JSON, case, exists, func, or_, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+import series
+from booking import MAX_DURATION
+from geo import haversine, within_box
+from loaders import apply_profile
+from model import db, Venue, Artist, Genre, Show, ShowSeries, artist_genres, artist_shows, venue_genres
+from serializers import SHOWS, VENUES
+
+
+ShowSplit = namedtuple('ShowSplit', 'upcoming past upcoming_count past_count')
+CalendarEntry = namedtuple('CalendarEntry', 'show_id series_id venue_id time duration artist_ids')
+
+
+def venue_shows(venue_id):
+    return Show.query.filter(Show.venue_id == venue_id)
+
+
+def artist_shows_query(artist_id):
+    return Show.query.join(artist_shows, artist_shows.c.show_id == Show.id) \
+        .filter(artist_shows.c.artist_id == artist_id)
+
+
+GENRE_LINKS = {
+    Venue: venue_genres.c.venue_id,
+    Artist: artist_genres.c.artist_id,
+}
+
+
+def filter_by_genre(query, model, name):
+    # genre name -> (genre_id, <model>_id) index range, already in id order
+    owner = GENRE_LINKS[model]
+    link = owner.table
+    return query.join(link, owner == model.id) \
+        .join(Genre, Genre.id == link.c.genre_id) \
+        .filter(Genre.name == name.strip())
+
+
+def show_counts(query, now=None):
+    """Return ``(upcoming, past)`` counts for ``query`` in a single aggregate."""
+    now = now or datetime.now()
+    upcoming, past = query.with_entities(
+        func.count(case((Show.time > now, Show.id))),
+        func.count(case((Show.time <= now, Show.id))),
+    ).order_by(None).one()
+    return upcoming, past
+
+
+def split_shows(query, profile, now=None, limit=None):
+    """Split the shows matched by ``query`` into upcoming and past, in SQL.
+
+    Upcoming shows come soonest first and past shows most recent first; with
+    ``limit`` each side is truncated but the counts still cover every show.
+    """
+    now = now or datetime.now()
+    upcoming_count, past_count = show_counts(query, now)
+    upcoming = apply_profile(query.filter(Show.time > now), profile) \
+        .order_by(Show.time, Show.id)
+    past = apply_profile(query.filter(Show.time <= now), profile) \
+        .order_by(Show.time.desc(), Show.id.desc())
+    if limit is not None:
+        upcoming = upcoming.limit(limit)
+        past = past.limit(limit)
+    return ShowSplit(
+        upcoming.all() if upcoming_count else [],
+        past.all() if past_count else [],
+        upcoming_count,
+        past_count,
+    )
+
+
+def region_tag(city=None, state=None):
+    """Cache tag of a by-region listing filtered on ``city`` and/or ``state``."""
+    if city is None and state is None:
+        return 'venues'
+    return 'region:%s/%s' % ('*' if state is None else state, '*' if city is None else city)
+
+
+def region_tags(city, state):
+    """Tags of every by-region listing a venue in (city, state) appears in."""
+    return {region_tag(city, state), region_tag(state=state), region_tag(city=city), region_tag()}
+
+
+def venues_by_region(city=None, state=None):
+    """Venues grouped by (city, state) in one GROUP BY over ix_venue_city_state.
+
+    Returns ``(city, state, venues)`` rows ordered by city and state, where
+    venues is a list of ``{'id', 'name', 'num_upcoming_shows'}`` ordered by name.
+    """
+    filters = [column == value for column, value in ((Venue.city, city), (Venue.state, state))
+               if value is not None]
+    if db.engine.dialect.name == 'postgresql':
+        item = func.json_build_object('id', Venue.id, 'name', Venue.name,
+                                      'num_upcoming_shows', Venue.upcoming_show_count)
+        venues = func.json_agg(aggregate_order_by(item, Venue.name, Venue.id), type_=JSON)
+        city_, state_ = Venue.city, Venue.state
+        query = select(city_, state_, venues).where(*filters)
+    else:
+        # json_group_array keeps the order rows arrive in, so sort them first
+        rows = select(Venue.city, Venue.state, Venue.name, Venue.id, Venue.upcoming_show_count) \
+            .where(*filters).order_by(Venue.city, Venue.state, Venue.name, Venue.id).subquery()
+        item = func.json_object('id', rows.c.id, 'name', rows.c.name,
+                                'num_upcoming_shows', rows.c.upcoming_show_count)
+        city_, state_ = rows.c.city, rows.c.state
+        query = select(city_, state_, func.json_group_array(item, type_=JSON))
+    return db.session.execute(query.group_by(city_, state_).order_by(city_, state_)).all()
+
+
+def calendar(start, end, venue_id=None):
+    """Shows and series occurrences intersecting [start, end), in time order.
+
+    Stored shows come from one range scan (no show outlasts MAX_DURATION) and
+    series are expanded only across the window, so the cost follows the
+    window's size rather than how long the series have been running.
+    """
+    query = SHOWS.query().filter(Show.time < end, Show.time > start - timedelta(minutes=MAX_DURATION))
+    if venue_id is not None:
+        query = query.filter(Show.venue_id == venue_id)
+    entries = [
+        CalendarEntry(show['id'], show['series_id'], show['venue_id'], show['time'], show['duration'],
+                      show['artist_ids'])
+        for show in SHOWS.render(query) if show['time'] + timedelta(minutes=show['duration']) > start
+    ]
+    entries.extend(
+        CalendarEntry(None, item.id, item.venue_id, time, item.duration, [artist.id for artist in item.artists])
+        for item, time in series.slots(start, end, venue_id)
+    )
+    return sorted(entries, key=lambda entry: (entry.time, entry.venue_id))
+
+
+def has_upcoming_shows(now=None):
+    """Venues whose counter has upcoming shows or that run a series still going."""
+    now = now or datetime.now()
+    running = exists().where(ShowSeries.venue_id == Venue.id,
+                             or_(ShowSeries.ends_at.is_(None), ShowSeries.ends_at > now))
+    return or_(Venue.upcoming_show_count > 0, running)
+
+
+def venues_near(latitude, longitude, radius_km, limit, first_ring_km=1.0, growth=4):
+    """The ``limit`` nearest venues with upcoming shows within ``radius_km``,
+    as ``[(rendered venue, distance_km)]`` nearest first.
+
+    Candidates come from a bounding-box range scan on ix_venue_latitude_longitude
+    and are ranked by haversine distance. The box starts at ``first_ring_km``
+    and grows ``growth``-fold, up to the radius, only while fewer than
+    ``limit`` venues fall inside the circle, so a query in a dense city never
+    reads the whole radius. Every venue nearer than a ring's radius lies
+    inside its box, so stopping early cannot skip a closer one.
+    """
+    ring = min(first_ring_km, radius_km)
+    while True:
+        rows = db.session.query(Venue.id, Venue.latitude, Venue.longitude).filter(
+            within_box(latitude, longitude, ring), has_upcoming_shows())
+        found = sorted((distance, id) for distance, id in (
+            (haversine(latitude, longitude, lat, lng), id) for id, lat, lng in rows) if distance <= ring)
+        if len(found) >= limit or ring >= radius_km:
+            break
+        ring = min(ring * growth, radius_km)
+    found = found[:limit]
+    venues = VENUES.fetch([id for _, id in found])
+    return [(venues[id], distance) for distance, id in found]
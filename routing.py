@@ -0,0 +1,112 @@
+import itertools
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_PREFIX = 'replica_'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_COOKIE = 'db_primary_until'
+
+
+class ReplicaSet(object):
+    """Round-robin over the replica binds, skipping ones that fail a health check.
+
+    A replica is re-checked with ``SELECT 1`` at most every ``interval`` seconds.
+    """
+
+    def __init__(self, db, app, keys, interval=5.0):
+        self.db = db
+        self.app = app
+        self.keys = list(keys)
+        self.interval = interval
+        self._cycle = itertools.cycle(range(len(self.keys)))
+        self._lock = threading.Lock()
+        self._health = {}
+
+    def engine(self, key):
+        return self.db.get_engine(self.app, bind=key)
+
+    def choose(self):
+        if not self.keys:
+            return None
+        with self._lock:
+            start = next(self._cycle)
+        for offset in range(len(self.keys)):
+            key = self.keys[(start + offset) % len(self.keys)]
+            if self.healthy(key):
+                return key
+        return None
+
+    def healthy(self, key):
+        now = time.monotonic()
+        status = self._health.get(key)
+        if status is not None and now - status[1] < self.interval:
+            return status[0]
+        try:
+            with self.engine(key).connect() as connection:
+                connection.execute(text('SELECT 1'))
+            ok = True
+        except SQLAlchemyError:
+            logger.warning('replica %s failed its health check', key, exc_info=True)
+            ok = False
+        self._health[key] = (ok, now)
+        return ok
+
+
+class RoutingSession(SignallingSession):
+    """Send reads made while serving a read-only request to a replica.
+
+    Flushes, explicitly bound models and every other request use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if not self._flushing and self._routes_to_replica(mapper):
+            replicas = self.app.extensions['replicas']
+            key = g.get('db_replica')
+            if key is None:
+                # one replica per request, so its reads see a single snapshot
+                key = g.db_replica = replicas.choose() or False
+            if key:
+                return replicas.engine(key)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def _routes_to_replica(self, mapper):
+        if not has_request_context() or not g.get('db_read_only'):
+            return False
+        if mapper is not None and getattr(mapper.persist_selectable, 'info', {}).get('bind_key'):
+            return False
+        return True
+
+
+def init_app(app, db):
+    """Register replica binds from SQLALCHEMY_REPLICA_URIS and the request hooks."""
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    keys = []
+    for index, uri in enumerate(uris):
+        key = '%s%d' % (REPLICA_BIND_PREFIX, index)
+        binds[key] = uri
+        keys.append(key)
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['replicas'] = ReplicaSet(db, app, keys, app.config.get('REPLICA_HEALTH_INTERVAL', 5.0))
+    window = app.config.get('READ_YOUR_WRITES_SECONDS', 5)
+
+    @app.before_request
+    def route_reads():
+        # a client that has just written reads from the primary until replicas catch up
+        recent_write = request.cookies.get(PRIMARY_COOKIE, type=float) or 0
+        g.db_read_only = bool(keys) and request.method in SAFE_METHODS and recent_write < time.time()
+
+    @app.after_request
+    def pin_writers(response):
+        if keys and request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(PRIMARY_COOKIE, str(time.time() + window), max_age=window, httponly=True)
+        return response
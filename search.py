@@ -0,0 +1,74 @@
+import re
+
+from sqlalchemy import func, literal_column, or_
+
+from model import db, Venue, Artist
+
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# columns folded into each table's generated search_vector (see model.py and
+# migration f1a7d3c95e28): the name weighted 'A', city and state 'B' and the
+# comma-joined genre names 'C'
+SEARCH_COLUMNS = {
+    Venue: (Venue.name, Venue.city, Venue.state, Venue.genre_names),
+    Artist: (Artist.name, Artist.city, Artist.state, Artist.genre_names),
+}
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN.findall(text or '')]
+
+
+def search(model, text, page=1, per_page=20):
+    """Rank ``model`` rows against ``text``; every token must match a word prefix
+    of the name, city, state or genres.
+
+    Returns ``(rows, has_more)`` where rows are ``(id, name, city, state, rank)``.
+    """
+    tokens = tokenize(text)
+    if not tokens:
+        return [], False
+    offset = (page - 1) * per_page
+    if db.engine.dialect.name == 'postgresql':
+        rows = _search_postgresql(model, tokens, offset, per_page + 1)
+    else:
+        rows = _search_fallback(model, tokens, offset, per_page + 1)
+    return rows[:per_page], len(rows) > per_page
+
+
+def _search_postgresql(model, tokens, offset, limit):
+    vector = literal_column('%s.search_vector' % model.__tablename__)
+    query = func.to_tsquery('simple', ' & '.join('%s:*' % token for token in tokens))
+    # one @@ over the whole query, so the GIN index alone finds the rows
+    rank = func.ts_rank(vector, query).label('rank')
+    match = vector.op('@@')(query)
+    id_, name, city, state = model.id, model.name, model.city, model.state
+    return db.session.query(id_, name, city, state, rank) \
+        .filter(match) \
+        .order_by(rank.desc(), id_) \
+        .offset(offset).limit(limit).all()
+
+
+def _text_rank(tokens, name, city, state, genres):
+    weighted = [(tokenize(name), 1.0), (tokenize(city), 0.4), (tokenize(state), 0.4), (tokenize(genres), 0.2)]
+    rank = 0.0
+    for token in tokens:
+        hits = [weight for words, weight in weighted if any(w.startswith(token) for w in words)]
+        if not hits:
+            return None
+        rank += max(hits)
+    return rank
+
+
+def _search_fallback(model, tokens, offset, limit):
+    # SQLite has no tsvector: narrow with LIKE, then rank word prefixes in Python
+    columns = SEARCH_COLUMNS[model]
+    match = or_(*[func.lower(column).like('%' + tokens[0] + '%') for column in columns])
+    ranked = []
+    for row in db.session.query(model.id, *columns).filter(match):
+        rank = _text_rank(tokens, *row[1:])
+        if rank is not None:
+            ranked.append(tuple(row[:4]) + (rank,))
+    ranked.sort(key=lambda row: (-row[-1], row[0]))
+    return ranked[offset:offset + limit]
@@ -0,0 +1,113 @@
+"""Render read-only listings straight from selected columns.
+
+Listing pages never modify what they load, so hydrating ORM objects for them
+only buys identity-map bookkeeping, attribute instrumentation and a
+``format()`` call per row. A Serializer selects just the columns a response
+carries (``Query.with_entities`` rows, still usable with keyset_page and
+filter_by_genre), zips them into dicts, and fills in link lists such as
+genres or artist ids with one grouped query per page. Bodies are encoded
+with orjson when it is installed.
+"""
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select
+
+from model import db, Venue, Artist, Genre, Show, artist_genres, artist_shows, venue_genres
+
+try:
+    import orjson
+except ImportError:  # optional; the standard library encoder is the fallback
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError('cannot encode %r' % (value,))
+
+
+def dumps(payload):
+    """Compact JSON bytes; naive datetimes come out as isoformat() does."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode()
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(dumps(payload), status=status, mimetype='application/json')
+
+
+def grouped(statement):
+    """``{owner: [value, ...]}`` from a statement selecting (owner, value) pairs."""
+    groups = {}
+    for owner, value in db.session.execute(statement):
+        groups.setdefault(owner, []).append(value)
+    return groups
+
+
+def genre_names(link):
+    owner = link.c[link.c.keys()[0]]
+
+    def load(ids):
+        return grouped(select(owner, Genre.name).join(Genre, Genre.id == link.c.genre_id)
+                       .where(owner.in_(ids)).order_by(owner, Genre.name))
+    return load
+
+
+def show_artist_ids(ids):
+    return grouped(select(artist_shows.c.show_id, artist_shows.c.artist_id)
+                   .where(artist_shows.c.show_id.in_(ids))
+                   .order_by(artist_shows.c.show_id, artist_shows.c.artist_id))
+
+
+class Serializer(object):
+    """The columns one kind of listing renders, plus the link lists it carries.
+
+    ``fields`` name mapped columns of ``model``; ``links`` maps a response
+    key to a function from a page's ids to ``{id: [values]}``.
+    """
+
+    def __init__(self, model, fields, links=None):
+        self.model = model
+        self.fields = fields
+        self.columns = [getattr(model, name) for name in fields]
+        self.links = links or {}
+
+    @property
+    def budget(self):
+        """Statements one page takes: its rows, then a query per link list."""
+        return 1 + len(self.links)
+
+    def query(self):
+        return db.session.query(*self.columns)
+
+    def render(self, rows):
+        items = [dict(zip(self.fields, row)) for row in rows]
+        if items and self.links:
+            ids = [item['id'] for item in items]
+            for key, load in self.links.items():
+                found = load(ids)
+                for item in items:
+                    item[key] = found.get(item['id'], [])
+        return items
+
+    def fetch(self, ids):
+        """Rendered items for ``ids``, keyed by id."""
+        if not ids:
+            return {}
+        rows = self.query().filter(self.model.id.in_(ids))
+        return {item['id']: item for item in self.render(rows)}
+
+
+# same keys as the models' format()
+VENUES = Serializer(Venue, (
+    'id', 'name', 'city', 'state', 'address', 'phone', 'image_link', 'facebook_link', 'website_link',
+    'look_talent', 'seek_des', 'latitude', 'longitude', 'upcoming_show_count', 'past_show_count',
+), {'genres': genre_names(venue_genres)})
+ARTISTS = Serializer(Artist, (
+    'id', 'name', 'city', 'state', 'phone', 'image_link', 'facebook_link', 'website_link',
+    'seeking_venue', 'seek_des', 'upcoming_show_count', 'past_show_count',
+), {'genres': genre_names(artist_genres)})
+SHOWS = Serializer(Show, ('id', 'venue_id', 'time', 'duration', 'series_id'), {'artist_ids': show_artist_ids})
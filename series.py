@@ -0,0 +1,203 @@
+"""Recurring show series: RRULE parsing and lazy expansion into occurrences.
+
+Only the rule is stored. Occurrences are computed for the window a caller
+asks about; the rule's DTSTART is first moved forward by whole periods to
+just before the window, so a weekly residency that has run for ten years
+costs the same to expand as one that started last week. Cancelled
+occurrences are rows in series_cancellations, and edited ones are Show rows
+carrying ``series_id`` and ``occurrence``; both hide the generated
+occurrence.
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from dateutil import rrule
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import or_, select
+from sqlalchemy.orm import selectinload
+
+from model import db, Show, ShowSeries, series_cancellations
+
+
+FREQUENCIES = {'DAILY': rrule.DAILY, 'WEEKLY': rrule.WEEKLY, 'MONTHLY': rrule.MONTHLY, 'YEARLY': rrule.YEARLY}
+WEEKDAYS = {'MO': rrule.MO, 'TU': rrule.TU, 'WE': rrule.WE, 'TH': rrule.TH,
+            'FR': rrule.FR, 'SA': rrule.SA, 'SU': rrule.SU}
+INTEGER_PARTS = {'INTERVAL': 'interval', 'COUNT': 'count', 'BYMONTHDAY': 'bymonthday',
+                 'BYMONTH': 'bymonth', 'BYSETPOS': 'bysetpos', 'BYHOUR': 'byhour', 'BYMINUTE': 'byminute'}
+MAX_COUNT = 1000
+UNTIL_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def _integers(name, value):
+    try:
+        numbers = tuple(int(item) for item in value.split(','))
+    except ValueError:
+        raise ValueError('%s must be a list of integers' % name)
+    if name in ('INTERVAL', 'COUNT'):
+        if len(numbers) != 1 or numbers[0] < 1:
+            raise ValueError('%s must be a positive integer' % name)
+        return numbers[0]
+    return numbers
+
+
+def _weekday(item):
+    # MO, or with an ordinal such as 1MO or -1FR for MONTHLY/YEARLY rules
+    day, ordinal = item[-2:], item[:-2]
+    if day not in WEEKDAYS:
+        raise ValueError('unknown weekday %r' % item)
+    try:
+        return WEEKDAYS[day](int(ordinal)) if ordinal else WEEKDAYS[day]
+    except ValueError:
+        raise ValueError('unknown weekday %r' % item)
+
+
+def _parts(text):
+    text = text.strip()
+    if text.upper().startswith('RRULE:'):
+        text = text[len('RRULE:'):]
+    return [part.strip().upper() for part in text.split(';') if part.strip()]
+
+
+@lru_cache(maxsize=1024)
+def parse_rule(text):
+    """``rrule()`` keyword arguments for RRULE ``text``; ValueError for anything unsupported.
+
+    dateutil's own rrulestr cannot parse UNTIL with the pinned version, and
+    accepts more than a show schedule needs, so the rule is read here.
+    """
+    options = {}
+    for part in _parts(text):
+        name, sep, value = part.partition('=')
+        if not sep or not value:
+            raise ValueError('malformed rule part %r' % part)
+        if name == 'FREQ':
+            if value not in FREQUENCIES:
+                raise ValueError('FREQ must be one of %s' % ', '.join(FREQUENCIES))
+            options['freq'] = FREQUENCIES[value]
+        elif name in INTEGER_PARTS:
+            options[INTEGER_PARTS[name]] = _integers(name, value)
+        elif name == 'UNTIL':
+            try:
+                options['until'] = datetime.strptime(value.rstrip('Z'), UNTIL_FORMAT if 'T' in value else '%Y%m%d')
+            except ValueError:
+                raise ValueError('UNTIL must look like 20301231T235900')
+        elif name == 'BYDAY':
+            options['byweekday'] = tuple(_weekday(item) for item in value.split(','))
+        elif name == 'WKST':
+            if value not in WEEKDAYS:
+                raise ValueError('unknown weekday %r' % value)
+            options['wkst'] = WEEKDAYS[value]
+        else:
+            raise ValueError('unsupported rule part %s' % name)
+    if 'freq' not in options:
+        raise ValueError('FREQ is required')
+    if 'count' in options and 'until' in options:
+        raise ValueError('COUNT and UNTIL cannot be combined')
+    if options.get('count', 0) > MAX_COUNT:
+        raise ValueError('COUNT may be at most %d' % MAX_COUNT)
+    return options
+
+
+def normalize(text, start, duration):
+    """Validate a rule for a series starting at ``start``.
+
+    Returns the rule text to store, with COUNT replaced by the UNTIL it
+    amounts to, and the end of the last occurrence (None when open-ended).
+    """
+    options = parse_rule(text)
+    rule = rrule.rrule(dtstart=start, **options)
+    if rule.after(start, inc=True) is None:
+        raise ValueError('the rule has no occurrences')
+    parts = [part for part in _parts(text) if not part.startswith('COUNT=')]
+    if 'count' in options:
+        last = list(rule)[-1]
+        parts.append('UNTIL=' + last.strftime(UNTIL_FORMAT))
+    elif 'until' in options:
+        last = rule.before(options['until'], inc=True)
+    else:
+        last = None
+    return ';'.join(parts), last + timedelta(minutes=duration) if last else None
+
+
+def fast_forward(options, dtstart, lower):
+    """The latest DTSTART, on the rule's period grid and not after ``lower``,
+    from which the rule yields the same occurrences as from ``dtstart``.
+
+    Periods of days and weeks always have the same length; months and years
+    do too unless DTSTART falls on a day some of them lack (the 29th to 31st,
+    or February 29th), in which case expansion starts at ``dtstart``.
+    """
+    if lower <= dtstart:
+        return dtstart
+    freq, interval = options['freq'], options.get('interval', 1)
+    if freq in (rrule.DAILY, rrule.WEEKLY):
+        period = timedelta(days=interval * (7 if freq == rrule.WEEKLY else 1))
+        return dtstart + period * ((lower - dtstart) // period)
+    if freq == rrule.MONTHLY and dtstart.day <= 28:
+        months = (lower.year - dtstart.year) * 12 + lower.month - dtstart.month - 1
+        return dtstart + relativedelta(months=max(months, 0) // interval * interval)
+    if freq == rrule.YEARLY and (dtstart.month, dtstart.day) != (2, 29):
+        years = lower.year - dtstart.year - 1
+        return dtstart + relativedelta(years=max(years, 0) // interval * interval)
+    return dtstart
+
+
+def occurrences(series, start, end):
+    """Start times of the series' occurrences whose slot intersects [start, end)."""
+    options = parse_rule(series.rrule)
+    lower = start - timedelta(minutes=series.duration)
+    dtstart = fast_forward(options, series.starts_at, lower)
+    return rrule.rrule(dtstart=dtstart, **options).between(lower, end)
+
+
+def is_occurrence(series, time):
+    return time in occurrences(series, time, time + timedelta(minutes=1))
+
+
+def hidden(series_ids, lower, upper):
+    """``(series_id, occurrence)`` pairs in (lower, upper) that are cancelled or edited."""
+    if not series_ids:
+        return set()
+    cancelled = select(series_cancellations.c.series_id, series_cancellations.c.occurrence).where(
+        series_cancellations.c.series_id.in_(series_ids),
+        series_cancellations.c.occurrence > lower, series_cancellations.c.occurrence < upper)
+    edited = select(Show.series_id, Show.occurrence).where(
+        Show.series_id.in_(series_ids), Show.occurrence > lower, Show.occurrence < upper)
+    with db.session.no_autoflush:
+        return {tuple(row) for row in db.session.execute(cancelled.union_all(edited))}
+
+
+def slots(start, end, venue_id=None, exclude=None, venue_ids=None):
+    """``(series, time)`` for every generated occurrence intersecting [start, end).
+
+    Only series running during the window are loaded and only the window is
+    expanded. ``exclude`` is a ``(series_id, occurrence)`` pair to leave out;
+    ``venue_ids`` (a list or a select of ids) limits the venues searched.
+    """
+    query = ShowSeries.query.options(selectinload(ShowSeries.artists)).filter(
+        ShowSeries.starts_at < end, or_(ShowSeries.ends_at.is_(None), ShowSeries.ends_at > start))
+    if venue_id is not None:
+        query = query.filter(ShowSeries.venue_id == venue_id)
+    if venue_ids is not None:
+        query = query.filter(ShowSeries.venue_id.in_(venue_ids))
+    with db.session.no_autoflush:
+        running = query.all()
+    found = [(series, time) for series in running for time in occurrences(series, start, end)]
+    if not found:
+        return []
+    longest = max(series.duration for series, _ in found)
+    skip = hidden([series.id for series in running], start - timedelta(minutes=longest), end)
+    if exclude is not None:
+        skip.add(tuple(exclude))
+    return [(series, time) for series, time in found if (series.id, time) not in skip]
+
+
+def is_cancelled(series_id, time):
+    key = (series_cancellations.c.series_id == series_id) & (series_cancellations.c.occurrence == time)
+    with db.session.no_autoflush:
+        return db.session.execute(select(series_cancellations.c.series_id).where(key)).first() is not None
+
+
+def cancel(series, time):
+    """Record that an occurrence will not take place."""
+    db.session.execute(series_cancellations.insert().values(series_id=series.id, occurrence=time))
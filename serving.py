@@ -0,0 +1,148 @@
+"""Serve the Flask app over ASGI; asgi.py is the entry point.
+
+Requests are handed to the same Flask app as the WSGI server uses, on two
+bounded thread pools: one for reads (GET, HEAD, OPTIONS) and one for
+writes, so a burst of slow listings cannot hold up bookings. Each pool is
+sized to the connections its requests can get, so the event loop accepts
+any number of idle or slow clients while the number of threads stays fixed.
+Requests beyond ASGI_MAX_PENDING are answered 503 straight away instead of
+queueing without bound.
+"""
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+BUSY_BODY = json.dumps({'success': False, 'error': 503, 'message': 'server busy'}).encode('utf-8')
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI ``http`` scope whose whole body has been read."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class ThreadPoolASGI(object):
+    """Serve a WSGI app over ASGI on bounded read and write thread pools."""
+
+    def __init__(self, app, read_workers=None, write_workers=None, max_pending=None):
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        connections = options.get('pool_size', 5) + options.get('max_overflow', 10)
+        # by default the two pools together hold one thread per pooled connection,
+        # so no request waits for a connection once it has a thread
+        write_workers = write_workers or app.config.get('ASGI_WRITE_WORKERS') or max(1, connections // 4)
+        read_workers = read_workers or app.config.get('ASGI_READ_WORKERS') or max(1, connections - write_workers)
+        self.app = app
+        self.reads = ThreadPoolExecutor(read_workers, thread_name_prefix='asgi-read')
+        self.writes = ThreadPoolExecutor(write_workers, thread_name_prefix='asgi-write')
+        self.max_pending = max_pending or app.config.get('ASGI_MAX_PENDING') or 4 * (read_workers + write_workers)
+        self.pending = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('unsupported ASGI scope %r' % scope['type'])
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        if self.pending >= self.max_pending:
+            await send({'type': 'http.response.start', 'status': 503, 'headers': [
+                (b'content-type', b'application/json'), (b'retry-after', b'1')]})
+            await send({'type': 'http.response.body', 'body': BUSY_BODY})
+            return
+        pool = self.reads if scope['method'] in READ_METHODS else self.writes
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            await loop.run_in_executor(pool, self.run_wsgi, loop, scope, body, send)
+        finally:
+            self.pending -= 1
+
+    @staticmethod
+    async def read_body(receive):
+        """The request body, or None when the client went away first."""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    def run_wsgi(self, loop, scope, body, send):
+        # the whole request, including a streamed body, stays on this thread so
+        # the app and request contexts and the scoped session are never shared
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response and response[0] is None:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [{
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            }]
+
+        def send_start():
+            if response[0] is not None:
+                call(response[0])
+                response[0] = None
+
+        result = self.app(build_environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()
+                    call({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_start()
+            call({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                loop = asyncio.get_running_loop()
+                for pool in (self.reads, self.writes):
+                    await loop.run_in_executor(None, pool.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
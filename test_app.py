@@ -0,0 +1,1064 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy as sa
+from flask import jsonify
+from sqlalchemy import exc, inspect, select, text
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import create_app
+from benchmarks.datagen import generate, load
+from benchmarks.report import compare, summarize
+from cache import LRUBackend, RedisBackend
+import counters
+from database import TimedQueuePool, dispose_engines
+from geo import TableGeocoder, bounding_box, haversine
+from instrumentation import explainable, redact
+from jobs import DatabaseQueue, Job, MemoryQueue, handler, jobs, run
+from loaders import QueryBudgetExceeded, count_queries, query_budget
+from pagination import encode_cursor
+from model import db, Venue, Artist, Genre, Show, jobs as job_table
+from queries import artist_shows_query, split_shows, venue_shows
+import serializers
+from serving import ThreadPoolASGI
+
+
+@pytest.fixture
+def app():
+    app = create_app({'PAGE_SIZE': 2}, profile='testing')
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_venue(name='The Musical Hop', city='San Francisco', state='CA', genres='Jazz,Reggae'):
+    venue = Venue(name, city, state, '1015 Folsom Street', '123-123-1234', None, None, None, 'y', None, genres)
+    db.session.add(venue)
+    db.session.commit()
+    return venue
+
+
+def make_artist(name='Guns N Petals', city='San Francisco', state='CA', genres='Rock n Roll'):
+    artist = Artist(name, city, state, None, '326-123-5000', None, None, None, 'y', None, genres)
+    db.session.add(artist)
+    db.session.commit()
+    return artist
+
+
+def make_show(venue, artists, time):
+    show = Show(venue.id, None, time)
+    show.artist = list(artists)
+    db.session.add(show)
+    db.session.commit()
+    return show
+
+
+def walk(client, url):
+    seen, cursor = [], None
+    while True:
+        sep = '&' if '?' in url else '?'
+        res = client.get(url if cursor is None else '%s%scursor=%s' % (url, sep, cursor))
+        assert res.status_code == 200
+        body = res.get_json()
+        seen.extend(body['data'])
+        cursor = body['next_cursor']
+        if cursor is None:
+            return seen
+
+
+def test_venue_listing_walks_every_page_once(client):
+    ids = [make_venue(name='Venue %d' % i).id for i in range(5)]
+    assert [v['id'] for v in walk(client, '/venues')] == ids
+
+
+def test_show_listing_orders_by_time_then_id(client):
+    venue = make_venue()
+    artist = make_artist()
+    start = datetime(2030, 1, 1, 20)
+    shows = [make_show(venue, [artist], start + timedelta(days=d)) for d in (3, 1, 1, 2)]
+    expected = sorted(shows, key=lambda s: (s.time, s.id))
+    assert [s['id'] for s in walk(client, '/shows')] == [s.id for s in expected]
+
+
+def test_limit_is_capped_and_bad_cursor_rejected(client):
+    for i in range(3):
+        make_artist(name='Artist %d' % i)
+    assert len(client.get('/artists?limit=500').get_json()['data']) == 3
+    assert client.get('/artists?cursor=not-a-cursor').status_code == 400
+    # well formed, but not of the key's types
+    for url, values in (('/artists', ['x']), ('/venues', [True]), ('/shows', [5, 1]), ('/shows', ['2030-01-01', 1])):
+        assert client.get('%s?cursor=%s' % (url, encode_cursor(values))).status_code == 400
+    assert client.get('/artists?limit=0').status_code == 400
+
+
+def test_listings_render_the_same_fields_as_format_without_orm_objects(client, monkeypatch):
+    venue, artists = seed_graph(shows=2)
+    expected = {
+        '/venues': [venue.format()],
+        '/artists?limit=5': [artist.format() for artist in artists],
+        '/shows': [dict(show.format(), artist_ids=sorted(show.format()['artist_ids'])) for show in venue.shows],
+    }
+    for url, items in expected.items():
+        assert client.get(url).get_json()['data'] == items
+    # the standard library fallback encodes the same
+    monkeypatch.setattr(serializers, 'orjson', None)
+    db.session.remove()
+    res = client.get('/shows?limit=10')
+    assert res.headers['X-Cache'] == 'MISS' and res.get_json()['data'] == expected['/shows']
+
+
+def seed_graph(shows=6):
+    venue = make_venue()
+    artists = [make_artist(name='Artist %d' % i) for i in range(3)]
+    start = datetime(2030, 1, 1, 20)
+    for i in range(shows):
+        make_show(venue, artists[i % 3:i % 3 + 2], start + timedelta(days=i))
+    db.session.expire_all()
+    return venue, artists
+
+
+@pytest.mark.parametrize('profile, url', [
+    ('venue_detail', '/venues/1'),
+    ('artist_detail', '/artists/2'),
+    ('show_detail', '/shows/3'),
+])
+def test_endpoints_stay_within_query_budget(client, profile, url):
+    seed_graph()
+    db.session.remove()
+    with query_budget(db.engine, profile):
+        res = client.get(url)
+    assert res.status_code == 200
+
+
+@pytest.mark.parametrize('serializer, url', [
+    (serializers.VENUES, '/venues?limit=50'),
+    (serializers.ARTISTS, '/artists?limit=50'),
+    (serializers.SHOWS, '/shows?limit=50'),
+])
+def test_listings_stay_within_query_budget(client, serializer, url):
+    seed_graph()
+    db.session.remove()
+    with query_budget(db.engine, url, serializer.budget):
+        res = client.get(url)
+    assert res.status_code == 200
+
+
+def test_query_budget_fails_on_n_plus_one(app):
+    seed_graph(shows=12)
+    db.session.remove()
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget(db.engine, 'venue_detail'):
+            venue = Venue.query.get(1)
+            [show.format() for show in venue.shows]
+
+
+def test_venue_detail_includes_show_artists(client):
+    venue, artists = seed_graph(shows=2)
+    shows = client.get('/venues/%d' % venue.id).get_json()['venue']['upcoming_shows']
+    assert [sorted(s['artist_ids']) for s in shows] == [[artists[0].id, artists[1].id], [artists[1].id, artists[2].id]]
+
+
+def test_show_split_is_computed_against_now(app):
+    venue = make_venue()
+    artist = make_artist()
+    now = datetime(2030, 6, 1)
+    times = [now - timedelta(days=2), now - timedelta(days=1), now + timedelta(days=1)]
+    for time in times:
+        make_show(venue, [artist], time)
+    split = split_shows(venue_shows(venue.id), 'venue_detail', now=now)
+    assert (split.upcoming_count, split.past_count) == (1, 2)
+    assert [s.time for s in split.upcoming] == [times[2]]
+    assert [s.time for s in split.past] == [times[1], times[0]]
+    split = split_shows(artist_shows_query(artist.id), 'artist_detail', now=now, limit=1)
+    assert (len(split.past), split.past_count) == (1, 2)
+
+
+def test_artist_detail_reports_counts(client):
+    venue, artists = seed_graph(shows=3)
+    body = client.get('/artists/%d' % artists[1].id).get_json()['artist']
+    assert body['upcoming_shows_count'] == 2 and body['past_shows_count'] == 0
+    # only the live counts; the counters lag until the next roll
+    assert 'upcoming_show_count' not in body and 'past_show_count' not in body
+    assert {s['venue_name'] for s in body['upcoming_shows']} == {venue.name}
+
+
+def test_genres_are_normalized_and_shared(app):
+    first = make_venue(genres='Jazz, Reggae,Jazz')
+    second = make_venue(name='Park Square', genres=['Jazz', 'Folk'])
+    assert first.genres == ['Jazz', 'Reggae']
+    assert second.genres == ['Folk', 'Jazz']
+    assert Genre.query.count() == 3
+
+
+def test_a_new_genre_resolved_from_two_sessions_is_created_once(app):
+    first, second = db.create_session({})(), db.create_session({})()
+    genres = Genre.resolve('Polka', session=first)
+    resolved = []
+    # neither session sees the other's row before it commits; on Postgres the
+    # second insert waits on the first transaction and then does nothing
+    racing = threading.Thread(target=lambda: resolved.extend(Genre.resolve('Polka', session=second)))
+    racing.start()
+    racing.join(0.5)
+    first.commit()
+    racing.join()
+    second.commit()
+    assert [genre.id for genre in resolved] == [genre.id for genre in genres]
+    assert Genre.query.filter_by(name='Polka').count() == 1
+    first.close()
+    second.close()
+
+
+def test_legacy_genres_column_is_kept_and_synced_back(app):
+    venue_id, artist_id = make_venue(genres='Jazz, Reggae').id, make_artist().id
+    assert db.session.execute(text('SELECT genres FROM venue')).scalar() == 'Jazz,Reggae'
+    # an instance that predates the genre tables writes only the column
+    db.session.execute(text("UPDATE venue SET genres = 'Folk,Blues'"))
+    db.session.execute(text('UPDATE artist SET genres = NULL'))
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['genres', 'sync', '--batch-size', '1'])
+    assert result.output == 'relinked the genres of 1 venues\nrelinked the genres of 0 artists\n'
+    venue, artist = db.session.get(Venue, venue_id), db.session.get(Artist, artist_id)
+    assert (venue.genres, venue.version) == (['Blues', 'Folk'], 2)
+    assert artist.genre_names == 'Rock n Roll'
+
+
+def test_listing_filters_by_genre(client):
+    jazz = [make_venue(name='Jazz %d' % i, genres='Jazz') for i in range(3)]
+    make_venue(name='Rock', genres='Rock')
+    make_artist(genres='Jazz,Blues')
+    assert [v['id'] for v in walk(client, '/venues?genre=Jazz')] == [v.id for v in jazz]
+    body = client.get('/artists?genre=Blues').get_json()
+    assert [a['genres'] for a in body['data']] == [['Blues', 'Jazz']]
+    assert client.get('/venues?genre=Polka').get_json()['data'] == []
+
+
+def test_genre_listing_stays_within_query_budget(client):
+    for i in range(4):
+        make_venue(name='Venue %d' % i, genres='Jazz,Folk')
+    db.session.remove()
+    with query_budget(db.engine, 'venues', serializers.VENUES.budget):
+        assert len(client.get('/venues?limit=10').get_json()['data']) == 4
+
+
+def test_search_matches_word_prefixes_and_ranks_names_first(client):
+    by_name = make_venue(name='Dueling Pianos Bar', city='New York', state='NY')
+    by_city = make_venue(name='Park Square', city='Duelingville', state='NY')
+    make_venue(name='Something Else', city='Austin', state='TX', genres='Rock')
+    body = client.get('/search?q=duel').get_json()
+    assert [v['id'] for v in body['data']] == [by_name.id, by_city.id]
+    body = client.get('/search?q=pian%20new').get_json()
+    assert [v['id'] for v in body['data']] == [by_name.id]
+
+
+def test_search_matches_genres_and_paginates(client):
+    for i in range(3):
+        make_artist(name='Artist %d' % i, genres='Jazz')
+    make_artist(name='Jazzy Jeff', genres='Hip-Hop')
+    first = client.get('/search?type=artists&q=jazz&limit=2').get_json()
+    assert first['data'][0]['name'] == 'Jazzy Jeff'
+    assert first['next_page'] == 2
+    second = client.get('/search?type=artists&q=jazz&limit=2&page=2').get_json()
+    assert len(second['data']) == 2 and second['next_page'] is None
+    assert client.get('/search?type=shows&q=x').status_code == 400
+
+
+def test_search_requires_every_token_across_text_and_genres(client):
+    both = make_venue(name='Blue Note', city='Berlin', state='BE', genres='Jazz')
+    make_venue(name='Duc des Lombards', city='Paris', state='IDF', genres='Jazz')
+    make_venue(name='Tresor', city='Berlin', state='BE', genres='Techno')
+    body = client.get('/search?q=jazz%20berlin').get_json()
+    assert [v['id'] for v in body['data']] == [both.id]
+
+
+def test_timed_queue_pool_reports_checkouts_and_timeouts():
+    pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.05)
+    held = pool.connect()
+    with pytest.raises(exc.TimeoutError):
+        pool.connect()
+    stats = pool.stats()
+    stats.update(pool.metrics.as_dict())
+    assert stats['checked_out'] == 1 and stats['checkouts'] == 1 and stats['timeouts'] == 1
+    assert stats['wait_seconds_max'] >= 0.05
+    held.close()
+
+
+def test_pool_stats_endpoint(client):
+    assert client.get('/health/pool').get_json()['pool'] == {'pool': 'StaticPool'}
+
+
+@pytest.fixture
+def replicated(tmp_path):
+    replica = 'sqlite:///%s' % (tmp_path / 'replica.db')
+    app = create_app({
+        'SQLALCHEMY_REPLICA_URIS': [replica, 'sqlite:////nonexistent/dir/replica.db'],
+        'CACHE_BACKEND': 'null',
+    }, profile='testing')
+    with app.app_context():
+        db.create_all(bind=None)
+        db.Model.metadata.create_all(db.get_engine(app, bind='replica_0'))
+
+        @app.route('/touch', methods=['POST'])
+        def touch():
+            make_venue(name='Written')
+            return jsonify({'success': True})
+
+        yield app
+        db.session.remove()
+
+
+def test_reads_go_to_a_healthy_replica(replicated):
+    with db.get_engine(replicated, bind='replica_0').begin() as connection:
+        connection.execute(text("INSERT INTO venue (id, name) VALUES (7, 'On replica')"))
+    make_venue(name='On primary')
+    client = replicated.test_client()
+    for _ in range(3):
+        names = [v['name'] for v in client.get('/venues').get_json()['data']]
+        assert names == ['On replica']
+
+
+def test_writers_read_their_writes_from_the_primary(replicated):
+    client = replicated.test_client()
+    assert client.post('/touch').status_code == 200
+    assert [v['name'] for v in client.get('/venues').get_json()['data']] == ['Written']
+    assert replicated.test_client().get('/venues').get_json()['data'] == []
+
+
+def test_detail_cache_is_invalidated_by_writes_to_that_venue_only(client):
+    first, second = make_venue(), make_venue(name='Park Square')
+    for venue in (first, second):
+        assert client.get('/venues/%d' % venue.id).headers['X-Cache'] == 'MISS'
+    assert client.get('/venues/%d' % first.id).headers['X-Cache'] == 'HIT'
+    first.name = 'Renamed'
+    db.session.commit()
+    res = client.get('/venues/%d' % first.id)
+    assert res.headers['X-Cache'] == 'MISS' and res.get_json()['venue']['name'] == 'Renamed'
+    assert client.get('/venues/%d' % second.id).headers['X-Cache'] == 'HIT'
+
+
+def test_cached_body_is_only_served_with_the_etag_it_was_rendered_under(client):
+    venue = make_venue()
+    venue_id = venue.id
+    first = client.get('/venues/%d' % venue_id)
+    # a change no invalidation has reached yet
+    db.session.execute(text("UPDATE venue SET name = 'Renamed', version = version + 1 WHERE id = :id"),
+                       {'id': venue_id})
+    db.session.commit()
+    res = client.get('/venues/%d' % venue_id, headers={'If-None-Match': first.headers['ETag']})
+    assert res.status_code == 200 and res.headers['X-Cache'] == 'MISS'
+    assert res.get_json()['venue']['name'] == 'Renamed' and res.headers['ETag'] != first.headers['ETag']
+    again = client.get('/venues/%d' % venue_id, headers={'If-None-Match': res.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_new_show_invalidates_its_venue_artists_and_listings(client):
+    venue, other = make_venue(), make_venue(name='Park Square')
+    artist, bystander = make_artist(), make_artist(name='Bystander')
+    urls = ['/venues/%d' % venue.id, '/venues/%d' % other.id, '/artists/%d' % artist.id,
+            '/artists/%d' % bystander.id, '/shows', '/venues']
+    for url in urls:
+        client.get(url)
+    make_show(venue, [artist], datetime(2030, 1, 1))
+    # the venue listing carries show counters, so it goes too
+    assert [client.get(url).headers['X-Cache'] for url in urls] == ['MISS', 'HIT', 'MISS', 'HIT', 'MISS', 'MISS']
+
+
+def test_rescheduling_a_show_invalidates_its_artists_pages(client):
+    venue, artist = make_venue(), make_artist()
+    show = make_show(venue, [artist], datetime(2030, 1, 1))
+    client.get('/artists/%d' % artist.id)
+    db.session.expire_all()
+    show = Show.query.get(show.id)
+    show.time = datetime(2031, 1, 1)
+    db.session.commit()
+    res = client.get('/artists/%d' % artist.id)
+    assert res.headers['X-Cache'] == 'MISS'
+    assert res.get_json()['artist']['upcoming_shows'][0]['time'].startswith('2031')
+
+
+def test_lru_backend_evicts_and_drops_tags():
+    backend = LRUBackend(maxsize=2, ttl=60)
+    backend.set('venue:1', b'1', {'venue:1'})
+    backend.set('venue:2', b'2', {'venue:2', 'venues'})
+    backend.get('venue:1')
+    backend.set('venue:3', b'3', {'venue:3', 'venues'})
+    assert backend.get('venue:2') is None and backend.get('venue:1') == b'1'
+    backend.invalidate({'venues'})
+    assert backend.get('venue:3') is None and backend.get('venue:1') == b'1'
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.values, self.sets = {}, {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member)
+
+    def expire(self, key, ttl):
+        pass
+
+    def smembers(self, key):
+        return set(self.sets.get(key, ()))
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.sets.pop(key, None)
+
+
+def test_redis_backend_invalidates_by_tag(app):
+    backend = RedisBackend(FakeRedis(), ttl=60)
+    app.extensions['cache'] = backend
+    client = app.test_client()
+    venue = make_venue()
+    client.get('/venues/%d' % venue.id)
+    assert client.get('/venues/%d' % venue.id).headers['X-Cache'] == 'HIT'
+    db.session.delete(venue)
+    db.session.commit()
+    assert client.get('/venues/%d' % venue.id).status_code == 404
+
+
+def test_conditional_get_answers_304_without_rendering(client):
+    venue = make_venue()
+    first = client.get('/venues/%d' % venue.id)
+    etag = first.headers['ETag']
+    db.session.remove()
+    with count_queries(db.engine) as counter:
+        res = client.get('/venues/%d' % venue.id, headers={'If-None-Match': etag})
+    assert res.status_code == 304 and res.data == b'' and len(counter) == 1
+    make_show(venue, [make_artist()], datetime(2030, 1, 1))
+    res = client.get('/venues/%d' % venue.id, headers={'If-None-Match': etag})
+    assert res.status_code == 200 and res.headers['ETag'] != etag
+
+
+def test_genre_change_bumps_version_and_etag(client):
+    artist = make_artist()
+    etag = client.get('/artists/%d' % artist.id).headers['ETag']
+    artist.genres = 'Folk'
+    db.session.commit()
+    assert artist.version == 2
+    assert client.get('/artists/%d' % artist.id).headers['ETag'] != etag
+
+
+def test_update_with_stale_if_match_is_rejected(client):
+    venue = make_venue()
+    etag = client.get('/venues/%d' % venue.id).headers['ETag']
+    res = client.patch('/venues/%d' % venue.id, json={'name': 'New name'}, headers={'If-Match': etag})
+    assert res.status_code == 200 and res.get_json()['venue']['name'] == 'New name'
+    assert res.headers['ETag'] != etag
+    res = client.patch('/venues/%d' % venue.id, json={'name': 'Lost update'}, headers={'If-Match': etag})
+    assert res.status_code == 412
+    assert client.patch('/venues/%d' % venue.id, json={'owner': 'x'}).status_code == 400
+
+
+def test_concurrent_version_change_surfaces_as_412(app):
+    venue = make_venue()
+    with db.engine.begin() as connection:
+        connection.execute(text('UPDATE venue SET version = version + 1 WHERE id = :id'), {'id': venue.id})
+    venue.name = 'Overwrite'
+    with pytest.raises(StaleDataError):
+        db.session.commit()
+
+
+def test_show_update_moves_artists(client):
+    venue, artist, other = make_venue(), make_artist(), make_artist(name='Other')
+    show = make_show(venue, [artist], datetime(2030, 1, 1))
+    res = client.patch('/shows/%d' % show.id, json={'artist_ids': [other.id], 'time': '2030-02-01T20:00:00'})
+    assert res.get_json()['show']['artist_ids'] == [other.id]
+    assert client.patch('/shows/%d' % show.id, json={'artist_ids': [999]}).status_code == 400
+
+
+def test_import_upserts_profiles_and_links_genres(app, tmp_path):
+    make_venue(name='Old name')
+    source = tmp_path / 'venues.csv'
+    source.write_text(
+        'id,name,city,state,genres\n'
+        '1,The Musical Hop,San Francisco,CA,"Jazz, Folk"\n'
+        ',Park Square,San Francisco,CA,Rock\n'
+        ',,Nowhere,CA,\n'
+        ',Dueling Pianos,New York,NYYYYYYY%s,\n' % ('Y' * 120))
+    result = app.test_cli_runner().invoke(args=['import', 'venues', str(source), '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert '2 imported, 2 rejected' in result.output
+    assert 'line 4: name is required' in result.output
+    db.session.expire_all()
+    first, second = Venue.query.order_by(Venue.id).all()
+    assert (first.name, first.genres, first.version) == ('The Musical Hop', ['Folk', 'Jazz'], 2)
+    assert (second.id, second.genres) == (2, ['Rock'])
+    assert Genre.query.count() == 4
+
+
+def test_import_shows_links_artists_and_rejects_dangling_ids(app, tmp_path):
+    venue, artist = make_venue(), make_artist()
+    source = tmp_path / 'shows.jsonl'
+    source.write_text(
+        '{"venue_id": %d, "time": "2030-01-01T20:00:00", "artist_ids": [%d]}\n'
+        '{"venue_id": 99, "time": "2030-01-02T20:00:00"}\n'
+        '{"venue_id": %d, "time": "2030-01-03T20:00:00", "artist_ids": "%d;98"}\n'
+        'not json\n' % (venue.id, artist.id, venue.id, artist.id))
+    result = app.test_cli_runner().invoke(args=['import', 'shows', str(source)])
+    assert '1 imported, 3 rejected' in result.output
+    assert 'line 2: venue 99 does not exist' in result.output
+    assert 'line 3: artists 98 do not exist' in result.output
+    db.session.expire_all()
+    show, = Show.query.all()
+    assert [a.id for a in show.artist] == [artist.id] and show.time == datetime(2030, 1, 1, 20)
+    result = app.test_cli_runner().invoke(args=['import', 'shows', str(source), '--max-errors', '1'])
+    assert result.exit_code == 1 and 'more than 1 invalid rows' in result.output
+
+
+def test_show_import_recounts_only_the_venues_and_artists_it_touched(app, tmp_path):
+    first, second, bystander = make_venue(), make_venue(name='Park Square'), make_venue(name='Bystander')
+    artist = make_artist()
+    show_id = make_show(first, [artist], datetime(2030, 1, 1, 20)).id
+    db.session.execute(text('UPDATE venue SET upcoming_show_count = 7 WHERE id = :id'), {'id': bystander.id})
+    db.session.commit()
+    source = tmp_path / 'shows.jsonl'
+    # moves the show to the second venue, so the first one's counter drops too
+    source.write_text('{"id": %d, "venue_id": %d, "time": "2030-01-01T20:00:00", "artist_ids": []}\n'
+                      % (show_id, second.id))
+    assert '1 imported' in app.test_cli_runner().invoke(args=['import', 'shows', str(source)]).output
+    assert counts(first, second, artist, bystander) == [(0, 0), (1, 0), (0, 0), (7, 0)]
+
+
+def test_export_streams_one_ndjson_record_per_show(client):
+    venue, artists = seed_graph(shows=3)
+    lonely = make_show(venue, [], datetime(2031, 1, 1))
+    res = client.get('/export/shows')
+    assert res.is_streamed and res.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in res.data.decode().splitlines()]
+    assert [r['id'] for r in records] == [1, 2, 3, lonely.id]
+    assert records[0]['artist_ids'] == [artists[0].id, artists[1].id]
+    assert records[0]['venue_name'] == venue.name and records[-1]['artist_names'] == []
+    assert client.get('/export/shows?format=xml').status_code == 400
+    assert client.get('/export/tickets').status_code == 404
+
+
+def test_export_gzips_csv_that_imports_back(app, client, tmp_path):
+    make_venue(name='Park Square', genres='Jazz,Rock')
+    res = client.get('/export/venues?format=csv', headers={'Accept-Encoding': 'gzip'})
+    assert res.headers['Content-Encoding'] == 'gzip'
+    rows = list(csv.DictReader(io.StringIO(gzip.decompress(res.data).decode())))
+    assert (rows[0]['name'], rows[0]['genres']) == ('Park Square', 'Jazz,Rock')
+    output = tmp_path / 'venues.csv.gz'
+    result = app.test_cli_runner().invoke(args=['export', 'venues', '--format', 'csv', '-o', str(output)])
+    assert result.exit_code == 0 and gzip.decompress(output.read_bytes()) == gzip.decompress(res.data)
+    result = app.test_cli_runner().invoke(args=['import', 'venues', str(output)])
+    assert '1 imported, 0 rejected' in result.output
+
+
+def test_booking_rejects_overlapping_slots_at_a_venue(client):
+    venue, other = make_venue(), make_venue(name='Park Square')
+    artist = make_artist()
+    res = client.post('/shows', json={'venue_id': venue.id, 'artist_ids': [artist.id],
+                                      'time': '2030-01-01T20:00:00', 'duration': 90})
+    assert res.status_code == 201 and res.get_json()['show']['duration'] == 90
+    clash = {'venue_id': venue.id, 'time': '2030-01-01T21:00:00'}
+    assert client.post('/shows', json=clash).status_code == 409
+    assert client.post('/shows', json=dict(clash, venue_id=other.id)).status_code == 201
+    # back to back is fine
+    assert client.post('/shows', json=dict(clash, time='2030-01-01T21:30:00')).status_code == 201
+    assert client.post('/shows', json=dict(clash, time='2030-01-02T20:00:00', duration=0)).status_code == 400
+    assert client.post('/shows', json=dict(clash, venue_id=999)).status_code == 400
+
+
+def test_rescheduling_into_a_taken_slot_is_a_conflict(client):
+    venue = make_venue()
+    show = make_show(venue, [], datetime(2030, 1, 1, 20))
+    later = make_show(venue, [], datetime(2030, 1, 2, 20))
+    assert client.patch('/shows/%d' % later.id, json={'time': '2030-01-01T21:00:00'}).status_code == 409
+    assert client.patch('/shows/%d' % show.id, json={'duration': 180}).status_code == 200
+    db.session.expire_all()
+    assert later.time == datetime(2030, 1, 2, 20)
+
+
+def test_series_occurrences_are_expanded_for_the_requested_window_only(client):
+    venue, artist = make_venue(), make_artist()
+    body = {'artist_ids': [artist.id], 'rrule': 'FREQ=WEEKLY;BYDAY=FR', 'starts_at': '2020-01-03T21:00:00',
+            'duration': 120}
+    res = client.post('/venues/%d/series' % venue.id, json=body)
+    assert res.status_code == 201 and res.get_json()['series']['ends_at'] is None
+    series_id = res.get_json()['series']['id']
+    # years of history cost nothing: only the window's Fridays are generated
+    data = client.get('/calendar?start=2030-03-01T00:00:00&end=2030-03-31T00:00:00').get_json()['data']
+    assert [entry['time'] for entry in data] == ['2030-03-%02dT21:00:00' % day for day in (1, 8, 15, 22, 29)]
+    assert data[0]['series_id'] == series_id and data[0]['artist_ids'] == [artist.id] and data[0]['show_id'] is None
+    assert client.get('/calendar?start=2030-03-01T00:00:00&end=2030-09-01T00:00:00').status_code == 400
+    assert client.post('/venues/%d/series' % venue.id, json=dict(body, rrule='FREQ=HOURLY')).status_code == 400
+    count = client.post('/venues/%d/series' % venue.id, json=dict(body, rrule='FREQ=DAILY;COUNT=3',
+                                                                    starts_at='2030-06-01T12:00:00'))
+    assert count.get_json()['series']['rrule'] == 'FREQ=DAILY;UNTIL=20300603T120000'
+    # a new series or show may not land on an occurrence
+    clash = dict(body, rrule='FREQ=MONTHLY;BYMONTHDAY=1', starts_at='2030-03-01T22:00:00')
+    res = client.post('/venues/%d/series' % venue.id, json=clash)
+    assert res.status_code == 409
+    assert client.post('/shows', json={'venue_id': venue.id, 'time': '2030-03-08T20:00:00'}).status_code == 409
+    assert client.post('/shows', json={'venue_id': venue.id, 'time': '2030-03-08T23:00:00'}).status_code == 201
+
+
+def test_series_occurrences_can_be_edited_and_cancelled(client):
+    venue, artist, guest = make_venue(), make_artist(), make_artist(name='Guest')
+    res = client.post('/venues/%d/series' % venue.id, json={
+        'artist_ids': [artist.id], 'rrule': 'RRULE:FREQ=WEEKLY;UNTIL=20300331T235959',
+        'starts_at': '2030-03-01T21:00:00'})
+    series_id = res.get_json()['series']['id']
+    url = '/series/%d/occurrences/%%s' % series_id
+    # moving an occurrence keeps its own slot free for it
+    res = client.patch(url % '2030-03-08T21:00:00', json={'time': '2030-03-08T22:00:00', 'artist_ids': [guest.id]})
+    assert res.status_code == 200 and res.get_json()['show']['series_id'] == series_id
+    # but not the neighbouring occurrence's
+    assert client.patch(url % '2030-03-15T21:00:00', json={'time': '2030-03-22T20:00:00'}).status_code == 409
+    assert client.delete(url % '2030-03-22T21:00:00').status_code == 200
+    assert client.delete(url % '2030-03-22T21:00:00').status_code == 404
+    assert client.patch(url % '2030-03-09T21:00:00', json={'duration': 60}).status_code == 404
+    data = client.get('/calendar?start=2030-03-01T00:00:00&end=2030-04-01T00:00:00&venue_id=%d'
+                      % venue.id).get_json()['data']
+    assert [(entry['time'][8:13], entry['show_id'] is not None, entry['artist_ids']) for entry in data] == [
+        ('01T21', False, [artist.id]),
+        ('08T22', True, [guest.id]),
+        ('15T21', False, [artist.id]),
+        ('29T21', False, [artist.id]),
+    ]
+    # the cancelled slot can be booked again
+    assert client.post('/shows', json={'venue_id': venue.id, 'time': '2030-03-22T21:00:00'}).status_code == 201
+
+
+def test_available_venues_have_a_long_enough_free_window(client):
+    hop = make_venue()
+    square, closed = make_venue(name='Park Square'), make_venue(name='Closed')
+    make_venue(name='Elsewhere', city='Austin', state='TX')
+    closed.look_talent = 'n'
+    db.session.commit()
+    # the hop is busy 18:00-02:00 apart from a one hour gap; the square all evening
+    make_show(hop, [], datetime(2030, 1, 1, 18))
+    make_show(hop, [], datetime(2030, 1, 1, 21))
+    make_show(hop, [], datetime(2030, 1, 1, 23)).duration = 180
+    series = client.post('/venues/%d/series' % square.id, json={
+        'rrule': 'FREQ=DAILY', 'starts_at': '2029-12-01T18:00:00', 'duration': 480}).get_json()['series']
+    db.session.commit()
+    url = '/venues/available?start=2030-01-01T18:00:00&end=2030-01-02T02:00:00&city=San Francisco&min_minutes=%d'
+    assert client.get(url % 60).get_json()['data'][0]['free'] == [
+        {'start': '2030-01-01T20:00:00', 'end': '2030-01-01T21:00:00'}]
+    assert client.get(url % 90).get_json()['data'] == []
+    assert client.delete('/series/%d/occurrences/2030-01-01T18:00:00' % series['id']).status_code == 200
+    res = client.get(url % 90 + '&genre=Jazz,Blues&limit=1').get_json()
+    assert [venue['name'] for venue in res['data']] == ['Park Square'] and res['next_cursor'] is None
+    assert client.get(url % 90 + '&genre=Rock').get_json()['data'] == []
+    assert client.get(url.replace('02T02', '01T17') % 60).status_code == 400
+
+
+def counts(*rows):
+    # the CLI runner removes the test's session, so fetch the rows again by identity
+    db.session.expire_all()
+    rows = [db.session.get(type(row), inspect(row).identity) for row in rows]
+    return [(row.upcoming_show_count, row.past_show_count) for row in rows]
+
+
+def test_show_counters_follow_writes_and_rolls(client):
+    venue, other = make_venue(), make_venue(name='Park Square')
+    artist, guest = make_artist(), make_artist(name='Guest')
+    old = make_show(venue, [artist], datetime(2020, 1, 1))
+    new = make_show(venue, [artist, guest], datetime.now() + timedelta(days=30))
+    # the watermark starts at the epoch, so both count as upcoming until a roll
+    assert counts(venue, artist, guest) == [(2, 0), (2, 0), (1, 0)]
+    result = client.application.test_cli_runner().invoke(args=['counters', 'roll'])
+    assert 'rolled counters of 1 venues and 1 artists' in result.output
+    assert counts(venue, artist, guest) == [(1, 1), (1, 1), (1, 0)]
+    new = Show.query.get(inspect(new).identity)
+    new.venue_id = inspect(other).identity[0]
+    new.artist = [Artist.query.get(inspect(guest).identity)]
+    db.session.commit()
+    assert counts(venue, other, artist, guest) == [(0, 1), (1, 0), (0, 1), (1, 0)]
+    db.session.delete(Show.query.get(inspect(old).identity))
+    db.session.commit()
+    assert counts(venue, artist) == [(0, 0), (0, 0)]
+    assert client.get('/venues').get_json()['data'][1]['upcoming_show_count'] == 1
+
+
+def test_reconcile_repairs_drifted_counters(app):
+    venue, artist = make_venue(), make_artist()
+    make_show(venue, [artist], datetime(2030, 1, 1))
+    db.session.execute(text('UPDATE venue SET upcoming_show_count = 7'))
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['counters', 'reconcile'])
+    assert 'repaired 1 venues and 0 artists' in result.output
+    assert counts(venue, artist) == [(1, 0), (1, 0)]
+
+
+def test_venues_by_region_groups_in_one_query(client):
+    make_venue(name='The Musical Hop')
+    make_venue(name='Park Square')
+    make_venue(name='Dueling Pianos', city='New York', state='NY')
+    with count_queries(db.engine) as counter:
+        body = client.get('/venues/by-region').get_json()
+    assert len(counter) == 1
+    assert [(r['city'], r['state'], [v['name'] for v in r['venues']]) for r in body['data']] == [
+        ('New York', 'NY', ['Dueling Pianos']),
+        ('San Francisco', 'CA', ['Park Square', 'The Musical Hop']),
+    ]
+    assert body['data'][0]['venues'][0]['num_upcoming_shows'] == 0
+    res = client.get('/venues/by-region?city=New+York&state=NY')
+    assert [r['city'] for r in res.get_json()['data']] == ['New York']
+
+
+def test_region_cache_is_invalidated_by_venue_writes_in_that_region(client):
+    venue = make_venue(name='Park Square')
+    urls = ['/venues/by-region?state=CA', '/venues/by-region?state=NY', '/venues/by-region']
+    for url in urls:
+        client.get(url)
+    assert [client.get(url).headers['X-Cache'] for url in urls] == ['HIT', 'HIT', 'HIT']
+    make_show(venue, [], datetime(2030, 1, 1))
+    assert [client.get(url).headers['X-Cache'] for url in urls] == ['MISS', 'HIT', 'MISS']
+    venue.city, venue.state = 'New York', 'NY'
+    db.session.commit()
+    assert [client.get(url).headers['X-Cache'] for url in urls] == ['MISS', 'MISS', 'MISS']
+    assert client.get(urls[0]).get_json()['data'] == []
+
+
+def test_venues_are_geocoded_and_found_nearest_first(app, client):
+    app.extensions['geocoder'] = TableGeocoder([
+        ('1015 Folsom Street', 'San Francisco', 'CA', 37.7786, -122.4059),
+        ('', 'San Francisco', 'CA', 37.7749, -122.4194),
+        ('', 'Oakland', 'CA', 37.8044, -122.2712),
+    ])
+    hop, square, far = make_venue(), make_venue(name='Park Square'), make_venue(name='Far', city='Oakland')
+    assert (hop.latitude, hop.longitude) == (37.7786, -122.4059)
+    for venue in (hop, square, far):
+        make_show(venue, [], datetime(2030, 1, 1, 20))
+    square.address = '1 Unknown Way'
+    db.session.commit()
+    assert (square.latitude, square.longitude) == (37.7749, -122.4194)  # the city's entry
+    # next door, but nothing on
+    assert make_venue(name='No Shows').latitude == 37.7786
+    data = client.get('/venues/near?lat=37.7790&lng=-122.4060&radius_km=5').get_json()['data']
+    assert [venue['name'] for venue in data] == ['The Musical Hop', 'Park Square']
+    assert data[0]['distance_km'] < 0.1 and 1.0 < data[1]['distance_km'] < 1.5
+    data = client.get('/venues/near?lat=37.7790&lng=-122.4060&radius_km=50&limit=3').get_json()['data']
+    assert [venue['name'] for venue in data] == ['The Musical Hop', 'Park Square', 'Far']
+    assert client.get('/venues/near?lat=91&lng=0').status_code == 400
+    assert client.get('/venues/near?lat=0&lng=0&radius_km=5000').status_code == 400
+
+
+def test_bounding_box_contains_the_circle_across_the_antimeridian():
+    low_lat, high_lat, spans = bounding_box(10.0, 179.9, 50)
+    assert spans[0][1] == 180.0 and spans[1][0] == -180.0
+    assert haversine(10.0, 179.9, 10.0, -179.8) < 50 and -179.8 < spans[1][1]
+    assert bounding_box(89.9, 0, 50)[2] == [(-180.0, 180.0)]
+    assert abs(haversine(0, 0, 0, 1) - 111.19) < 0.01
+
+
+def test_requests_are_timed_and_exported_as_metrics(client, caplog):
+    venue = make_venue()
+    with caplog.at_level('INFO', logger='instrumentation'):
+        res = client.get('/venues/%d' % venue.id)
+    assert res.headers['Server-Timing'].startswith('db;dur=')
+    record = json.loads([r.message for r in caplog.records if '"request"' in r.message][-1])
+    assert record['endpoint'] == '/venues/<int:venue_id>' and record['statements'] >= 3
+    assert len(record['slowest']) == 3
+    client.get('/nowhere')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'fyyur_http_requests_total{method="GET",endpoint="/venues/<int:venue_id>",status="200"} 1' in text
+    assert 'fyyur_http_requests_total{method="GET",endpoint="unmatched",status="404"} 1' in text
+    assert 'fyyur_http_request_duration_seconds_count{endpoint="/venues/<int:venue_id>"} 1' in text
+    assert 'fyyur_db_statements_total{endpoint="/venues/<int:venue_id>"} %d' % record['statements'] in text
+
+
+def test_slow_queries_are_logged_redacted_with_their_plan(app, client, caplog):
+    app.config.update(SLOW_QUERY_MS=1e-9, SLOW_QUERY_EXPLAIN=1.0)
+    make_venue(name="O'Hara's")
+    with caplog.at_level('WARNING', logger='instrumentation'):
+        client.get('/search?q=hara')
+    slow = [json.loads(r.message) for r in caplog.records if '"slow_query"' in r.message]
+    assert slow and all("O'Hara" not in entry['statement'] for entry in slow)
+    assert any('SCAN' in (entry.get('plan') or '') or 'SEARCH' in (entry.get('plan') or '') for entry in slow)
+    assert 'fyyur_db_slow_queries_total ' in client.get('/metrics').get_data(as_text=True)
+
+
+def test_slow_query_plans_skip_locking_and_streamed_reads():
+    plain, streamed = SimpleNamespace(execution_options={}), SimpleNamespace(execution_options={'stream_results': True})
+    assert explainable('SELECT id FROM shows WHERE id = %(id)s', plain, False)
+    assert not explainable('SELECT id FROM shows', streamed, False)
+    for lock in ('FOR UPDATE', 'FOR NO KEY UPDATE', 'for share', 'FOR KEY SHARE'):
+        assert not explainable('SELECT id FROM shows %s SKIP LOCKED' % lock, plain, False)
+    assert not explainable('UPDATE shows SET duration = 60', plain, False)
+
+
+def test_redact_hides_inline_literals():
+    assert redact("SELECT *  FROM venue\nWHERE name = 'it''s' AND id = 5 AND x_1 = ?") == \
+        'SELECT * FROM venue WHERE name = ? AND id = ? AND x_1 = ?'
+
+
+def test_generated_catalogue_is_reproducible_and_loads(app):
+    data = generate(venues=5, artists=20, shows=60, seed=7)
+    assert data == generate(venues=5, artists=20, shows=60, seed=7)
+    assert data != generate(venues=5, artists=20, shows=60, seed=8)
+    by_venue = sorted((show['venue_id'], show['time'], show['duration']) for show in data['shows'])
+    for (venue, start, minutes), (next_venue, next_start, _) in zip(by_venue, by_venue[1:]):
+        assert venue != next_venue or \
+            datetime.fromisoformat(start) + timedelta(minutes=minutes) <= datetime.fromisoformat(next_start)
+    stats = load(data, batch_size=25)
+    assert [stats[kind].imported for kind in ('venues', 'artists', 'shows')] == [5, 20, 60]
+    assert Show.query.count() == 60
+    assert sum(venue.upcoming_show_count + venue.past_show_count for venue in Venue.query) == 60
+
+
+def test_benchmark_report_flags_regressions_against_a_baseline():
+    baseline = {'detail': summarize([0.010] * 100, 0, 1.0)}
+    assert compare({'detail': summarize([0.011] * 100, 0, 1.0)}, baseline) == []
+    failures = compare({'detail': summarize([0.020] * 50, 1, 1.0), 'search': summarize([0.5], 0, 1.0)}, baseline)
+    assert [failure.split(':')[0] for failure in failures] == ['detail'] * 5
+    assert 'req/s' in failures[-1]
+
+
+def asgi_request(adapter, method, path, body=b'', query=b''):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'http_version': '1.1',
+             'headers': [(b'content-type', b'application/json'), (b'accept-encoding', b'identity')]}
+    asyncio.run(adapter(scope, receive, send))
+    start, chunks = messages[0], [message['body'] for message in messages[1:]]
+    assert messages[-1].get('more_body', False) is False
+    return start['status'], dict(start['headers']), b''.join(chunks)
+
+
+def test_asgi_adapter_serves_reads_writes_and_streams_on_its_pools(app):
+    venue = make_venue()
+    adapter = ThreadPoolASGI(app, read_workers=2, write_workers=1)
+    status, headers, body = asgi_request(adapter, 'GET', '/venues/%d' % venue.id)
+    assert status == 200 and json.loads(body)['venue']['name'] == 'The Musical Hop'
+    assert headers[b'content-type'] == b'application/json'
+    status, _, body = asgi_request(adapter, 'POST', '/shows',
+                                   json.dumps({'venue_id': venue.id, 'time': '2030-01-01T20:00:00'}).encode())
+    assert status == 201
+    status, _, body = asgi_request(adapter, 'GET', '/export/shows', query=b'format=csv')
+    assert status == 200 and body.decode().splitlines()[1].startswith('1,2030-01-01T20:00:00,120,')
+    adapter.pending = adapter.max_pending
+    status, headers, body = asgi_request(adapter, 'GET', '/venues')
+    assert status == 503 and headers[b'retry-after'] == b'1' and json.loads(body)['error'] == 503
+
+
+def test_profiles_pick_debug_and_require_a_production_secret(monkeypatch):
+    assert create_app(profile='development').debug
+    assert create_app(profile='testing').testing
+    with pytest.raises(RuntimeError):
+        create_app(profile='production')
+    monkeypatch.setenv('FYYUR_ENV', 'production')
+    app = create_app({'SECRET_KEY': 'from-the-environment'})
+    assert not app.debug and not app.testing and app.secret_key == 'from-the-environment'
+    with pytest.raises(ValueError):
+        create_app(profile='staging')
+
+
+def test_migrate_commands_load_on_first_use(app):
+    assert 'migrate' not in app.extensions
+    res = app.test_cli_runner().invoke(args=['db', '--help'])
+    assert res.exit_code == 0 and 'upgrade' in res.output
+    assert app.extensions['migrate'].directory == app.config['MIGRATIONS_DIRECTORY']
+
+
+def test_memory_queue_runs_jobs_on_worker_threads_and_retries_with_backoff(app):
+    app.config.update(JOBS_BACKOFF=0.01, JOBS_MAX_ATTEMPTS=3, JOBS_POLL_INTERVAL=0.01)
+    calls = []
+
+    @handler('test.flaky')
+    def flaky(n):
+        calls.append(n)
+        if calls.count(n) < 2:
+            raise RuntimeError('try again')
+    queue = MemoryQueue(app)
+    queue.submit([Job('test.flaky', {'n': n}) for n in range(5)])
+    deadline = time.monotonic() + 5
+    while (len(calls) < 10 or len(queue)) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    queue.stop(1)
+    assert sorted(calls) == sorted(list(range(5)) * 2)
+    assert {thread.name for thread in queue._threads} == {'jobs-0', 'jobs-1'}
+
+
+def test_durable_jobs_are_written_with_the_write_and_claimed_once(app):
+    app.config.update(JOBS_WORKERS=0, JOBS_BACKOFF=0, JOBS_MAX_ATTEMPTS=2)
+    queue = app.extensions['jobs'] = DatabaseQueue(app)
+    # a shared cache is invalidated by a job, which any process may run
+    app.extensions['cache'] = RedisBackend(FakeRedis(), ttl=60)
+    app.extensions['geocoder'] = TableGeocoder([('1015 Folsom Street', 'San Francisco', 'CA', 37.7786, -122.4059)])
+    hop = make_venue()
+    db.session.add(Venue('Rolled Back', 'Oakland', 'CA', '1 Main St', None, None, None, None, 'y', None, ''))
+    db.session.flush()
+    db.session.rollback()
+    queued = dict(db.session.execute(select(job_table.c.id, job_table.c.name)).all())
+    assert sorted(queued.values()) == ['cache.invalidate', 'geocode_venue']
+    assert hop.latitude is None
+    db.session.remove()
+
+    if db.engine.dialect.name == 'postgresql':
+        # a row another worker has locked is skipped rather than waited for
+        with db.engine.connect() as other, other.begin():
+            locked = other.execute(select(job_table.c.id).order_by(job_table.c.id).limit(1)
+                                   .with_for_update()).scalar()
+            claimed = queue.claim(5)
+            assert [job.id for job in claimed] == [id for id in sorted(queued) if id != locked]
+    else:
+        claimed = queue.claim(1)
+    # claimed jobs are leased, so the next claim gets the others
+    rest = queue.claim(5)
+    assert sorted(job.id for job in claimed + rest) == sorted(queued)
+    for job in claimed + rest:
+        queue.finish(job, run(app, job))
+    hop = db.session.get(Venue, hop.id)
+    assert (hop.latitude, hop.longitude) == (37.7786, -122.4059)
+    # geocoding changed the venue, which queued its cache invalidation
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['worker', '--once']).output == 'ran 1 jobs\n'
+
+    handler('test.broken')(lambda: 1 / 0)
+    jobs.submit('test.broken')
+    assert runner.invoke(args=['worker', '--once']).output == 'ran 2 jobs\n'
+    (attempts, failed_at, last_error), = db.session.execute(
+        select(job_table.c.attempts, job_table.c.failed_at, job_table.c.last_error)).all()
+    assert attempts == 2 and failed_at is not None and last_error.startswith('ZeroDivisionError')
+
+
+def test_process_local_cache_is_cleared_at_commit_with_a_durable_queue(app):
+    app.config.update(JOBS_WORKERS=0)
+    app.extensions['jobs'] = DatabaseQueue(app)
+    client = app.test_client()
+    venue = make_venue()
+    venue_id = venue.id
+    client.get('/venues/%d' % venue_id)
+    res = client.patch('/venues/%d' % venue_id, json={'name': 'Renamed'},
+                       headers={'If-Match': client.get('/venues/%d' % venue_id).headers['ETag']})
+    assert res.status_code == 200
+    # no worker has run, yet this process's LRU no longer serves the old name
+    res = client.get('/venues/%d' % venue_id)
+    assert res.headers['X-Cache'] == 'MISS' and res.get_json()['venue']['name'] == 'Renamed'
+    assert 'cache.invalidate' not in db.session.execute(select(job_table.c.name)).scalars().all()
+
+
+def test_online_ops_add_backfill_index_and_tighten_a_column(app):
+    from alembic.migration import MigrationContext
+    from alembic.operations import Operations
+    from migrations import online_ops
+    for name in ('A', 'B', 'C', 'D', 'E'):
+        make_venue(name)
+    db.session.remove()
+    with db.engine.connect() as conn:
+        with Operations.context(MigrationContext.configure(conn)):
+            online_ops.add_column('venue', sa.Column('rank', sa.Integer(), nullable=False))
+            online_ops.backfill('venue', 'rank = id * 10', batch_size=2, pause=0)
+            # each row once, however the condition is written
+            online_ops.backfill('venue', 'rank = rank + 1', where="name = 'A' OR name = 'E'", batch_size=2, pause=0)
+            online_ops.create_index('ix_venue_rank', 'venue', ['rank'])
+            online_ops.set_not_null('venue', 'rank', existing_type=sa.Integer())
+    columns = {column['name']: column for column in inspect(db.engine).get_columns('venue')}
+    assert columns['rank']['nullable'] is False
+    assert 'ix_venue_rank' in {index['name'] for index in inspect(db.engine).get_indexes('venue')}
+    ranks = db.session.execute(text('SELECT id, rank FROM venue')).fetchall()
+    assert sorted(rank - venue_id * 10 for venue_id, rank in ranks) == [0, 0, 0, 1, 1]
+
+
+def test_lock_report_flags_blocking_statements_per_revision(app):
+    from migrations.online_ops import LockReport
+    pg = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql://localhost/unused'}, profile='testing')
+    res = pg.test_cli_runner().invoke(args=['db', 'upgrade', '--sql', '-x', 'rows=shows:5000000'])
+    assert res.exit_code == 0, res.output
+    assert 'ALTER TABLE shows ADD COLUMN venue_id INTEGER NOT NULL' in res.output
+    report = res.output[res.output.index('-- estimated locks'):]
+    assert 'shows: 5000000 rows' in report
+    assert re.search(r'f323aba683fb upgrade +3\.3s blocking', report)
+    assert re.search(r'b91e4d7a3c20 upgrade +0\.0s blocking', report)
+
+    # what set_not_null and a batched backfill write, judged as such
+    report = LockReport({'shows': 5000000})
+    for sql in ('-- online_ops: batched backfill of 1000 rows', 'UPDATE shows SET hall_id = 1',
+                'ALTER TABLE shows ADD CONSTRAINT ck_shows_hall_id_not_null CHECK (hall_id IS NOT NULL) NOT VALID',
+                'ALTER TABLE shows VALIDATE CONSTRAINT ck_shows_hall_id_not_null',
+                'ALTER TABLE shows ALTER COLUMN hall_id SET NOT NULL'):
+        report.feed(sql + ';\n\n')
+    update, check, validate, not_null = report.pending
+    assert update.batch == 1000 and update.seconds < 1
+    assert check.seconds == validate.seconds == not_null.seconds == 0
+    assert LockReport({'shows': 5000000}).classify('ALTER TABLE shows ALTER COLUMN hall_id SET NOT NULL').seconds > 1
+
+
+def test_forked_worker_gets_fresh_engines(app):
+    inherited = db.engine
+    dispose_engines(app)
+    assert db.engine is not inherited
+
+
+def test_past_months_are_archived_to_csv_searched_and_restored(app, tmp_path):
+    app.config.update(PARTITION_ARCHIVE_DIR=str(tmp_path), PARTITION_ARCHIVE_MONTHS=1)
+    venue, artist = make_venue(), make_artist()
+    venue_id, artist_id = venue.id, artist.id
+    old_id = make_show(venue, [artist], datetime(2020, 1, 10, 20)).id
+    make_show(venue, [], datetime(2020, 2, 3, 20))
+    make_show(venue, [artist], datetime.now() + timedelta(days=30))
+    runner = app.test_cli_runner()
+    if db.engine.dialect.name == 'postgresql':
+        # months before the migration's belong to shows_history, which 2020 is archived from
+        result = runner.invoke(args=['partitions', 'ensure'])
+        assert result.output == '0 partitions created\n'
+        plan = '\n'.join(db.session.execute(text('EXPLAIN SELECT id FROM shows WHERE venue_id = :venue AND time > :now'),
+                                             {'venue': venue_id, 'now': datetime.now()}).scalars())
+        db.session.rollback()  # archiving waits for open transactions on shows
+        # past months are pruned; the default partition only holds months beyond the ones ensured
+        assert 'shows_history' not in plan and 'shows_%s' % datetime.now().strftime('%Y_%m') in plan
+    else:
+        assert runner.invoke(args=['partitions', 'ensure']).exit_code == 2
+
+    result = runner.invoke(args=['partitions', 'archive'])
+    assert 'archived 1 shows of shows_2020_01' in result.output
+    assert 'archived 1 shows of shows_2020_02' in result.output
+    assert Show.query.count() == 1 and db.session.execute(text('SELECT count(*) FROM artist_shows')).scalar() == 1
+    # archiving took the shows out of the counters too
+    assert 'repaired 0 venues and 0 artists' in runner.invoke(args=['counters', 'reconcile']).output
+    assert counts(venue, artist) == [(1, 0), (1, 0)]
+
+    found = runner.invoke(args=['partitions', 'query', '--artist', str(artist_id), '--end', '2021-01-01'])
+    record, = [json.loads(line) for line in found.output.splitlines()]
+    assert (record['id'], record['time'], record['artist_ids']) == (old_id, '2020-01-10T20:00:00', [artist_id])
+    result = runner.invoke(args=['import', 'shows', str(tmp_path / 'shows_2020_01.csv.gz')])
+    assert '1 imported, 0 rejected' in result.output
+    assert db.session.get(Show, old_id).artist[0].id == artist_id
+
+
+def test_archive_is_only_published_once_its_month_is_removed(app, tmp_path, monkeypatch):
+    app.config.update(PARTITION_ARCHIVE_DIR=str(tmp_path), PARTITION_ARCHIVE_MONTHS=1)
+    make_show(make_venue(), [make_artist()], datetime(2020, 1, 10, 20))
+    db.session.remove()
+
+    def fail(connection, deltas):
+        raise RuntimeError('counters unavailable')
+    monkeypatch.setattr(counters, 'apply_deltas', fail)
+    result = app.test_cli_runner().invoke(args=['partitions', 'archive'])
+    assert isinstance(result.exception, RuntimeError)
+    assert list(tmp_path.iterdir()) == [] and Show.query.count() == 1
@@ -0,0 +1,16 @@
+"""WSGI entry point, e.g. ``gunicorn --preload --workers 4 wsgi:app``.
+
+The app is built once at import, which with --preload happens in the
+gunicorn master before it forks. Building it opens no connections and does
+not import Alembic, so forking is cheap; a worker that inherits engines
+anyway (something queried during import) drops them and opens its own.
+The production profile is used unless FYYUR_ENV says otherwise.
+"""
+import os
+
+from app import create_app
+from database import dispose_engines
+
+
+app = create_app(profile=os.environ.get('FYYUR_ENV', 'production'))
+os.register_at_fork(after_in_child=lambda: dispose_engines(app))